@@ -1,38 +1,55 @@
 from tqdm import tqdm
 import json
-import gzip
+import sys
+from array import array
 from pprint import pp
-import os
 from collections import defaultdict
-
+from checkpoint import (
+    clear_partial_batches,
+    input_fingerprint,
+    load_checkpoint,
+    mark_stage_done,
+    save_checkpoint,
+    stage_is_current,
+    stage_record,
+)
+from columnar import load_ids, save_shard
+from gzip_index import open_gzip
+from instrument import count, end_stage, reject, start_stage, timer
+from isbn_index import INDEX_FOLDER, asin_works, has_isbn, open_isbn_index
+from runs import concat, first_fields, list_runs, merge_runs, write_run
+from sharding import (
+    AGGREGATE_WORKERS,
+    SHARDING,
+    WORKER_MEMORY,
+    aggregate_shards,
+    run_order,
+)
+from storage import AsyncWriter, open_storage
+from subject_index import SUBJECT_INDEX_FOLDER, build_genre_index
 
 BOOK_PATH = "data/amazon/meta_Books.jsonl.gz"
 REVIEWS_PATH = "data/amazon/Books.jsonl.gz"
-S3_FOLDER = "mock_s3"
+S3_FOLDER = "mock_s3"  # or an s3://bucket/prefix location, see storage.py
 
 BOOK_SAMPLE_SIZE = 5000
 REVIEW_SAMPLE_SIZE = 50000
 BOOK_ID_FIRST_N = 2
 REVIEW_ID_FIRST_N = 3
 BATCH_SIZE = 100
+BATCH_BYTES = 2**28  # estimated memory of a reviews batch that flushes it
+RATINGS = {1, 2, 3, 4, 5}  # Amazon ratings are whole stars
+RATING_BYTES = 9  # user number, ASIN number and rating of one buffered rating
+USER_BYTES = 100  # a batch's entry for a user besides the id string, about
+OUTPUT_FORMAT = "json"  # "json" or "columnar", see columnar.py
 
+# names of stage checkpoints and stage records
+OL_STAGE = "ol_editions"
+BOOK_STAGE = "amz_books"
+REVIEW_STAGE = "amz_reviews"
 
-def _remove_folder(folder_path, recursed=False):
-    """Recursively delete a folder."""
-    names = os.listdir(folder_path)
-    for name in names:
-        path = folder_path + f"/{name}"
-        if os.path.isfile(path):
-            os.remove(path)
-        else:
-            _remove_folder(path, recursed=True)
-            os.rmdir(path)
-
-    if not recursed:
-        os.rmdir(folder_path)
 
-
-def _parse_book(line, ol_isbn_10s, ol_isbn_13s) -> tuple[str, dict]:
+def _parse_book(line, ol_isbns) -> tuple[str, dict]:
     """Parse a single line into edition key and data"""
 
     # preprocess line into dictionary
@@ -42,13 +59,13 @@ def _parse_book(line, ol_isbn_10s, ol_isbn_13s) -> tuple[str, dict]:
     # only include English books
     language = raw_json["details"].get("Language")
     if not language or language != "English":
-        return None, None
+        return reject("language")
 
     # check if book has ISBNs, otherwise return None
     isbn_10 = raw_json["details"].get("ISBN 10")
     isbn_13 = raw_json["details"].get("ISBN 13")
     if not isbn_10 and not isbn_13:
-        return None, None
+        return reject("no_isbn")
     if isbn_10:
         book["isbn_10"] = isbn_10
     if isbn_13:
@@ -57,15 +74,15 @@ def _parse_book(line, ol_isbn_10s, ol_isbn_13s) -> tuple[str, dict]:
     # check if one of the ISBNs is in the open library dataset, otherwise return None
     # TODO watch out for this! could cause a very small sample
 
-    if isbn_10 not in ol_isbn_10s and isbn_13 not in ol_isbn_13s:
-        return None, None
+    if not has_isbn(ol_isbns, [isbn_10, isbn_13]):
+        return reject("not_in_open_library")
 
     # only include books w/ more than one rating
     num_ratings = int(raw_json.get("rating_number"))
     if num_ratings > 1:
         book["num_ratings"] = num_ratings
     else:
-        return None, None
+        return reject("few_ratings")
 
     # get average rating
     avg_rating = raw_json.get("average_rating")
@@ -77,7 +94,7 @@ def _parse_book(line, ol_isbn_10s, ol_isbn_13s) -> tuple[str, dict]:
     if genre and len(genre) >= 2:
         book["genre"] = genre[1]
     else:
-        return None, None
+        return reject("no_genre")
 
     # get number of pages
     hard_pages = raw_json["details"].get("Hardcover")
@@ -87,7 +104,7 @@ def _parse_book(line, ol_isbn_10s, ol_isbn_13s) -> tuple[str, dict]:
     elif soft_pages:
         book["num_pages"] = int(soft_pages.split()[0])
     else:
-        return None, None
+        return reject("no_pages")
 
     # get publication year
     pub_year = raw_json["details"].get("Publisher")
@@ -96,111 +113,163 @@ def _parse_book(line, ol_isbn_10s, ol_isbn_13s) -> tuple[str, dict]:
             pub_year = int(pub_year[-5:-1])
             book["publication_year"] = pub_year
         except ValueError:
-            return None, None
+            return reject("bad_year")
 
     asin = raw_json["parent_asin"]
 
     return asin, book
 
 
-def _save_book_batch(batch_books, batch_isbn10, batch_isbn13, batch_count, n):
-    """Save one batch's works (grouped into files by first n characters) and work ids"""
-    # make temporary directories if they don't exist
-    os.makedirs(f"{S3_FOLDER}/temp_batches", exist_ok=True)
-    os.makedirs(f"{S3_FOLDER}/temp_batches/amz_books", exist_ok=True)
-    os.makedirs(f"{S3_FOLDER}/temp_batches/amz_isbn10", exist_ok=True)
-    os.makedirs(f"{S3_FOLDER}/temp_batches/amz_isbn13", exist_ok=True)
-
-    # group books by first n characters of id
-    books_n = defaultdict(dict)
-    for book_id, book_data in batch_books.items():
-        books_n[book_id[:n]][book_id] = book_data
-
-    # save batch of works to directory by their id's first n characters
-    for book_n_id, book_n_data in books_n.items():
-        book_n_dir = f"{S3_FOLDER}/temp_batches/amz_books/{book_n_id}"
-        os.makedirs(book_n_dir, exist_ok=True)
-        with open(book_n_dir + f"/batch_{batch_count}.json", "w") as f:
-            json.dump(book_n_data, f)
-
-    # save isbn10s by batch
-    with open(
-        f"{S3_FOLDER}/temp_batches/amz_isbn10/batch_{batch_count}.json", "w"
-    ) as f:
-        json.dump(batch_isbn10, f)
-
-    # save isbn13s by batch
-    with open(
-        f"{S3_FOLDER}/temp_batches/amz_isbn13/batch_{batch_count}.json", "w"
-    ) as f:
-        json.dump(batch_isbn13, f)
-
-
-def _aggregate_book_batches():
-    """Aggregate temporary batches into corresponding folders"""
+def _save_book_batch(
+    storage, batch_books, batch_isbn10, batch_isbn13, batch_count, sharding=SHARDING
+):
+    """Save one batch's books and ISBNs as sorted runs"""
+    # spill each map as one run sorted by ASIN, books in the order they're sharded in
+    write_run(
+        storage,
+        f"temp_batches/amz_books/batch_{batch_count}.jsonl",
+        batch_books.items(),
+        run_order(sharding),
+    )
+    write_run(
+        storage,
+        f"temp_batches/amz_isbn10/batch_{batch_count}.jsonl",
+        batch_isbn10.items(),
+    )
+    write_run(
+        storage,
+        f"temp_batches/amz_isbn13/batch_{batch_count}.jsonl",
+        batch_isbn13.items(),
+    )
+    write_run(
+        storage,
+        f"temp_batches/amz_genres/batch_{batch_count}.jsonl",
+        [(asin, {"genre": book.get("genre")}) for asin, book in batch_books.items()],
+    )
+
+
+def _aggregate_book_batches(
+    storage,
+    writer,
+    n=BOOK_ID_FIRST_N,
+    output_format=OUTPUT_FORMAT,
+    sharding=SHARDING,
+    aggregate_workers=AGGREGATE_WORKERS,
+    worker_memory=WORKER_MEMORY,
+):
+    """Aggregate temporary batches into corresponding folders by merging their sorted runs
+
+    Sharded outputs are queued on writer, the single-file maps are streamed to storage
+    since they hold every id and would be buffered in memory by the writer.
+    With aggregate_workers > 1, books are merged by a pool of processes while the maps
+    are aggregated here (see sharding.py), into the same shards.
+    """
+    # every run has to be stored before they're merged
+    writer.flush()
+
+    # books are merged meanwhile by a pool of processes, or after the maps
+    finish_books = aggregate_shards(
+        storage,
+        writer,
+        S3_FOLDER,
+        "amz_books",
+        list_runs(storage, "temp_batches/amz_books"),
+        first_fields,
+        "amz_books",
+        output_format,
+        sharding,
+        first_n=n,
+        workers=aggregate_workers,
+        worker_memory=worker_memory,
+        desc="Aggregating books",
+    )
 
     # aggregate ISBN 10s and save
-    isbn_10s = defaultdict(list)
-    for batch_filename in tqdm(
-        os.listdir(f"{S3_FOLDER}/temp_batches/amz_isbn10"), desc="Aggregating ISBN 10s"
-    ):
-        with open(f"{S3_FOLDER}/temp_batches/amz_isbn10/{batch_filename}", "r") as f:
-            batch = json.load(f)
-            for asin, isbn10 in batch.items():
-                isbn_10s[asin] += isbn10
-    with open(f"{S3_FOLDER}/amz_isbn10s.json", "w") as f:
-        json.dump(isbn_10s, f)
+    save_shard(
+        storage,
+        "amz_isbn10s",
+        tqdm(
+            merge_runs(storage, list_runs(storage, "temp_batches/amz_isbn10"), concat),
+            desc="Aggregating ISBN 10s",
+        ),
+        "id_lists",
+        output_format,
+    )
 
     # aggregate ISBN 13s and save
-    isbn_13s = defaultdict(list)
-    for batch_filename in tqdm(
-        os.listdir(f"{S3_FOLDER}/temp_batches/amz_isbn13"), desc="Aggregating ISBN 13s"
-    ):
-        with open(f"{S3_FOLDER}/temp_batches/amz_isbn13/{batch_filename}", "r") as f:
-            batch = json.load(f)
-            for asin, isbn13 in batch.items():
-                isbn_13s[asin] += isbn13
-    with open(f"{S3_FOLDER}/amz_isbn13s.json", "w") as f:
-        json.dump(isbn_13s, f)
-
-    # aggregate books
-    for first_n_id in tqdm(
-        os.listdir(f"{S3_FOLDER}/temp_batches/amz_books"), desc="Aggregating books"
-    ):
-        books_group = dict()
-        for batch_group_filename in os.listdir(
-            f"{S3_FOLDER}/temp_batches/amz_books/{first_n_id}"
-        ):
-            with open(
-                f"{S3_FOLDER}/temp_batches/amz_books/{first_n_id}/{batch_group_filename}",
-                "r",
-            ) as f:
-                batch_group = json.load(f)
-                for asin, book_data in batch_group.items():
-                    if asin not in books_group.keys():
-                        books_group[asin] = book_data
-
-                    else:
-                        book_keys = books_group[asin].keys()
-                        for key, value in book_data.items():
-                            if key not in book_keys:
-                                books_group[asin][key] = value
-
-        # export group to json, converting subjects from set to list
-        os.makedirs(f"{S3_FOLDER}/amz_books", exist_ok=True)
-        with open(f"{S3_FOLDER}/amz_books/{first_n_id}.json", "w") as f:
-            json.dump(books_group, f)
-
-    # clear temporary batches
-    _remove_folder(f"{S3_FOLDER}/temp_batches")
+    save_shard(
+        storage,
+        "amz_isbn13s",
+        tqdm(
+            merge_runs(storage, list_runs(storage, "temp_batches/amz_isbn13"), concat),
+            desc="Aggregating ISBN 13s",
+        ),
+        "id_lists",
+        output_format,
+    )
+
+    # index the books' genres under their works, beside the works' own subjects
+    if storage.exists(f"{SUBJECT_INDEX_FOLDER}/meta.json"):
+        _, n_genres = build_genre_index(
+            storage,
+            tqdm(
+                merge_runs(
+                    storage, list_runs(storage, "temp_batches/amz_genres"), first_fields
+                ),
+                desc="Indexing genres",
+            ),
+            asin_works(storage),
+            SUBJECT_INDEX_FOLDER,
+        )
+        count("indexed_genres", n_genres)
+    else:
+        print("No subject index to add genres to, it's built by the Open Library stage")
+
+    # aggregate books, writing each shard once all of its ASINs have been merged
+    finish_books()
+
+    # the shards are stored, clear temporary batches
+    storage.delete("temp_batches")
 
 
 def process_book_batches(
     book_path=BOOK_PATH,
     batch_size=BATCH_SIZE,
     book_sample_size=BOOK_SAMPLE_SIZE,
+    output_format=OUTPUT_FORMAT,
+    resume=False,
+    skip_if_current=False,
+    sharding=SHARDING,
+    aggregate_workers=AGGREGATE_WORKERS,
+    worker_memory=WORKER_MEMORY,
+    sample_fraction=None,
 ):
-    """Process Amazon book data in batches"""
+    """Process Amazon book data in batches
+
+    sharding selects prefix or hash sharded outputs (see sharding.py), aggregate_workers > 1
+    merges them in a pool of processes using up to worker_memory each.
+    resume=True continues from the last checkpointed batch of an interrupted run with
+    the same inputs, skip_if_current=True skips the stage if its outputs are current.
+    sample_fraction reads a uniform random sample of about that fraction of the lines
+    instead of the whole file (see gzip_index.py).
+    Batches and shards are written by a pool of threads, so parsing doesn't wait on them.
+    """
+    storage = open_storage(S3_FOLDER)
+    temp_folder = "temp_batches"
+    inputs = input_fingerprint(
+        book_path,
+        batch_size=batch_size,
+        book_sample_size=book_sample_size,
+        output_format=output_format,
+        sharding=sharding,
+        sample_fraction=sample_fraction,
+        upstream=stage_record(storage, OL_STAGE),
+    )
+    if skip_if_current and stage_is_current(storage, BOOK_STAGE, inputs):
+        print("Amazon books are already processed, skipping")
+        return
+    start_stage(BOOK_STAGE)
+    writer = AsyncWriter(storage)
 
     # define variables for batch
     batch_books = dict()
@@ -208,203 +277,420 @@ def process_book_batches(
     batch_isbn13 = defaultdict(list)
     batch_count = 0
 
-    # variable for whether or not books have been aggregated
-    aggregated = False
-
-    # read in open library isbns before iteration for efficiency
-    with open(f"{S3_FOLDER}/isbn_10s.json", "r") as f:
-        ol_isbn10s = json.load(f).keys()
-    with open(f"{S3_FOLDER}/isbn_13s.json", "r") as f:
-        ol_isbn13s = json.load(f).keys()
+    # memory-map the open library isbn index, isbn 10s and 13s share normalized keys
+    ol_isbns = open_isbn_index(storage, INDEX_FOLDER)
 
     # define variable for tracking number of samples collected
     total_processed = 0
 
-    with gzip.open(book_path, "rb") as f:
-        with tqdm(
-            f,
-            desc="Processing books",
-        ) as t:
-            for line in t:
-                key, edition = _parse_book(line, ol_isbn10s, ol_isbn13s)
-                if total_processed % 1000 == 0:
-                    t.set_postfix(total_processed=total_processed)
-
-                if key and edition:
-                    batch_books[key] = edition
-                    isbn10 = edition.get("isbn_10")
-                    isbn13 = edition.get("isbn_13")
-                    if isbn10:
-                        batch_isbn10[key].append(isbn10)
-                    if isbn13:
-                        batch_isbn13[key].append(isbn13)
-                    total_processed += 1
-
-                    if (
-                        len(batch_books) >= batch_size
-                        or total_processed == book_sample_size
-                    ):
-                        # aggregate into works and save
-                        _save_book_batch(
-                            batch_books,
-                            batch_isbn10,
-                            batch_isbn13,
-                            batch_count,
-                            BOOK_ID_FIRST_N,
-                        )
-
-                        # reset batch
-                        batch_books.clear()
-                        batch_isbn10.clear()
-                        batch_isbn13.clear()
-                        batch_count += 1
-
-                    # if processed the number we want, break
-                    if total_processed == book_sample_size:
-                        print(
-                            f"\nProcessed {total_processed} books in {batch_count} batches\n"
-                        )
-                        _aggregate_book_batches()
-                        aggregated = False
-                        break
-
-    # aggregate batches in case sample size isn't reached
-    if not aggregated:
-        _aggregate_book_batches()
-
-
-def _parse_review(line, asins) -> tuple[str, dict]:
-    """Parse a single line into edition key and data"""
+    # define variables for where to start reading and whether reading has finished
+    offset = 0
+    parsed = False
+
+    # pick up from the last checkpoint, otherwise clear anything left by an earlier run
+    checkpoint = (
+        load_checkpoint(storage, temp_folder, BOOK_STAGE, inputs) if resume else None
+    )
+    if checkpoint:
+        batch_count = checkpoint["batch_count"]
+        total_processed = checkpoint["total_processed"]
+        offset = checkpoint["offset"]
+        parsed = checkpoint["parsed"]
+        clear_partial_batches(storage, temp_folder, batch_count)
+        print(f"Resuming after {total_processed} books in {batch_count} batches")
+    else:
+        storage.delete(temp_folder)
+
+    if not parsed:
+        with open_gzip(book_path, sample_fraction) as f, timer("parse"):
+            # jumps through the file's gzip index if it has one, otherwise decompresses up
+            # to the offset without parsing
+            f.seek(offset)
+            start_offset = offset
+            with tqdm(
+                f,
+                desc="Processing books",
+            ) as t:
+                for line in t:
+                    offset += len(line)
+                    key, edition = _parse_book(line, ol_isbns)
+                    if total_processed % 1000 == 0:
+                        t.set_postfix(total_processed=total_processed)
+
+                    if key and edition:
+                        batch_books[key] = edition
+                        isbn10 = edition.get("isbn_10")
+                        isbn13 = edition.get("isbn_13")
+                        if isbn10:
+                            batch_isbn10[key].append(isbn10)
+                        if isbn13:
+                            batch_isbn13[key].append(isbn13)
+                        total_processed += 1
+
+                        # save and checkpoint
+                        if len(batch_books) >= batch_size:
+                            with timer("save"):
+                                _save_book_batch(
+                                    writer,
+                                    batch_books,
+                                    batch_isbn10,
+                                    batch_isbn13,
+                                    batch_count,
+                                    sharding,
+                                )
+
+                            # reset batch
+                            batch_books.clear()
+                            batch_isbn10.clear()
+                            batch_isbn13.clear()
+                            batch_count += 1
+                            save_checkpoint(
+                                writer,
+                                temp_folder,
+                                BOOK_STAGE,
+                                inputs,
+                                offset=offset,
+                                compressed_offset=f.fileobj.tell(),
+                                batch_count=batch_count,
+                                total_processed=total_processed,
+                                parsed=False,
+                            )
+
+                        # if processed the number we want, break
+                        if total_processed == book_sample_size:
+                            break
+
+            # save the last partial batch
+            if batch_books:
+                with timer("save"):
+                    _save_book_batch(
+                        writer,
+                        batch_books,
+                        batch_isbn10,
+                        batch_isbn13,
+                        batch_count,
+                        sharding,
+                    )
+                batch_count += 1
+            count("lines", t.n)
+            count("bytes_read", offset - start_offset)
+            count("compressed_bytes_read", f.fileobj.tell())
+            save_checkpoint(
+                writer,
+                temp_folder,
+                BOOK_STAGE,
+                inputs,
+                offset=offset,
+                compressed_offset=f.fileobj.tell(),
+                batch_count=batch_count,
+                total_processed=total_processed,
+                parsed=True,
+            )
+
+    print(f"\nProcessed {total_processed} books in {batch_count} batches\n")
+    count("accepted", total_processed)
+    with timer("aggregate"):
+        _aggregate_book_batches(
+            storage,
+            writer,
+            output_format=output_format,
+            sharding=sharding,
+            aggregate_workers=aggregate_workers,
+            worker_memory=worker_memory,
+        )
+    writer.close()
+    mark_stage_done(storage, BOOK_STAGE, inputs)
+    end_stage()
+
+
+def _parse_review(line, asin_ids) -> tuple[str, tuple[int, int]]:
+    """Parse a single line into user id and (ASIN number, rating)"""
 
     # preprocess line into dictionary
     raw_json = json.loads(line)
 
     # only include books in our ASINs
-    asin = raw_json.get("asin")
-    if not asin or not asin in asins:
-        return None, None
+    asin_id = asin_ids.get(raw_json.get("asin"))
+    if asin_id is None:
+        return reject("unknown_asin")
 
     # only include verified purchases
     if not raw_json["verified_purchase"]:
-        return None, None
+        return reject("unverified")
 
     # get user id and rating
     user_id = raw_json["user_id"]
     rating = raw_json["rating"]
-
-    return user_id, {asin: rating}
-
-
-def _save_review_batch(batch_reviews, batch_count, n):
-    """Save one batch's works (grouped into files by first n characters) and work ids"""
-    # make temporary directories if they don't exist
-    os.makedirs(f"{S3_FOLDER}/temp_batches", exist_ok=True)
-    os.makedirs(f"{S3_FOLDER}/temp_batches/reviews", exist_ok=True)
-
-    # group books by first n characters of id
-    reviews_n = defaultdict(dict)
-    for user_id, review in batch_reviews.items():
-        reviews_n[user_id[:n]][user_id] = review
-
-    # save batch of works to directory by their id's first n characters
-    for user_n_id, user_n_data in reviews_n.items():
-        user_n_dir = f"{S3_FOLDER}/temp_batches/reviews/{user_n_id}"
-        os.makedirs(user_n_dir, exist_ok=True)
-        with open(user_n_dir + f"/batch_{batch_count}.json", "w") as f:
-            json.dump(user_n_data, f)
-
-
-def _aggregate_review_batches():
-    """Aggregate temporary batches into corresponding folders"""
-    # aggregate reviews
-    for first_n_id in tqdm(
-        os.listdir(f"{S3_FOLDER}/temp_batches/reviews"), desc="Aggregating reviews"
-    ):
-        reviews_group = defaultdict(list)
-        for batch_group_filename in os.listdir(
-            f"{S3_FOLDER}/temp_batches/reviews/{first_n_id}"
-        ):
-            with open(
-                f"{S3_FOLDER}/temp_batches/reviews/{first_n_id}/{batch_group_filename}",
-                "r",
-            ) as f:
-                batch_group = json.load(f)
-                for user_id, review in batch_group.items():
-                    reviews_group[user_id] += review
-
-        # export group to json, converting subjects from set to list
-        os.makedirs(f"{S3_FOLDER}/reviews", exist_ok=True)
-        with open(f"{S3_FOLDER}/reviews/{first_n_id}.json", "w") as f:
-            json.dump(reviews_group, f)
-
-    # clear temporary batches
-    _remove_folder(f"{S3_FOLDER}/temp_batches")
+    if rating not in RATINGS:
+        return reject("invalid_rating")
+
+    return user_id, (asin_id, int(rating))
+
+
+class ReviewBatch:
+    """One batch of ratings, buffered in parallel arrays
+
+    Users are numbered in the order the batch first sees them and ASINs by their index in
+    asin_names, so a rating takes RATING_BYTES plus one id string per user. Ratings of
+    the same ASIN by the same user are deduplicated when the batch is saved.
+    """
+
+    def __init__(self, asin_names):
+        self.asin_names = asin_names
+        self.user_numbers = dict()  # user id -> number in this batch
+        self.users = array("I")
+        self.asins = array("I")
+        self.ratings = array("b")
+        self.user_bytes = 0
+
+    def add(self, user_id, asin_id, rating):
+        """Buffer one rating"""
+        user = self.user_numbers.get(user_id)
+        if user is None:
+            user = self.user_numbers[user_id] = len(self.user_numbers)
+            self.user_bytes += sys.getsizeof(user_id) + USER_BYTES
+        self.users.append(user)
+        self.asins.append(asin_id)
+        self.ratings.append(rating)
+
+    def __len__(self) -> int:
+        return len(self.ratings)
+
+    @property
+    def nbytes(self) -> int:
+        """Estimated memory held by the batch"""
+        return len(self.ratings) * RATING_BYTES + self.user_bytes
+
+    def items(self) -> list[tuple[str, dict]]:
+        """(user id, {asin: rating}) pairs, a user's later ratings of an ASIN replacing
+        earlier ones"""
+        user_ratings = [dict() for _ in self.user_numbers]
+        for user, asin_id, rating in zip(self.users, self.asins, self.ratings):
+            user_ratings[user][asin_id] = rating
+        return [
+            (
+                user_id,
+                {self.asin_names[a]: float(rating) for a, rating in ratings.items()},
+            )
+            for user_id, ratings in zip(self.user_numbers, user_ratings)
+        ]
+
+
+def _save_review_batch(storage, batch, batch_count, sharding=SHARDING):
+    """Save one batch's ratings as a run of {asin: rating} per user, sorted by user id in
+    the order they're sharded in"""
+    items = batch.items()
+    count("duplicate_ratings", len(batch) - sum(len(ratings) for _, ratings in items))
+    write_run(
+        storage,
+        f"temp_batches/reviews/batch_{batch_count}.jsonl",
+        items,
+        run_order(sharding),
+    )
+
+
+def _merge_reviews(values) -> list[dict]:
+    """Merge one user's ratings from different batches into [{asin: rating}, ...], later
+    ratings of an ASIN replacing earlier ones"""
+    ratings = dict()
+    for batch_ratings in values:
+        ratings.update(batch_ratings)
+    return [{asin: rating} for asin, rating in ratings.items()]
+
+
+def _aggregate_review_batches(
+    storage,
+    writer,
+    n=REVIEW_ID_FIRST_N,
+    output_format=OUTPUT_FORMAT,
+    sharding=SHARDING,
+    aggregate_workers=AGGREGATE_WORKERS,
+    worker_memory=WORKER_MEMORY,
+):
+    """Aggregate temporary batches into corresponding folders by merging their sorted runs,
+    in a pool of processes with aggregate_workers > 1 (see sharding.py)"""
+    # every run has to be stored before they're merged
+    writer.flush()
+
+    # aggregate reviews, writing each shard once all of its users have been merged
+    finish_reviews = aggregate_shards(
+        storage,
+        writer,
+        S3_FOLDER,
+        "reviews",
+        list_runs(storage, "temp_batches/reviews"),
+        _merge_reviews,
+        "reviews",
+        output_format,
+        sharding,
+        first_n=n,
+        workers=aggregate_workers,
+        worker_memory=worker_memory,
+        desc="Aggregating reviews",
+    )
+    finish_reviews()
+
+    # the shards are stored, clear temporary batches
+    storage.delete("temp_batches")
 
 
 def process_review_batches(
     review_path=REVIEWS_PATH,
     batch_size=BATCH_SIZE,
     review_sample_size=REVIEW_SAMPLE_SIZE,
+    output_format=OUTPUT_FORMAT,
+    resume=False,
+    skip_if_current=False,
+    sharding=SHARDING,
+    batch_bytes=BATCH_BYTES,
+    aggregate_workers=AGGREGATE_WORKERS,
+    worker_memory=WORKER_MEMORY,
+    sample_fraction=None,
 ):
-    """Process Amazon book data in batches"""
+    """Process Amazon reviews in batches
+
+    A batch is saved once it holds batch_size ratings or about batch_bytes of memory (see
+    ReviewBatch), and each user's ratings of an ASIN are deduplicated to the latest one.
+    sharding selects prefix or hash sharded outputs (see sharding.py), aggregate_workers > 1
+    merges them in a pool of processes using up to worker_memory each.
+    resume=True continues from the last checkpointed batch of an interrupted run with
+    the same inputs, skip_if_current=True skips the stage if its outputs are current.
+    sample_fraction reads a uniform random sample of about that fraction of the lines
+    instead of the whole file (see gzip_index.py).
+    Batches and shards are written by a pool of threads, so parsing doesn't wait on them.
+    """
+    storage = open_storage(S3_FOLDER)
+    temp_folder = "temp_batches"
+    inputs = input_fingerprint(
+        review_path,
+        batch_size=batch_size,
+        batch_bytes=batch_bytes,
+        review_sample_size=review_sample_size,
+        output_format=output_format,
+        sharding=sharding,
+        sample_fraction=sample_fraction,
+        upstream=stage_record(storage, BOOK_STAGE),
+    )
+    if skip_if_current and stage_is_current(storage, REVIEW_STAGE, inputs):
+        print("Amazon reviews are already processed, skipping")
+        return
+    start_stage(REVIEW_STAGE)
+    writer = AsyncWriter(storage)
+
+    # read in asins before iteration for efficiency, numbering them for the batches
+    asin_names = set(load_ids(storage, "amz_isbn10s"))
+    asin_names.update(load_ids(storage, "amz_isbn13s"))
+    asin_names = sorted(asin_names)
+    asin_ids = {asin: i for i, asin in enumerate(asin_names)}
 
     # define variables for batch
-    batch_reviews = defaultdict(list)
+    batch = ReviewBatch(asin_names)
     batch_count = 0
 
-    # variable for whether or not reviews have been aggregated
-    aggregated = False
-
-    # read in asins before iteration for efficiency
-    with open(f"{S3_FOLDER}/amz_isbn10s.json", "r") as f:
-        asins = set(json.load(f).keys())
-    with open(f"{S3_FOLDER}/amz_isbn13s.json", "r") as f:
-        asins.update(json.load(f).keys())
-
     # define variable for tracking number of samples collected
     total_processed = 0
 
-    with gzip.open(review_path, "rb") as f:
-        with tqdm(
-            f,
-            desc="Processing reviews",
-        ) as t:
-            for line in t:
-                user_id, review = _parse_review(line, asins)
-
-                if user_id and review:
-                    batch_reviews[user_id].append(review)
-                    total_processed += 1
-                    if total_processed % 1000 == 0:
-                        t.set_postfix(total_processed=total_processed)
-
-                    if (
-                        len(batch_reviews) >= batch_size
-                        or total_processed == review_sample_size
-                    ):
-                        # aggregate into works and save
-                        _save_review_batch(
-                            batch_reviews,
-                            batch_count,
-                            REVIEW_ID_FIRST_N,
-                        )
-
-                        # reset batch
-                        batch_reviews.clear()
-                        batch_count += 1
-
-                    # if processed the number we want, break
-                    if total_processed == review_sample_size:
-                        print(
-                            f"\nProcessed {total_processed} reviews in {batch_count} batches\n"
-                        )
-                        _aggregate_review_batches()
-                        aggregated = True
-                        break
-
-    # aggregate reviews in case sample size isn't reached
-    if not aggregated:
-        _aggregate_review_batches()
+    # define variables for where to start reading and whether reading has finished
+    offset = 0
+    parsed = False
+
+    # pick up from the last checkpoint, otherwise clear anything left by an earlier run
+    checkpoint = (
+        load_checkpoint(storage, temp_folder, REVIEW_STAGE, inputs) if resume else None
+    )
+    if checkpoint:
+        batch_count = checkpoint["batch_count"]
+        total_processed = checkpoint["total_processed"]
+        offset = checkpoint["offset"]
+        parsed = checkpoint["parsed"]
+        clear_partial_batches(storage, temp_folder, batch_count)
+        print(f"Resuming after {total_processed} reviews in {batch_count} batches")
+    else:
+        storage.delete(temp_folder)
+
+    if not parsed:
+        with open_gzip(review_path, sample_fraction) as f, timer("parse"):
+            # jumps through the file's gzip index if it has one, otherwise decompresses up
+            # to the offset without parsing
+            f.seek(offset)
+            start_offset = offset
+            with tqdm(
+                f,
+                desc="Processing reviews",
+            ) as t:
+                for line in t:
+                    offset += len(line)
+                    user_id, review = _parse_review(line, asin_ids)
+
+                    if user_id and review:
+                        batch.add(user_id, *review)
+                        total_processed += 1
+                        if total_processed % 1000 == 0:
+                            t.set_postfix(total_processed=total_processed)
+
+                        # save and checkpoint
+                        if len(batch) >= batch_size or batch.nbytes >= batch_bytes:
+                            with timer("save"):
+                                _save_review_batch(
+                                    writer,
+                                    batch,
+                                    batch_count,
+                                    sharding,
+                                )
+
+                            # reset batch
+                            batch = ReviewBatch(asin_names)
+                            batch_count += 1
+                            save_checkpoint(
+                                writer,
+                                temp_folder,
+                                REVIEW_STAGE,
+                                inputs,
+                                offset=offset,
+                                compressed_offset=f.fileobj.tell(),
+                                batch_count=batch_count,
+                                total_processed=total_processed,
+                                parsed=False,
+                            )
+
+                        # if processed the number we want, break
+                        if total_processed == review_sample_size:
+                            break
+
+            # save the last partial batch
+            if len(batch):
+                with timer("save"):
+                    _save_review_batch(writer, batch, batch_count, sharding)
+                batch_count += 1
+            count("lines", t.n)
+            count("bytes_read", offset - start_offset)
+            count("compressed_bytes_read", f.fileobj.tell())
+            save_checkpoint(
+                writer,
+                temp_folder,
+                REVIEW_STAGE,
+                inputs,
+                offset=offset,
+                compressed_offset=f.fileobj.tell(),
+                batch_count=batch_count,
+                total_processed=total_processed,
+                parsed=True,
+            )
+
+    print(f"\nProcessed {total_processed} reviews in {batch_count} batches\n")
+    count("accepted", total_processed)
+    with timer("aggregate"):
+        _aggregate_review_batches(
+            storage,
+            writer,
+            output_format=output_format,
+            sharding=sharding,
+            aggregate_workers=aggregate_workers,
+            worker_memory=worker_memory,
+        )
+    writer.close()
+    mark_stage_done(storage, REVIEW_STAGE, inputs)
+    end_stage()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import time
+
+from synthetic import BOOK_PATH, MANIFEST_PATH, OL_PATH, REVIEWS_PATH, generate
+
+"""
+Benchmarks for the preprocessing stages on synthetic data
+- Each stage runs in its own process (so peak RSS is per stage), in the order preproc.py runs them
+  and through its run_*_stage functions so with the same settings, then preproc.py itself runs
+  end to end on a clean output folder
+- Reports seconds, lines/sec, uncompressed and compressed MB/sec, peak RSS, files written
+  (every file written through storage, by worker processes and temporary batches included)
+  and output size
+- Results are saved as JSON with the git commit and data parameters, so runs can be compared
+"""
+
+BENCH_ROOT = "bench"
+RESULTS_FOLDER = "benchmarks"
+STAGES = ["ol", "books", "reviews"]
+STAGE_INPUTS = {"ol": [OL_PATH], "books": [BOOK_PATH], "reviews": [REVIEWS_PATH]}
+STAGE_INPUTS["end_to_end"] = [OL_PATH, BOOK_PATH, REVIEWS_PATH]
+PREPROCESSING_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def _peak_rss_mb() -> float:
+    """Peak RSS of this process and its finished children in MB"""
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _folder_size(folder) -> tuple[int, int]:
+    """Number of files and total bytes in a folder"""
+    n_files, n_bytes = 0, 0
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            n_files += 1
+            n_bytes += os.path.getsize(f"{root}/{filename}")
+    return n_files, n_bytes
+
+
+def _run_stage(stage):
+    """Run one stage in this process (from the benchmark root) and print its metrics as JSON"""
+    import preproc
+    from instrument import report
+
+    start = time.perf_counter()
+    if stage == "ol":
+        preproc.run_ol_stage()
+    elif stage == "books":
+        preproc.run_book_stage()
+    elif stage == "reviews":
+        preproc.run_review_stage()
+    else:
+        runpy.run_path(f"{PREPROCESSING_FOLDER}/preproc.py", run_name="__main__")
+    seconds = time.perf_counter() - start
+
+    # files counted by storage in every stage, pool workers' included (see instrument.py)
+    files_written = sum(
+        stage["counts"].get("files_written", 0) for stage in report()["stages"].values()
+    )
+    print(
+        json.dumps(
+            {
+                "seconds": seconds,
+                "peak_rss_mb": _peak_rss_mb(),
+                "files_written": files_written,
+            }
+        )
+    )
+
+
+def _benchmark_stage(stage, root, manifest) -> dict:
+    """Run a stage in a child process and combine its metrics with the input sizes"""
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", stage],
+        cwd=root,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        check=True,
+    )
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+
+    # throughput over the stage's inputs
+    inputs = STAGE_INPUTS[stage]
+    lines = sum(manifest["files"][path]["lines"] for path in inputs)
+    mb = sum(manifest["files"][path]["bytes"] for path in inputs) / 1024**2
+    compressed_mb = sum(os.path.getsize(f"{root}/{path}") for path in inputs) / 1024**2
+    output_files, output_bytes = _folder_size(f"{root}/mock_s3")
+
+    return {
+        **result,
+        "lines": lines,
+        "lines_per_sec": lines / result["seconds"],
+        "mb": mb,
+        "mb_per_sec": mb / result["seconds"],
+        "compressed_mb_per_sec": compressed_mb / result["seconds"],
+        "output_files": output_files,
+        "output_mb": output_bytes / 1024**2,
+    }
+
+
+def _git_commit() -> str:
+    """Current git commit, None outside a git repo"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PREPROCESSING_FOLDER,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    root=BENCH_ROOT,
+    results_folder=RESULTS_FOLDER,
+    regenerate=False,
+    **generate_params,
+) -> dict:
+    """Benchmark each stage and the end-to-end run on synthetic data in root, saving results
+
+    Synthetic data is generated with generate_params unless it already exists in root and
+    regenerate is False.
+    """
+    root = os.path.abspath(root)
+    if regenerate or not os.path.exists(f"{root}/{MANIFEST_PATH}"):
+        print("Generating synthetic data")
+        generate(root, **generate_params)
+    with open(f"{root}/{MANIFEST_PATH}", "r") as f:
+        manifest = json.load(f)
+
+    # stages in pipeline order, each one reads the previous one's outputs
+    results = dict()
+    shutil.rmtree(f"{root}/mock_s3", ignore_errors=True)
+    for stage in STAGES:
+        print(f"Benchmarking {stage}")
+        results[stage] = _benchmark_stage(stage, root, manifest)
+
+    # the whole pipeline through preproc.py from a clean output folder
+    print("Benchmarking end to end")
+    shutil.rmtree(f"{root}/mock_s3", ignore_errors=True)
+    results["end_to_end"] = _benchmark_stage("end_to_end", root, manifest)
+
+    report = {
+        "commit": _git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "data": manifest["params"],
+        "stages": results,
+    }
+    os.makedirs(results_folder, exist_ok=True)
+    path = f"{results_folder}/bench_{time.strftime('%Y%m%d_%H%M%S')}_{report['commit']}.json"
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Saved results to {path}")
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing stages")
+    parser.add_argument("--root", default=BENCH_ROOT)
+    parser.add_argument("--results", default=RESULTS_FOLDER)
+    parser.add_argument("--regenerate", action="store_true")
+    parser.add_argument("--editions", type=int, default=100000)
+    parser.add_argument("--english-ratio", type=float, default=0.8)
+    parser.add_argument("--isbn-overlap", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--child", choices=STAGES + ["end_to_end"], help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.child:
+        _run_stage(args.child)
+    else:
+        report = run_benchmarks(
+            args.root,
+            args.results,
+            args.regenerate,
+            n_editions=args.editions,
+            english_ratio=args.english_ratio,
+            isbn_overlap=args.isbn_overlap,
+            seed=args.seed,
+        )
+        for stage, result in report["stages"].items():
+            print(
+                f"{stage:>12}: {result['seconds']:8.2f}s "
+                f"{result['lines_per_sec']:10.0f} lines/s "
+                f"{result['mb_per_sec']:7.1f} MB/s "
+                f"{result['peak_rss_mb']:8.1f} MB peak "
+                f"{result['files_written']:7d} files written"
+            )
@@ -0,0 +1,139 @@
+import json
+from collections import namedtuple
+
+import numpy as np
+from tqdm import tqdm
+
+from amz_preproc import BOOK_STAGE, S3_FOLDER
+from checkpoint import mark_stage_done, stage_is_current, stage_record
+from columnar import load_shard
+from instrument import count, end_stage, start_stage, timer
+from rating_matrix import MATRIX_FOLDER, STAGE as MATRIX_STAGE, open_rating_matrix
+from sharding import shard_paths
+from storage import open_storage
+
+"""
+Book content features for models, aligned with the rating matrix's book indexes
+- Row i is the book at column i of the rating matrix (see rating_matrix.py), so a batch of
+  book indexes gets its features with one fancy index into memory-mapped arrays
+- genres.npy holds an int32 genre index per book, 0 for books without a genre, and
+  meta.json the genre names in index order
+- numeric.npy holds float32 NUMERIC features per book, standardized to mean 0 and standard
+  deviation 1, with missing values at the mean (0)
+"""
+
+FEATURES_FOLDER = "book_features"
+STAGE = "book_features"  # name of this stage's stage record
+NUMERIC = ["num_pages", "publication_year", "avg_rating"]
+UNKNOWN_GENRE = ""  # genre name of index 0
+
+BookFeatures = namedtuple(
+    "BookFeatures", ["genres", "numeric", "genre_names", "numeric_names"]
+)
+
+
+def _save_array(storage, key, values):
+    """Save an array as a .npy file in storage"""
+    with storage.open_write(key) as f:
+        np.save(f, values)
+
+
+def build_book_features(
+    storage, matrix_folder=MATRIX_FOLDER, folder=FEATURES_FOLDER
+) -> int:
+    """Read the Amazon books shards and save the feature arrays for every book in the
+    rating matrix, returning how many books had features"""
+    asins = open_rating_matrix(storage, matrix_folder).asins
+    # genre -> index in the order genres are first seen
+    genre_index = {UNKNOWN_GENRE: 0}
+    genres = np.zeros(len(asins), dtype=np.int32)
+    numeric = np.full((len(asins), len(NUMERIC)), np.nan, dtype=np.float32)
+    found = 0
+
+    columns = ["genre"] + NUMERIC
+    # without rated books (e.g. no reviews matched) there are no rows to look books up in
+    paths = shard_paths(storage, "amz_books") if len(asins) else []
+    for path in tqdm(paths, desc="Building book features"):
+        books = load_shard(storage, path, "amz_books", columns)
+        if not books:
+            continue
+
+        # rows of the shard's books, skipping books nobody rated
+        keys = np.array([asin.encode("utf-8") for asin in books], dtype=bytes)
+        rows = np.minimum(np.searchsorted(asins, keys), len(asins) - 1)
+        rated = asins[rows] == keys
+        for row, book, is_rated in zip(rows, books.values(), rated):
+            if not is_rated:
+                continue
+            genres[row] = genre_index.setdefault(
+                book.get("genre", UNKNOWN_GENRE), len(genre_index)
+            )
+            numeric[row] = [book.get(name, np.nan) for name in NUMERIC]
+        found += int(rated.sum())
+    count("books_without_features", len(asins) - found)
+
+    # relabel genres in sorted order, keeping the unknown genre at 0
+    names = sorted(genre_index)
+    rank = np.empty(len(names), dtype=np.int32)
+    rank[[genre_index[name] for name in names]] = np.arange(len(names))
+    genres = rank[genres]
+
+    # standardize, then missing values become the mean
+    mean = np.nanmean(numeric, axis=0)
+    std = np.nanstd(numeric, axis=0)
+    std[~(std > 0)] = 1
+    numeric = np.nan_to_num((numeric - np.nan_to_num(mean)) / std)
+
+    _save_array(storage, f"{folder}/genres.npy", genres)
+    _save_array(storage, f"{folder}/numeric.npy", numeric.astype(np.float32))
+    meta = {
+        "genres": names,
+        "numeric": NUMERIC,
+        "mean": np.nan_to_num(mean).tolist(),
+        "std": std.tolist(),
+        "books": len(asins),
+        "books_with_features": found,
+    }
+    storage.put(f"{folder}/meta.json", json.dumps(meta).encode("utf-8"))
+    return found
+
+
+def open_book_features(storage, folder=FEATURES_FOLDER) -> BookFeatures:
+    """Memory-map saved book features"""
+    meta = json.loads(storage.get(f"{folder}/meta.json"))
+    return BookFeatures(
+        np.load(storage.local_path(f"{folder}/genres.npy"), mmap_mode="r"),
+        np.load(storage.local_path(f"{folder}/numeric.npy"), mmap_mode="r"),
+        meta["genres"],
+        meta["numeric"],
+    )
+
+
+def process_book_features(folder=FEATURES_FOLDER, skip_if_current=False):
+    """Build the book feature arrays, main function
+
+    skip_if_current=True skips the stage if the features were built from the current rating
+    matrix and books.
+    """
+    storage = open_storage(S3_FOLDER)
+    inputs = {
+        "folder": folder,
+        "numeric": NUMERIC,
+        "matrix": stage_record(storage, MATRIX_STAGE),
+        "books": stage_record(storage, BOOK_STAGE),
+    }
+    if skip_if_current and stage_is_current(storage, STAGE, inputs):
+        print("Book features are already built, skipping")
+        return
+    start_stage(STAGE)
+
+    with timer("build"):
+        found = build_book_features(storage, folder=folder)
+    print(f"\nBuilt features for {found} books\n")
+    count("books", found)
+    mark_stage_done(storage, STAGE, inputs)
+    end_stage()
+
+
+if __name__ == "__main__":
+    process_book_features()
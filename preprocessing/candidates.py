@@ -0,0 +1,532 @@
+import argparse
+import io
+import json
+import shutil
+import tempfile
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+from amz_preproc import S3_FOLDER
+from checkpoint import mark_stage_done, stage_is_current, stage_record
+from group_aggregation import recommend
+from instrument import count, end_stage, start_stage, timer
+from rating_matrix import (
+    MATRIX_FOLDER,
+    STAGE as MATRIX_STAGE,
+    book_ratings,
+    gather_rows,
+    open_rating_matrix,
+    user_index,
+)
+from storage import open_storage
+from synthetic_groups import NEIGHBOURS, nearest_neighbours
+
+"""
+Precomputed candidate books for each user, so group recommendations only score a few
+hundred books instead of the whole catalogue
+- A user's predicted rating of a book is their mean rating plus their neighbours' mean-
+  centered ratings of it, weighted by similarity. Neighbours are each user's most similar
+  users (see synthetic_groups.py), and SHRINKAGE is added to the weights' total so books
+  few neighbours rated aren't ranked above books many rated highly
+- books.npy and scores.npy hold each user's top N unrated books (-1 and 0 padded), row i
+  is user i of the rating matrix, computed in blocks of users in a pool of processes
+- A group's candidates are the union of its members' lists. Every member's predicted
+  rating of every candidate is then aggregated (see group_aggregation.py)
+- Guests, group members without a row in the rating matrix, are scored from their own
+  ratings: their neighbours are the users with the most similar ratings of the same books,
+  found when they're scored, and their top N predictions join the group's candidates
+- A group's constraints (subjects, genres, pages, years, see subject_index.py) are a mask
+  over the books, applied to the candidates before anyone's ratings of them are predicted
+- New ratings are saved as an update in updates/ together with the recomputed lists of
+  the users they affect: the users who rated, and the users who have them as neighbours.
+  Updates are applied on top of the saved lists when the store is opened, and cleared by
+  the next full build. Neighbours themselves are only recomputed by a full build
+"""
+
+CANDIDATES_FOLDER = "candidates"
+UPDATES_FOLDER = "updates"  # inside CANDIDATES_FOLDER
+STAGE = "candidates"  # name of this stage's stage record
+TOP_N = 100  # candidates kept per user
+SHRINKAGE = 1.0  # added to the total similarity of the neighbours who rated a book
+USER_BLOCK = 20000  # users scored per task
+WORKERS = 4
+
+_matrix = None  # the rating matrix, opened in each worker
+# each user's neighbours and their similarities, opened in each worker
+_neighbours = None
+_similarities = None
+
+
+def _open_arrays(location, matrix_folder, folder):
+    """Memory-map the rating matrix and neighbours in a worker"""
+    global _matrix, _neighbours, _similarities
+    storage = open_storage(location)
+    _matrix = open_rating_matrix(storage, matrix_folder)
+    _neighbours = np.load(storage.local_path(f"{folder}/neighbours.npy"), mmap_mode="r")
+    _similarities = np.load(
+        storage.local_path(f"{folder}/similarities.npy"), mmap_mode="r"
+    )
+
+
+def _ratings(matrix, users, new_ratings) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(position in users, book index, rating) of every rating of a batch of users, with new
+    ratings ({user: {book: rating}}) replacing the matrix's ratings of the same books"""
+    owners, books, ratings = gather_rows(matrix, users)
+    added = [
+        (position, book, rating)
+        for position, user in enumerate(users)
+        for book, rating in new_ratings.get(int(user), {}).items()
+    ]
+    if not added:
+        return owners, books, ratings
+
+    added_owners, added_books, added_ratings = (np.array(x) for x in zip(*added))
+    n_books = matrix.shape[1]
+    replaced = np.isin(
+        owners.astype(np.int64) * n_books + books,
+        added_owners.astype(np.int64) * n_books + added_books,
+    )
+    return (
+        np.concatenate([owners[~replaced], added_owners]),
+        np.concatenate([books[~replaced], added_books]).astype(np.int32),
+        np.concatenate([ratings[~replaced], added_ratings]).astype(np.float32),
+    )
+
+
+def _means(owners, ratings, n) -> np.ndarray:
+    """Mean rating of each of n users, 0 for users without ratings"""
+    totals = np.bincount(owners, ratings, minlength=n)
+    return totals / np.maximum(np.bincount(owners, minlength=n), 1)
+
+
+def _from_neighbours(matrix, neighbours, similarities, means, new_ratings, books=None):
+    """(position, book, prediction) arrays of users' predicted ratings of the books their
+    neighbours rated (only books in the sorted books array, if given), from users x k
+    arrays of -1 padded neighbours and their similarities and the users' mean ratings"""
+    n_books = matrix.shape[1]
+
+    # every rating of every neighbour, centered on the neighbour's mean
+    slots = np.flatnonzero(neighbours.ravel() >= 0)
+    flat_neighbours = neighbours.ravel()[slots]
+    weights = similarities.ravel()[slots]
+    owners, neighbour_books, ratings = _ratings(matrix, flat_neighbours, new_ratings)
+    deviations = ratings - _means(owners, ratings, len(flat_neighbours))[owners]
+    positions = slots[owners] // neighbours.shape[1]
+    weights = weights[owners]
+    if books is not None:
+        keep = np.isin(neighbour_books, books)
+        positions, neighbour_books = positions[keep], neighbour_books[keep]
+        deviations, weights = deviations[keep], weights[keep]
+
+    # sum over the neighbours who rated each (user, book)
+    keys = positions.astype(np.int64) * n_books + neighbour_books
+    keys, inverse = np.unique(keys, return_inverse=True)
+    totals = np.bincount(inverse, weights * deviations, len(keys))
+    total_weights = np.bincount(inverse, weights, len(keys))
+    positions, predicted_books = keys // n_books, keys % n_books
+    predictions = means[positions] + totals / (total_weights + SHRINKAGE)
+    return positions, predicted_books, predictions
+
+
+def _predict(matrix, users, neighbours, similarities, new_ratings, books=None):
+    """Predicted ratings of the books the users' neighbours rated but they didn't (only
+    books in the sorted books array, if given), returning (position in users, book,
+    prediction) arrays and the users' mean ratings"""
+    n_books = matrix.shape[1]
+    users = np.asarray(users)
+    own = _ratings(matrix, users, new_ratings)
+    means = _means(own[0], own[2], len(users))
+    positions, predicted_books, predictions = _from_neighbours(
+        matrix,
+        np.asarray(neighbours[users]),
+        np.asarray(similarities[users]),
+        means,
+        new_ratings,
+        books,
+    )
+
+    keys = positions * n_books + predicted_books
+    unrated = ~np.isin(keys, own[0].astype(np.int64) * n_books + own[1])
+    return (
+        positions[unrated],
+        predicted_books[unrated],
+        predictions[unrated].astype(np.float32),
+        means,
+    )
+
+
+def _guest_neighbours(matrix, books, ratings, k) -> tuple[np.ndarray, np.ndarray]:
+    """The k users of the rating matrix most similar (by cosine similarity of ratings) to a
+    guest who rated books, as -1 padded (neighbours, similarities) arrays"""
+    rated = [book_ratings(matrix, book) for book in books.tolist()]
+    users = np.concatenate([users for users, _ in rated] + [np.empty(0, np.int32)])
+    products = np.concatenate(
+        [
+            values.astype(np.float64) * rating
+            for (_, values), rating in zip(rated, ratings)
+        ]
+        + [np.empty(0)]
+    )
+    users, inverse = np.unique(users, return_inverse=True)
+    dots = np.bincount(inverse, products, len(users))
+
+    owners, _, values = gather_rows(matrix, users)
+    norms = np.sqrt(np.bincount(owners, values.astype(np.float64) ** 2, len(users)))
+    similarities = dots / (norms * np.sqrt(np.sum(ratings.astype(np.float64) ** 2)))
+    top = np.argsort(-similarities, kind="stable")[:k]
+
+    neighbours = np.full(k, -1, dtype=np.int32)
+    neighbour_similarities = np.zeros(k, dtype=np.float32)
+    neighbours[: len(top)] = users[top]
+    neighbour_similarities[: len(top)] = similarities[top]
+    return neighbours, neighbour_similarities
+
+
+def _top_n(positions, books, predictions, n_users, n) -> tuple[np.ndarray, np.ndarray]:
+    """Each user's n highest predictions as (books, scores) arrays of shape users x n"""
+    order = np.lexsort((-predictions, positions))
+    positions, books, predictions = positions[order], books[order], predictions[order]
+    ranks = np.arange(len(positions)) - np.searchsorted(positions, positions)
+    keep = ranks < n
+
+    top_books = np.full((n_users, n), -1, dtype=np.int32)
+    top_scores = np.zeros((n_users, n), dtype=np.float32)
+    top_books[positions[keep], ranks[keep]] = books[keep]
+    top_scores[positions[keep], ranks[keep]] = predictions[keep]
+    return top_books, top_scores
+
+
+def _score_users(task) -> tuple[np.ndarray, np.ndarray]:
+    """Candidate lists of users start to end"""
+    start, end, n = task
+    users = np.arange(start, end)
+    positions, books, predictions, _ = _predict(
+        _matrix, users, _neighbours, _similarities, dict()
+    )
+    return _top_n(positions, books, predictions, len(users), n)
+
+
+def _save_array(storage, key, values):
+    """Save an array as a .npy file in storage"""
+    with storage.open_write(key) as f:
+        np.save(f, values)
+
+
+def _save_file(storage, key, path):
+    """Copy a local file (e.g. a memory-mapped .npy built on disk) to storage"""
+    with open(path, "rb") as source, storage.open_write(key) as f:
+        shutil.copyfileobj(source, f, 2**24)
+
+
+def build_candidates(
+    location=S3_FOLDER,
+    matrix_folder=MATRIX_FOLDER,
+    folder=CANDIDATES_FOLDER,
+    n=TOP_N,
+    k=NEIGHBOURS,
+    workers=WORKERS,
+) -> int:
+    """Find every user's neighbours and save their top n candidates, returning the number of
+    users with candidates"""
+    storage = open_storage(location)
+    with timer("neighbours"):
+        neighbours, similarities = nearest_neighbours(
+            location, matrix_folder, k, workers=workers
+        )
+    _save_array(storage, f"{folder}/neighbours.npy", neighbours)
+    _save_array(storage, f"{folder}/similarities.npy", similarities)
+    n_users = len(neighbours)
+    del neighbours, similarities
+
+    found = 0
+    tasks = [
+        (start, min(start + USER_BLOCK, n_users), n)
+        for start in range(0, n_users, USER_BLOCK)
+    ]
+    with tempfile.TemporaryDirectory() as temp_folder, Pool(
+        workers, initializer=_open_arrays, initargs=(location, matrix_folder, folder)
+    ) as pool, timer("candidates"):
+        # lists are written to memory-mapped files, so they never all have to be in memory
+        books = np.lib.format.open_memmap(
+            f"{temp_folder}/books.npy", "w+", np.int32, (n_users, n)
+        )
+        scores = np.lib.format.open_memmap(
+            f"{temp_folder}/scores.npy", "w+", np.float32, (n_users, n)
+        )
+        results = pool.imap(_score_users, tasks)
+        for (start, end, _), (block_books, block_scores) in tqdm(
+            zip(tasks, results), total=len(tasks), desc="Scoring candidates"
+        ):
+            books[start:end] = block_books
+            scores[start:end] = block_scores
+            found += int(np.count_nonzero(block_books[:, 0] >= 0))
+
+        books.flush()
+        scores.flush()
+        del books, scores
+        _save_file(storage, f"{folder}/books.npy", f"{temp_folder}/books.npy")
+        _save_file(storage, f"{folder}/scores.npy", f"{temp_folder}/scores.npy")
+
+    # updates were made against the old lists
+    storage.delete(f"{folder}/{UPDATES_FOLDER}")
+    meta = {"users": n_users, "n": n, "neighbours": k, "shrinkage": SHRINKAGE}
+    storage.put(f"{folder}/meta.json", json.dumps(meta).encode("utf-8"))
+    return found
+
+
+class CandidateStore:
+    """Users' precomputed candidate books, group recommendations from them and incremental
+    updates with new ratings"""
+
+    def __init__(
+        self,
+        location=S3_FOLDER,
+        folder=CANDIDATES_FOLDER,
+        matrix_folder=MATRIX_FOLDER,
+    ):
+        self.storage = open_storage(location)
+        self.folder = folder
+        self.matrix = open_rating_matrix(self.storage, matrix_folder)
+        self.books = self._load("books")
+        self.scores = self._load("scores")
+        self.neighbours = self._load("neighbours")
+        self.similarities = self._load("similarities")
+        self.new_ratings = dict()  # user -> {book: rating} from updates
+        self.updated = dict()  # user -> (books, scores) recomputed by updates
+        self.n_updates = 0
+        for key in sorted(
+            self.storage.list(f"{folder}/{UPDATES_FOLDER}"),
+            key=lambda key: int(key.rsplit("_", 1)[-1].split(".")[0]),
+        ):
+            with self.storage.open(key) as f, np.load(f) as update:
+                self._apply(**update)
+            self.n_updates += 1
+
+    def _load(self, name) -> np.ndarray:
+        """Memory-map one of the store's arrays"""
+        key = f"{self.folder}/{name}.npy"
+        return np.load(self.storage.local_path(key), mmap_mode="r")
+
+    def _apply(self, rating_users, rating_books, rating_values, users, books, scores):
+        """Apply an update's new ratings and recomputed lists"""
+        for user, book, rating in zip(
+            rating_users.tolist(), rating_books.tolist(), rating_values.tolist()
+        ):
+            self.new_ratings.setdefault(user, dict())[book] = rating
+        for user, user_books, user_scores in zip(users.tolist(), books, scores):
+            self.updated[user] = (user_books, user_scores)
+
+    def candidates(self, user) -> tuple[np.ndarray, np.ndarray]:
+        """(books, predicted ratings) of a user's candidates, best first"""
+        books, scores = self.updated.get(user, (self.books[user], self.scores[user]))
+        found = books >= 0
+        return np.asarray(books[found]), np.asarray(scores[found])
+
+    def guest(self, books, ratings, n=None, k=None) -> dict:
+        """Predictions for a guest, a member without a row in the rating matrix, from their
+        own ratings of books (rating matrix indexes) through their k most similar users
+
+        Returns their books, ratings and mean, their predicted books (sorted) with the
+        predictions, and their top n candidates, in a dict.
+        """
+        books = np.asarray(books, dtype=np.int32)
+        ratings = np.asarray(ratings, dtype=np.float32)
+        n = n or self.books.shape[1]
+        neighbours, similarities = _guest_neighbours(
+            self.matrix, books, ratings, k or self.neighbours.shape[1]
+        )
+        mean = float(ratings.mean()) if len(ratings) else 0.0
+        _, predicted, predictions = _from_neighbours(
+            self.matrix,
+            neighbours[np.newaxis],
+            similarities[np.newaxis],
+            np.array([mean]),
+            self.new_ratings,
+        )
+        unrated = ~np.isin(predicted, books)
+        predicted = predicted[unrated].astype(np.int32)
+        predictions = predictions[unrated].astype(np.float32)
+        top = np.argsort(-predictions, kind="stable")[:n]
+        return {
+            "books": books,
+            "ratings": ratings,
+            "mean": mean,
+            "neighbours": neighbours[neighbours >= 0],
+            "predicted": predicted,
+            "predictions": predictions,
+            "candidates": predicted[top],
+        }
+
+    def group_candidates(self, members, guests=(), allowed=None) -> np.ndarray:
+        """Sorted union of the members' (and guests', see guest) candidate books, only the
+        books allowed by a bool mask over the books if one is given"""
+        books = np.unique(
+            np.concatenate(
+                [self.candidates(user)[0] for user in members]
+                + [guest["candidates"] for guest in guests]
+                + [np.empty(0, dtype=np.int32)]
+            )
+        ).astype(np.int32)
+        return books if allowed is None else books[allowed[books]]
+
+    def group_ratings(
+        self, members, exclude_rated=True, guests=(), allowed=None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """(candidate books, members x candidates predicted ratings) of a group, with a row
+        after the members' for each guest (see guest). Members' own ratings are used for
+        books they rated, unless exclude_rated drops those books. allowed is a bool mask
+        over the books that candidates are cut down to before they're scored
+        """
+        members = np.asarray(members, dtype=np.int64)
+        books = self.group_candidates(members, guests, allowed)
+        positions, predicted_books, predictions, means = _predict(
+            self.matrix,
+            members,
+            self.neighbours,
+            self.similarities,
+            self.new_ratings,
+            books,
+        )
+
+        # members' means where no neighbour rated a candidate, then predictions
+        ratings = np.repeat(means[:, np.newaxis], len(books), axis=1).astype(np.float32)
+        ratings[positions, np.searchsorted(books, predicted_books)] = predictions
+        owners, rated_books, values = _ratings(self.matrix, members, self.new_ratings)
+
+        guest_ratings = np.empty((len(guests), len(books)), dtype=np.float32)
+        for row, guest in zip(guest_ratings, guests):
+            row[:] = guest["mean"]
+            found = np.isin(books, guest["predicted"])
+            row[found] = guest["predictions"][
+                np.searchsorted(guest["predicted"], books[found])
+            ]
+        ratings = np.concatenate([ratings, guest_ratings])
+        owners = np.concatenate(
+            [owners]
+            + [
+                np.full(len(guest["books"]), len(members) + i)
+                for i, guest in enumerate(guests)
+            ]
+        ).astype(np.int64)
+        rated_books = np.concatenate(
+            [rated_books] + [guest["books"] for guest in guests]
+        )
+        values = np.concatenate([values] + [guest["ratings"] for guest in guests])
+
+        if exclude_rated:
+            keep = ~np.isin(books, rated_books)
+            return books[keep], ratings[:, keep]
+        rated = np.isin(rated_books, books)
+        ratings[owners[rated], np.searchsorted(books, rated_books[rated])] = values[
+            rated
+        ]
+        return books, ratings
+
+    def recommend(
+        self,
+        members,
+        method="copeland",
+        k=10,
+        exclude_rated=True,
+        guests=(),
+        allowed=None,
+    ) -> list:
+        """Top k books for a group of users (rating matrix indexes) and guests (see guest)
+        as [(asin, score), ...], from the books allowed by a bool mask if one is given
+        """
+        books, ratings = self.group_ratings(members, exclude_rated, guests, allowed)
+        if not len(books):
+            return []
+        top, scores = recommend(ratings, method, k)
+        return [
+            (self.matrix.asins[books[i]].decode("utf-8"), float(score))
+            for i, score in zip(top, scores)
+        ]
+
+    def affected_users(self, users) -> np.ndarray:
+        """Users whose predictions change when users rate books: the users who rated, and
+        the users with them as neighbours"""
+        users = np.asarray(users, dtype=np.int64)
+        return np.union1d(
+            users, np.flatnonzero(np.isin(self.neighbours, users).any(axis=1))
+        )
+
+    def add_ratings(self, users, books, ratings, n=None) -> int:
+        """Add new ratings of users' (rating matrix indexes) books, recomputing and saving
+        the lists of the users they affect, returning how many users that was"""
+        users = np.asarray(users, dtype=np.int64)
+        books = np.asarray(books, dtype=np.int32)
+        ratings = np.asarray(ratings, dtype=np.float32)
+        n = n or self.books.shape[1]
+        for user, book, rating in zip(users.tolist(), books.tolist(), ratings.tolist()):
+            self.new_ratings.setdefault(user, dict())[book] = rating
+
+        affected = self.affected_users(users)
+        positions, predicted_books, predictions, _ = _predict(
+            self.matrix, affected, self.neighbours, self.similarities, self.new_ratings
+        )
+        top_books, top_scores = _top_n(
+            positions, predicted_books, predictions, len(affected), n
+        )
+
+        update = {
+            "rating_users": users,
+            "rating_books": books,
+            "rating_values": ratings,
+            "users": affected,
+            "books": top_books,
+            "scores": top_scores,
+        }
+        buffer = io.BytesIO()
+        np.savez(buffer, **update)
+        key = f"{self.folder}/{UPDATES_FOLDER}/update_{self.n_updates}.npz"
+        self.storage.put(key, buffer.getvalue())
+        self.n_updates += 1
+        self._apply(**update)
+        return len(affected)
+
+
+def process_candidates(folder=CANDIDATES_FOLDER, n=TOP_N, skip_if_current=False):
+    """Build every user's candidate list, main function
+
+    skip_if_current=True skips the stage if the lists were built from the current rating
+    matrix.
+    """
+    storage = open_storage(S3_FOLDER)
+    inputs = {
+        "folder": folder,
+        "n": n,
+        "upstream": stage_record(storage, MATRIX_STAGE),
+    }
+    if skip_if_current and stage_is_current(storage, STAGE, inputs):
+        print("Candidates are already built, skipping")
+        return
+    start_stage(STAGE)
+
+    found = build_candidates(folder=folder, n=n)
+    print(f"\nBuilt candidate lists for {found} users\n")
+    count("users_with_candidates", found)
+    mark_stage_done(storage, STAGE, inputs)
+    end_stage()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query candidate lists")
+    parser.add_argument("--build", action="store_true")
+    parser.add_argument("--n", type=int, default=TOP_N)
+    parser.add_argument("--group", nargs="*", default=[], help="user ids of a group")
+    parser.add_argument("--method", default="copeland")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.build:
+        process_candidates(n=args.n)
+    if args.group:
+        store = CandidateStore()
+        members = [user_index(store.matrix, user_id) for user_id in args.group]
+        if min(members) < 0:
+            raise ValueError("Every member needs ratings in the rating matrix")
+        results = store.recommend(members, args.method, args.k)
+        print(json.dumps(results, indent=4))
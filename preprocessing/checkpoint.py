@@ -0,0 +1,80 @@
+import json
+import os
+import time
+
+"""
+Checkpoints for resumable preprocessing runs
+- A checkpoint manifest in temp_batches records how far the input was read (uncompressed offset,
+  and compressed offset for reference), total_processed and batch_count: batches 0 to
+  batch_count - 1 are on disk, and any later ones weren't checkpointed and are deleted on resume.
+  It is rewritten after every batch is saved, so it always describes the last durable batch.
+  With writes queued (see AsyncWriter in storage.py) it's only stored once its batches are stored
+- A stage record in stages/ is written once a stage's outputs are aggregated, with a fingerprint
+  of its inputs and parameters, so an unchanged stage can be skipped
+- Everything is read and written through a storage backend, with keys relative to its root
+"""
+
+CHECKPOINT_FILE = "checkpoint.json"
+STAGES_FOLDER = "stages"
+
+
+def _load_json(storage, key) -> dict:
+    """Load a JSON file from storage, None if it doesn't exist"""
+    if not storage.exists(key):
+        return None
+    return json.loads(storage.get(key))
+
+
+def input_fingerprint(path, **params) -> dict:
+    """Describe an input file and the parameters it's processed with"""
+    stat = os.stat(path)
+    return {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "params": params,
+    }
+
+
+def save_checkpoint(storage, temp_folder, stage, inputs, **progress):
+    """Record the progress of a stage after a batch has been saved (or queued to be)"""
+    checkpoint = {"stage": stage, "inputs": inputs, **progress}
+    storage.put_after(
+        f"{temp_folder}/{CHECKPOINT_FILE}", json.dumps(checkpoint).encode("utf-8")
+    )
+
+
+def load_checkpoint(storage, temp_folder, stage, inputs) -> dict:
+    """Load a stage's checkpoint, None if there isn't one for these inputs"""
+    checkpoint = _load_json(storage, f"{temp_folder}/{CHECKPOINT_FILE}")
+    if checkpoint is None:
+        return None
+    if checkpoint["stage"] != stage or checkpoint["inputs"] != inputs:
+        return None
+    return checkpoint
+
+
+def clear_partial_batches(storage, temp_folder, batch_count):
+    """Delete batches at or after batch_count from temp_folder, which weren't checkpointed"""
+    for key in storage.list(temp_folder):
+        filename = key.rsplit("/", 1)[-1]
+        if filename.startswith("batch_"):
+            if int(filename.split("_")[1].split(".")[0]) >= batch_count:
+                storage.delete(key)
+
+
+def stage_record(storage, stage) -> dict:
+    """Load the record of a completed stage, None if it hasn't completed"""
+    return _load_json(storage, f"{STAGES_FOLDER}/{stage}.json")
+
+
+def mark_stage_done(storage, stage, inputs):
+    """Record that a stage's outputs are complete for these inputs"""
+    record = {"stage": stage, "inputs": inputs, "finished": time.time()}
+    storage.put(f"{STAGES_FOLDER}/{stage}.json", json.dumps(record).encode("utf-8"))
+
+
+def stage_is_current(storage, stage, inputs) -> bool:
+    """Check if a stage has already completed with the same inputs"""
+    record = stage_record(storage, stage)
+    return record is not None and record["inputs"] == inputs
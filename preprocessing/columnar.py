@@ -0,0 +1,275 @@
+import json
+
+import numpy as np
+
+from runs import write_json_stream
+
+"""
+Columnar shard format
+- One compressed .npz per shard, one or more arrays per column, so readers only
+  decompress the columns they ask for
+- Strings are a uint8 byte buffer plus int64 offsets, lists are int64 list offsets
+  into a flat values column, every column has a bool "valid" mask for missing fields
+- Fields outside the schema (or that don't fit its type) go in a JSON "_extra" column,
+  so records read back exactly as they were written
+"""
+
+OUTPUT_FORMATS = ["json", "columnar"]
+
+# column types for each output, the id column is always "id"
+SCHEMAS = {
+    "works": {
+        "isbn_10": "str",
+        "isbn_13": "str",
+        "title": "str",
+        "number_of_pages": "int",
+        "publish_date": "str",
+        "subjects": "list[str]",
+        "genres": "list[str]",
+        "covers": "list[int]",
+    },
+    "amz_books": {
+        "isbn_10": "str",
+        "isbn_13": "str",
+        "num_ratings": "int",
+        "avg_rating": "float",
+        "genre": "str",
+        "num_pages": "int",
+        "publication_year": "int",
+    },
+    "reviews": {"asin": "list[str]", "rating": "list[float]"},
+    "work_ratings": {
+        "isbn_10": "str",
+        "isbn_13": "str",
+        "title": "str",
+        "number_of_pages": "int",
+        "publish_date": "str",
+        "subjects": "list[str]",
+        "genres": "list[str]",
+        "covers": "list[int]",
+        "asins": "list[str]",
+        "users": "list[str]",
+        "ratings": "list[float]",
+    },
+    "isbn_map": {"value": "str"},  # isbn -> work id
+    "id_lists": {"value": "list[str]"},  # work id -> edition ids, asin -> isbns
+}
+
+_TYPE_CHECKS = {
+    "str": lambda v: isinstance(v, str),
+    "int": lambda v: type(v) is int,
+    "float": lambda v: type(v) is float,
+    "list[str]": lambda v: isinstance(v, list) and all(isinstance(x, str) for x in v),
+    "list[int]": lambda v: isinstance(v, list) and all(type(x) is int for x in v),
+    "list[float]": lambda v: isinstance(v, list) and all(type(x) is float for x in v),
+}
+
+
+def _to_record(dataset, value) -> dict:
+    """Convert an output value to a flat record of schema fields"""
+    if dataset == "reviews":
+        # list of single key {asin: rating} dicts -> parallel lists
+        pairs = [pair for review in value for pair in review.items()]
+        return {
+            "asin": [asin for asin, _ in pairs],
+            "rating": [rating for _, rating in pairs],
+        }
+    if dataset in ["isbn_map", "id_lists"]:
+        return {"value": value}
+    return value
+
+
+def _from_record(dataset, record):
+    """Convert a record read back from columns to its original output value"""
+    if dataset == "reviews":
+        return [
+            {asin: rating}
+            for asin, rating in zip(record.get("asin", []), record.get("rating", []))
+        ]
+    if dataset in ["isbn_map", "id_lists"]:
+        return record.get("value")
+    return record
+
+
+def _encode_strings(strings) -> dict:
+    """Encode strings as a utf-8 byte buffer and offsets"""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    return {
+        "data": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        "offsets": offsets,
+    }
+
+
+def _decode_strings(data, offsets) -> list[str]:
+    """Decode a utf-8 byte buffer and offsets back to strings"""
+    buffer = data.tobytes()
+    offsets = offsets.tolist()
+    return [
+        buffer[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])
+    ]
+
+
+def _encode_column(name, kind, values) -> dict:
+    """Encode one column's values (None where missing) as named arrays"""
+    valid = np.array([value is not None for value in values], dtype=bool)
+    arrays = {f"{name}.valid": valid}
+
+    if kind.startswith("list"):
+        lists = [value if value is not None else [] for value in values]
+        list_offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in lists], out=list_offsets[1:])
+        arrays[f"{name}.list_offsets"] = list_offsets
+        values = [item for value in lists for item in value]
+        kind = kind[5:-1]
+    elif kind == "str":
+        values = [value if value is not None else "" for value in values]
+    else:
+        values = [value if value is not None else 0 for value in values]
+
+    if kind == "str":
+        for key, array in _encode_strings(values).items():
+            arrays[f"{name}.{key}"] = array
+    elif kind == "int":
+        arrays[f"{name}.values"] = np.array(values, dtype=np.int64)
+    else:
+        arrays[f"{name}.values"] = np.array(values, dtype=np.float64)
+
+    return arrays
+
+
+def _decode_column(npz, name, kind) -> list:
+    """Decode one column from a loaded .npz, None where missing"""
+    valid = npz[f"{name}.valid"].tolist()
+    base_kind = kind[5:-1] if kind.startswith("list") else kind
+
+    if base_kind == "str":
+        values = _decode_strings(npz[f"{name}.data"], npz[f"{name}.offsets"])
+    else:
+        values = npz[f"{name}.values"].tolist()
+
+    if kind.startswith("list"):
+        list_offsets = npz[f"{name}.list_offsets"].tolist()
+        values = [
+            values[start:end] for start, end in zip(list_offsets, list_offsets[1:])
+        ]
+
+    return [value if is_valid else None for value, is_valid in zip(values, valid)]
+
+
+def write_columns(storage, key, items, dataset) -> int:
+    """Write (id, value) pairs of one output as a columnar .npz file in storage, returning
+    its size in bytes"""
+    schema = SCHEMAS[dataset]
+    ids = []
+    columns = {name: [] for name in schema}
+    extras = []
+
+    # split each record into typed columns, anything that doesn't fit goes to extras
+    for item_id, value in items:
+        record = _to_record(dataset, value)
+        ids.append(item_id)
+        extra = dict()
+        for name, field in record.items():
+            if name not in schema or not _TYPE_CHECKS[schema[name]](field):
+                extra[name] = field
+        for name, kind in schema.items():
+            columns[name].append(None if name in extra else record.get(name))
+        extras.append(json.dumps(extra) if extra else None)
+
+    arrays = _encode_column("id", "str", ids)
+    for name, kind in schema.items():
+        arrays.update(_encode_column(name, kind, columns[name]))
+    arrays.update(_encode_column("_extra", "str", extras))
+
+    with storage.open_write(key) as f:
+        np.savez_compressed(f, **arrays)
+        return f.tell()
+
+
+def read_columns(storage, key, dataset, columns=None) -> dict[str, list]:
+    """Read the id column and the requested columns (all if None) of a columnar file"""
+    schema = SCHEMAS[dataset]
+    columns = schema.keys() if columns is None else columns
+    with storage.open(key) as f, np.load(f) as npz:
+        result = {"id": _decode_column(npz, "id", "str")}
+        for name in columns:
+            result[name] = _decode_column(npz, name, schema[name])
+        return result
+
+
+def read_records(storage, key, dataset, columns=None) -> dict:
+    """Read a columnar file back into {id: value}, projecting to columns if given
+
+    Fields kept in the "_extra" column are only returned when reading all columns.
+    """
+    project_all = columns is None
+    result = read_columns(storage, key, dataset, columns)
+    if project_all:
+        with storage.open(key) as f, np.load(f) as npz:
+            extras = _decode_column(npz, "_extra", "str")
+    else:
+        extras = [None] * len(result["id"])
+
+    records = dict()
+    for i, item_id in enumerate(result["id"]):
+        record = {
+            name: values[i]
+            for name, values in result.items()
+            if name != "id" and values[i] is not None
+        }
+        if extras[i]:
+            record.update(json.loads(extras[i]))
+        records[item_id] = _from_record(dataset, record)
+
+    return records
+
+
+def shard_path(path, output_format) -> str:
+    """Key of a shard saved without an extension, for the given output format"""
+    return f"{path}.npz" if output_format == "columnar" else f"{path}.json"
+
+
+def save_shard(storage, path, items, dataset, output_format="json") -> int:
+    """Save (id, value) pairs under path (no extension) in storage in the given output
+    format, returning the shard's size in bytes"""
+    if output_format == "columnar":
+        return write_columns(storage, shard_path(path, output_format), items, dataset)
+    elif output_format == "json":
+        return write_json_stream(storage, shard_path(path, output_format), items)
+    else:
+        raise ValueError(
+            f"Unknown output format {output_format}, use one of {OUTPUT_FORMATS}"
+        )
+
+
+def shard_exists(storage, path) -> bool:
+    """Check if a shard was saved by save_shard (path without extension) in either format"""
+    return any(storage.exists(shard_path(path, fmt)) for fmt in OUTPUT_FORMATS)
+
+
+def load_shard(storage, path, dataset, columns=None) -> dict:
+    """Load a shard saved by save_shard (path without extension) in whichever format exists
+
+    columns limits the fields read: for columnar shards only those columns are decompressed.
+    """
+    if storage.exists(shard_path(path, "columnar")):
+        return read_records(storage, shard_path(path, "columnar"), dataset, columns)
+
+    records = json.loads(storage.get(shard_path(path, "json")))
+    if columns is not None and dataset in ["works", "amz_books"]:
+        records = {
+            item_id: {name: value for name, value in record.items() if name in columns}
+            for item_id, record in records.items()
+        }
+    return records
+
+
+def load_ids(storage, path) -> list[str]:
+    """Load just the ids of a shard saved by save_shard (path without extension)"""
+    if storage.exists(shard_path(path, "columnar")):
+        with storage.open(shard_path(path, "columnar")) as f, np.load(f) as npz:
+            return _decode_column(npz, "id", "str")
+
+    return list(json.loads(storage.get(shard_path(path, "json"))).keys())
@@ -0,0 +1,468 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import ssl
+from collections import OrderedDict, defaultdict
+from urllib.parse import urljoin, urlsplit
+
+from tqdm import tqdm
+
+from columnar import load_shard
+from instrument import (
+    REPORTS_FOLDER,
+    count,
+    end_stage,
+    save_report,
+    start_run,
+    start_stage,
+    timer,
+)
+from ol_preproc import S3_FOLDER
+from sharding import shard_paths
+from storage import open_storage
+
+"""
+Fetching Open Library covers in bulk, into a local cache
+- Covers are requested from BASE_URL/b/id/<cover id>-<size>.jpg (see
+  https://openlibrary.org/dev/docs/api/covers). The base URL can be pointed at any server
+  that answers the same paths, e.g. a local stand-in for testing offline
+- Requests go over a small HTTP/1.1 client on asyncio streams that keeps connections open
+  and reuses them, at most CONNECTIONS per host. At most CONCURRENCY covers are fetched at
+  once, so bulk prefetches don't open a task per cover
+- Failed requests (connection errors, timeouts and RETRY_STATUSES) are retried up to RETRIES
+  times, waiting BACKOFF seconds doubled each time with jitter, or the server's Retry-After
+- The cache is content-addressed: each image is saved once under blobs/ by its sha256, and
+  index.json maps "<cover id>-<size>" to its image's hash (or null for covers Open Library
+  doesn't have, so they aren't requested again). Once the images pass max_bytes, the least
+  recently used ones are evicted, with every cover that points to them
+- prefetch_shards fetches the first cover of every work in a sharded folder (works or
+  work_ratings). Shards are read one at a time as the workers need more covers, all on one
+  event loop and client, and the index is saved every SAVE_EVERY shards
+"""
+
+BASE_URL = "https://covers.openlibrary.org"
+COVER_SIZE = "M"  # "S", "M" or "L"
+COVER_SIZES = ["S", "M", "L"]
+CACHE_FOLDER = "cover_cache"  # local folder, images are served from disk
+STAGE = "covers"
+INDEX_FILE = "index.json"
+CACHE_BYTES = 2**30  # bytes of images kept in the cache before the oldest are evicted
+EVICT_TO = 0.9  # fraction of the limit eviction frees the cache down to
+CONCURRENCY = 32  # covers fetched at once
+CONNECTIONS = 8  # open connections kept per host
+RETRIES = 4
+BACKOFF = 0.5  # seconds before the first retry, doubled for each one after
+TIMEOUT = 30  # seconds a request may take
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+USER_AGENT = "better-bookclub cover prefetch"
+SAVE_EVERY = 100  # shards read between saves of the index while prefetching shards
+
+
+class HTTPError(Exception):
+    """A response with a status that isn't retried or retries ran out on"""
+
+    def __init__(self, status, url):
+        super().__init__(f"HTTP {status} from {url}")
+        self.status = status
+
+
+class _Connection:
+    """An open HTTP/1.1 connection to one host"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def request(
+        self, method, host, path, body=None, content_type=None
+    ) -> tuple[int, dict, bytes, bool]:
+        """Send a request, returning the status, headers, body and whether the connection
+        can be reused"""
+        head = (
+            f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: {USER_AGENT}\r\n"
+            "Connection: keep-alive\r\n"
+        )
+        if body is not None:
+            head += f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+        self.writer.write((head + "\r\n").encode("latin-1") + (body or b""))
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed before a response")
+        version, status = status_line.decode("latin-1").split(None, 2)[:2]
+        headers = dict()
+        while True:
+            line = await self.reader.readline()
+            if line in [b"\r\n", b"\n", b""]:
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self._read_chunked()
+        elif "content-length" in headers:
+            body = await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await self.reader.read()
+            return int(status), headers, body, False
+
+        keep_alive = headers.get("connection", "").lower() != "close"
+        return int(status), headers, body, keep_alive and version == "HTTP/1.1"
+
+    async def _read_chunked(self) -> bytes:
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # trailers, up to the blank line
+                while (await self.reader.readline()) not in [b"\r\n", b"\n", b""]:
+                    pass
+                return b"".join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+    def close(self):
+        self.writer.close()
+
+
+class HTTPClient:
+    """HTTP requests over pooled keep-alive connections, at most connections per host"""
+
+    def __init__(self, connections=CONNECTIONS, timeout=TIMEOUT):
+        self.connections = connections
+        self.timeout = timeout
+        self.idle = defaultdict(list)  # (scheme, host, port) -> idle connections
+        self.slots = dict()  # (scheme, host, port) -> semaphore of connections
+        self.ssl_context = ssl.create_default_context()
+
+    async def _connect(self, scheme, host, port) -> _Connection:
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self.ssl_context if scheme == "https" else None
+        )
+        return _Connection(reader, writer)
+
+    async def get(self, url) -> tuple[int, dict, bytes]:
+        """GET url, returning the status, headers and body"""
+        return await self.request("GET", url)
+
+    async def request(
+        self, method, url, data=None, content_type="application/json"
+    ) -> tuple[int, dict, bytes]:
+        """Send a request with an optional body (data), returning the status, headers and
+        body"""
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        host_key = (parts.scheme, parts.hostname, port)
+        host = parts.netloc
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        if host_key not in self.slots:
+            self.slots[host_key] = asyncio.Semaphore(self.connections)
+
+        async with self.slots[host_key]:
+            idle = self.idle[host_key]
+            while True:
+                reused = bool(idle)
+                connection = idle.pop() if reused else await self._connect(*host_key)
+                try:
+                    status, headers, body, keep_alive = await asyncio.wait_for(
+                        connection.request(method, host, path, data, content_type),
+                        self.timeout,
+                    )
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                    connection.close()
+                    # the server may have closed an idle connection, try the next one
+                    if not reused:
+                        raise
+                except BaseException:
+                    connection.close()
+                    raise
+
+            if keep_alive:
+                idle.append(connection)
+            else:
+                connection.close()
+        return status, headers, body
+
+    def close(self):
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+        self.idle.clear()
+
+
+class CoverCache:
+    """Content-addressed cache of cover images in a local folder, evicting the least recently
+    used images once they pass max_bytes"""
+
+    def __init__(self, folder=CACHE_FOLDER, max_bytes=CACHE_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        # "<cover id>-<size>" -> sha256 of its image, None if the cover is missing
+        self.covers = dict()
+        self.blobs = OrderedDict()  # sha256 -> bytes, least recently used first
+        self.keys = defaultdict(set)  # sha256 -> covers with that image
+        self.total_bytes = 0
+
+        index_path = os.path.join(folder, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            for digest, n_bytes in index["blobs"]:
+                if os.path.exists(self._blob_path(digest)):
+                    self.blobs[digest] = n_bytes
+                    self.total_bytes += n_bytes
+            for key, digest in index["covers"].items():
+                if digest is None or digest in self.blobs:
+                    self._set(key, digest)
+
+    def _blob_path(self, digest) -> str:
+        return os.path.join(self.folder, "blobs", digest[:2], digest)
+
+    def _set(self, key, digest):
+        self.covers[key] = digest
+        if digest is not None:
+            self.keys[digest].add(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self.covers
+
+    def path(self, key) -> str:
+        """Path of a cached cover's image, None if it's missing or not cached"""
+        digest = self.covers.get(key)
+        if digest is None:
+            return None
+        self.blobs.move_to_end(digest)
+        return self._blob_path(digest)
+
+    def get(self, key) -> bytes:
+        """A cached cover's image, None if it's missing or not cached"""
+        path = self.path(key)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put(self, key, data):
+        """Cache a cover's image, None for a cover that doesn't exist"""
+        if data is None:
+            self._set(key, None)
+            return
+
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.blobs:
+            path = self._blob_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+            self.blobs[digest] = len(data)
+            self.total_bytes += len(data)
+            count("cover_bytes_cached", len(data))
+        self.blobs.move_to_end(digest)
+        self._set(key, digest)
+        if self.total_bytes > self.max_bytes:
+            self.evict(int(self.max_bytes * EVICT_TO))
+
+    def evict(self, target_bytes):
+        """Delete least recently used images until the cache holds at most target_bytes"""
+        while self.total_bytes > target_bytes and self.blobs:
+            digest, n_bytes = self.blobs.popitem(last=False)
+            os.remove(self._blob_path(digest))
+            self.total_bytes -= n_bytes
+            for key in self.keys.pop(digest, ()):
+                del self.covers[key]
+            count("covers_evicted")
+
+    def save(self):
+        """Save the index, so the cache can be reopened"""
+        os.makedirs(self.folder, exist_ok=True)
+        index = {"covers": self.covers, "blobs": list(self.blobs.items())}
+        index_path = os.path.join(self.folder, INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+def cover_key(cover_id, size=COVER_SIZE) -> str:
+    return f"{cover_id}-{size}"
+
+
+def cover_url(cover_id, size=COVER_SIZE, base_url=BASE_URL) -> str:
+    """URL of a cover image, ?default=false makes missing covers 404 instead of a blank"""
+    return f"{base_url.rstrip('/')}/b/id/{cover_id}-{size}.jpg?default=false"
+
+
+def _retry_delay(attempt, headers, backoff) -> float:
+    """Seconds to wait before retry number attempt (from 0)"""
+    retry_after = headers.get("retry-after", "")
+    if retry_after.isdigit():
+        return float(retry_after)
+    return backoff * 2**attempt * (1 + random.random())
+
+
+async def fetch_url(client, url, retries=RETRIES, backoff=BACKOFF) -> bytes:
+    """GET url following redirects and retrying failures, None if it's not found"""
+    for attempt in range(retries + 1):
+        headers = dict()
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                status, headers, body = await client.get(url)
+                if status not in REDIRECT_STATUSES:
+                    break
+                if "location" not in headers:
+                    raise HTTPError(status, url)  # a redirect to nowhere
+                url = urljoin(url, headers["location"])
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            status = None
+            count("cover_connection_errors")
+
+        if status == 200:
+            return body
+        if status == 404:
+            return None
+        if status is not None and status not in RETRY_STATUSES:
+            raise HTTPError(status, url)
+        if attempt < retries:
+            count("cover_retries")
+            await asyncio.sleep(_retry_delay(attempt, headers, backoff))
+    if status is None:
+        raise ConnectionError(f"Couldn't connect to fetch {url}")
+    raise HTTPError(status, url)
+
+
+async def fetch_covers(
+    cover_ids,
+    cache,
+    size=COVER_SIZE,
+    base_url=BASE_URL,
+    concurrency=CONCURRENCY,
+    connections=CONNECTIONS,
+    retries=RETRIES,
+    backoff=BACKOFF,
+    progress=None,
+):
+    """Fetch every cover not in the cache into it, with at most concurrency requests at a
+    time. Covers that fail after retrying are counted and skipped
+
+    cover_ids is read as the requests need more, so it can be a generator.
+    """
+    if size not in COVER_SIZES:
+        raise ValueError(f"Unknown cover size {size}, use one of {COVER_SIZES}")
+    pending = iter(cover_ids)
+    client = HTTPClient(connections)
+
+    async def worker():
+        for cover_id in pending:
+            key = cover_key(cover_id, size)
+            if key in cache:
+                count("covers_cached")
+            else:
+                url = cover_url(cover_id, size, base_url)
+                try:
+                    data = await fetch_url(client, url, retries, backoff)
+                except (HTTPError, ConnectionError):
+                    count("cover_errors")
+                else:
+                    cache.put(key, data)
+                    count("covers_fetched" if data is not None else "covers_missing")
+            if progress is not None:
+                progress.update()
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        client.close()
+
+
+def prefetch_covers(
+    cover_ids, cache_folder=CACHE_FOLDER, max_bytes=CACHE_BYTES, **kwargs
+):
+    """Fetch covers into the cache in cache_folder, see fetch_covers for the options"""
+    cache = CoverCache(cache_folder, max_bytes)
+    try:
+        asyncio.run(fetch_covers(cover_ids, cache, **kwargs))
+    finally:
+        cache.save()
+    return cache
+
+
+def work_covers(storage, path, dataset="works") -> list[int]:
+    """First cover id of each work in a shard that has one"""
+    works = load_shard(storage, path, dataset, columns=["covers"])
+    return [work["covers"][0] for work in works.values() if work.get("covers")]
+
+
+def _shard_covers(storage, paths, dataset, cache, progress):
+    """Yield the first cover id of every work in the shards, a shard at a time, saving the
+    cache's index every SAVE_EVERY shards so a run stopped partway keeps what it fetched
+    """
+    for i, path in enumerate(paths):
+        cover_ids = work_covers(storage, path, dataset)
+        count("works_with_covers", len(cover_ids))
+        yield from cover_ids
+        progress.update()
+        if (i + 1) % SAVE_EVERY == 0:
+            cache.save()
+
+
+def prefetch_shards(
+    location=S3_FOLDER,
+    folder="works",
+    dataset="works",
+    cache_folder=CACHE_FOLDER,
+    max_bytes=CACHE_BYTES,
+    **kwargs,
+):
+    """Fetch the first cover of every work in a sharded folder into the cache, see
+    fetch_covers for the options"""
+    storage = open_storage(location)
+    cache = CoverCache(cache_folder, max_bytes)
+    paths = shard_paths(storage, folder)
+    start_stage(STAGE)
+    try:
+        with tqdm(total=len(paths), desc="Fetching covers") as progress:
+            cover_ids = _shard_covers(storage, paths, dataset, cache, progress)
+            with timer("fetch"):
+                asyncio.run(fetch_covers(cover_ids, cache, **kwargs))
+    finally:
+        cache.save()
+        end_stage()
+    return cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prefetch Open Library covers of works"
+    )
+    parser.add_argument("--location", default=S3_FOLDER)
+    parser.add_argument("--folder", default="works", choices=["works", "work_ratings"])
+    parser.add_argument("--size", default=COVER_SIZE, choices=COVER_SIZES)
+    parser.add_argument("--cache", default=CACHE_FOLDER)
+    parser.add_argument("--cache-bytes", type=int, default=CACHE_BYTES)
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--connections", type=int, default=CONNECTIONS)
+    args = parser.parse_args()
+
+    start_run()
+    cache = prefetch_shards(
+        args.location,
+        args.folder,
+        args.folder,
+        args.cache,
+        args.cache_bytes,
+        size=args.size,
+        base_url=args.base_url,
+        concurrency=args.concurrency,
+        connections=args.connections,
+    )
+    print(f"Cached {len(cache.covers)} covers in {cache.total_bytes} bytes of images")
+    report_key = save_report(open_storage(args.location), REPORTS_FOLDER)
+    print(f"Saved run report to {args.location}/{report_key}")
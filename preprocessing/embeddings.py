@@ -0,0 +1,465 @@
+import argparse
+import csv
+import gzip
+import json
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from tqdm import tqdm
+
+from amz_preproc import BOOK_STAGE, S3_FOLDER
+from checkpoint import (
+    input_fingerprint,
+    mark_stage_done,
+    stage_is_current,
+    stage_record,
+)
+from columnar import load_ids
+from instrument import count, end_stage, start_stage, timer
+from sharding import shard_paths
+from storage import open_storage
+
+"""
+Description embeddings of Amazon books, for similarity search (e.g. for cold-start books)
+- Vectors are read from a .csv or .jsonl file (optionally gzipped) with an ASIN column and an
+  embedding column, as a JSON list or a string of numbers
+- Row i of vectors.npy is the book at position i of asins.npy, the sorted ASINs of the
+  Amazon books shards, and present.npy marks the books that have a vector. Vectors are
+  L2-normalized, so dot products are cosine similarities, and stored as float16 (or
+  float32), then memory-mapped
+- Exact search multiplies batches of queries by blocks of rows, keeping a running top k,
+  so only one block is in memory at a time
+- The optional IVF index clusters vectors with spherical k-means. A query scores the
+  int8-quantized vectors of its n_probe nearest clusters, then rescores the best
+  candidates exactly
+"""
+
+EMBEDDINGS_PATH = "data/amazon/description_embeddings.csv"
+EMBEDDINGS_FOLDER = "embeddings"
+IVF_FOLDER = "ivf"  # inside EMBEDDINGS_FOLDER
+STAGE = "embeddings"  # name of this stage's stage record
+ID_FIELD = "parent_asin"
+VECTOR_FIELD = "embedding"
+DTYPE = "float16"  # "float16" or "float32"
+READ_BATCH = 10000  # vectors written to the matrix at once while building
+BLOCK_BYTES = 2**27  # most bytes of float32 rows scored at once
+QUERY_BLOCK = 1024  # most queries scored at once
+N_PROBE = 8  # IVF clusters searched per query
+RERANK = 4  # IVF candidates rescored exactly, as a multiple of k
+KMEANS_SAMPLE = 100000  # vectors the IVF clusters are trained on
+KMEANS_ITERATIONS = 10
+
+
+def _parse_vector(value) -> np.ndarray:
+    """An embedding from a JSON list or a string of numbers"""
+    if isinstance(value, str):
+        value = value.strip("[] \n").replace(",", " ").split()
+    return np.array(value, dtype=np.float32)
+
+
+def _read_embeddings(path, id_field, vector_field):
+    """Yield (asin, vector) for every row of an embeddings file"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        if ".csv" in path:
+            csv.field_size_limit(sys.maxsize)
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f)
+        for row in rows:
+            yield row[id_field], _parse_vector(row[vector_field])
+
+
+def _encode_ids(ids) -> np.ndarray:
+    """Encode ids as a fixed-width bytes array"""
+    return np.array([item_id.encode("utf-8") for item_id in ids], dtype=bytes)
+
+
+def _save_array(storage, key, values):
+    """Save an array as a .npy file in storage"""
+    with storage.open_write(key) as f:
+        np.save(f, values)
+
+
+def _save_file(storage, key, path):
+    """Copy a local file (e.g. a memory-mapped .npy built on disk) to storage"""
+    with open(path, "rb") as source, storage.open_write(key) as f:
+        shutil.copyfileobj(source, f, 2**24)
+
+
+def _normalize(vectors) -> np.ndarray:
+    """L2-normalize rows, leaving zero rows as they are"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def build_embeddings(
+    storage,
+    path,
+    folder=EMBEDDINGS_FOLDER,
+    dtype=DTYPE,
+    id_field=ID_FIELD,
+    vector_field=VECTOR_FIELD,
+) -> tuple[int, int]:
+    """Save the vectors of the Amazon books in an embeddings file, aligned with the books'
+    ASINs, returning (books, books with vectors)"""
+    asins = []
+    for shard in shard_paths(storage, "amz_books"):
+        asins += load_ids(storage, shard)
+    asins = np.sort(_encode_ids(asins))
+    present = np.zeros(len(asins), dtype=bool)
+    rows = _read_embeddings(path, id_field, vector_field)
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        vectors = None
+        batch_ids, batch_vectors = [], []
+        for asin, vector in tqdm(rows, desc="Reading embeddings"):
+            batch_ids.append(asin)
+            batch_vectors.append(vector)
+            if len(batch_ids) < READ_BATCH:
+                continue
+            vectors = _write_batch(
+                vectors, temp_folder, asins, present, batch_ids, batch_vectors, dtype
+            )
+            batch_ids, batch_vectors = [], []
+        vectors = _write_batch(
+            vectors, temp_folder, asins, present, batch_ids, batch_vectors, dtype
+        )
+        if vectors is None:
+            raise ValueError(f"No embeddings for any Amazon book in {path}")
+
+        vectors.flush()
+        dim = vectors.shape[1]
+        del vectors
+        _save_file(storage, f"{folder}/vectors.npy", f"{temp_folder}/vectors.npy")
+
+    _save_array(storage, f"{folder}/asins.npy", asins)
+    _save_array(storage, f"{folder}/present.npy", present)
+    meta = {
+        "dim": dim,
+        "dtype": dtype,
+        "books": len(asins),
+        "present": int(present.sum()),
+    }
+    storage.put(f"{folder}/meta.json", json.dumps(meta).encode("utf-8"))
+    return len(asins), int(present.sum())
+
+
+def _write_batch(vectors, temp_folder, asins, present, ids, batch, dtype):
+    """Write a batch of vectors to the rows of their ASINs, creating the memory-mapped matrix
+    on the first batch. Vectors of books that aren't in the Amazon books are skipped"""
+    if not ids:
+        return vectors
+    if not len(asins):
+        count("vectors_without_book", len(ids))
+        return vectors
+    if vectors is None:
+        vectors = np.lib.format.open_memmap(
+            f"{temp_folder}/vectors.npy", "w+", dtype, (len(asins), len(batch[0]))
+        )
+
+    keys = _encode_ids(ids)
+    rows = np.minimum(np.searchsorted(asins, keys), len(asins) - 1)
+    found = asins[rows] == keys
+    count("vectors_without_book", int((~found).sum()))
+    count("duplicate_vectors", int(present[rows[found]].sum()))
+    vectors[rows[found]] = _normalize(np.stack(batch)[found])
+    present[rows[found]] = True
+    return vectors
+
+
+def _top_k(scores, k) -> tuple[np.ndarray, np.ndarray]:
+    """(column indexes, scores) of the k highest scores in each row, in no order"""
+    if scores.shape[1] <= k:
+        columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        return columns, scores
+    columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return columns, np.take_along_axis(scores, columns, axis=1)
+
+
+def _sorted_top(rows, scores) -> tuple[np.ndarray, np.ndarray]:
+    """Sort each query's top k best first, with row -1 where fewer were found"""
+    order = np.argsort(-scores, axis=1, kind="stable")
+    rows = np.take_along_axis(rows, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    rows[np.isneginf(scores)] = -1
+    return rows, scores
+
+
+def _no_results(k) -> tuple[np.ndarray, np.ndarray]:
+    """The (rows, scores) of a search with no queries"""
+    return np.empty((0, k), dtype=np.int64), np.empty((0, k), dtype=np.float32)
+
+
+class EmbeddingStore:
+    """Memory-mapped book vectors with exact and IVF top-k search by cosine similarity"""
+
+    def __init__(self, location=S3_FOLDER, folder=EMBEDDINGS_FOLDER):
+        self.storage = open_storage(location)
+        self.folder = folder
+        self.meta = json.loads(self.storage.get(f"{folder}/meta.json"))
+        self.asins = self._load("asins")
+        self.present = self._load("present")
+        self.vectors = self._load("vectors")
+        self.block_rows = max(1, BLOCK_BYTES // (4 * self.meta["dim"]))
+        self.ivf = None
+        if self.storage.exists(f"{folder}/{IVF_FOLDER}/meta.json"):
+            self.ivf = {
+                name: self._load(f"{IVF_FOLDER}/{name}")
+                for name in ["centroids", "list_indptr", "list_rows", "codes", "scales"]
+            }
+
+    def _load(self, name) -> np.ndarray:
+        """Memory-map one of the store's arrays"""
+        key = f"{self.folder}/{name}.npy"
+        return np.load(self.storage.local_path(key), mmap_mode="r")
+
+    def rows(self, asins) -> np.ndarray:
+        """Row of each ASIN, -1 for books without a vector"""
+        keys = _encode_ids(asins)
+        if not len(self.asins):
+            return np.full(len(keys), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.asins, keys), len(self.asins) - 1)
+        found = (self.asins[rows] == keys) & self.present[rows]
+        return np.where(found, rows, -1)
+
+    def search(self, queries, k=10, exclude=None) -> tuple[np.ndarray, np.ndarray]:
+        """Exact top k rows for each query vector (queries x dim), returning (rows, scores)
+        arrays of shape queries x k, best first. exclude is a row per query to leave out
+        (e.g. the query's own book), -1 for none"""
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if not len(queries):
+            return _no_results(k)
+        if exclude is None:
+            exclude = np.full(len(queries), -1)
+        results = [
+            self._search_block(
+                queries[q : q + QUERY_BLOCK], k, exclude[q : q + QUERY_BLOCK]
+            )
+            for q in range(0, len(queries), QUERY_BLOCK)
+        ]
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+    def _search_block(self, queries, k, exclude) -> tuple[np.ndarray, np.ndarray]:
+        """Exact search for a block of queries, one block of rows at a time"""
+        best_rows = np.full((len(queries), 0), -1, dtype=np.int64)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        for start in range(0, len(self.asins), self.block_rows):
+            end = min(start + self.block_rows, len(self.asins))
+            block = np.asarray(self.vectors[start:end], dtype=np.float32)
+            scores = queries @ block.T
+            scores[:, ~self.present[start:end]] = -np.inf
+            excluded = np.flatnonzero((exclude >= start) & (exclude < end))
+            scores[excluded, exclude[excluded] - start] = -np.inf
+
+            # the block's top k, then the top k of those and the best so far
+            columns, scores = _top_k(scores, k)
+            best_rows = np.concatenate([best_rows, columns + start], axis=1)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            columns, best_scores = _top_k(best_scores, k)
+            best_rows = np.take_along_axis(best_rows, columns, axis=1)
+        return _sorted_top(best_rows, best_scores)
+
+    def search_ivf(
+        self, queries, k=10, exclude=None, n_probe=N_PROBE, rerank=RERANK
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Approximate top k with the IVF index, same arguments and results as search"""
+        if self.ivf is None:
+            raise ValueError("No IVF index, build one with build_ivf")
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if not len(queries):
+            return _no_results(k)
+        if exclude is None:
+            exclude = np.full(len(queries), -1)
+        indptr = self.ivf["list_indptr"]
+        n_probe = min(n_probe, len(indptr) - 1)
+
+        # nearest clusters of every query at once, then each query's candidates
+        centroid_scores = queries @ np.asarray(self.ivf["centroids"]).T
+        probes = np.argpartition(-centroid_scores, n_probe - 1, axis=1)[:, :n_probe]
+        all_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, query in enumerate(queries):
+            positions = np.concatenate(
+                [np.arange(indptr[p], indptr[p + 1]) for p in probes[q]]
+            )
+            codes = np.asarray(self.ivf["codes"][positions], dtype=np.float32)
+            approximate = (codes * self.ivf["scales"]) @ query
+            rows = np.asarray(self.ivf["list_rows"][positions])
+            approximate[rows == exclude[q]] = -np.inf
+
+            # rescore the best candidates with their stored vectors
+            n_candidates = min(k * rerank, len(rows))
+            if n_candidates == 0:
+                continue
+            best = np.argpartition(-approximate, n_candidates - 1)[:n_candidates]
+            best = best[~np.isneginf(approximate[best])]
+            candidates = np.sort(rows[best])
+            scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+            top = np.argsort(-scores, kind="stable")[:k]
+            all_rows[q, : len(top)] = candidates[top]
+            all_scores[q, : len(top)] = scores[top]
+        return _sorted_top(all_rows, all_scores)
+
+    def similar(self, asins, k=10, approximate=False) -> dict:
+        """Most similar books to a batch of books, {asin: [(asin, similarity), ...]} for the
+        books that have vectors"""
+        asins = list(asins)
+        rows = self.rows(asins)
+        found = np.flatnonzero(rows >= 0)
+        if not len(found):
+            return dict()
+        queries = np.asarray(self.vectors[rows[found]], dtype=np.float32)
+        search = self.search_ivf if approximate else self.search
+        top_rows, top_scores = search(queries, k, exclude=rows[found])
+
+        results = dict()
+        for i, q in enumerate(found):
+            valid = top_rows[i] >= 0
+            results[asins[q]] = [
+                (self.asins[row].decode("utf-8"), float(score))
+                for row, score in zip(top_rows[i][valid], top_scores[i][valid])
+            ]
+        return results
+
+
+def _assign(vectors, centroids, block_rows) -> np.ndarray:
+    """Index of the most similar centroid for each vector, in blocks of rows"""
+    clusters = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_rows):
+        block = np.asarray(vectors[start : start + block_rows], dtype=np.float32)
+        clusters[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return clusters
+
+
+def build_ivf(
+    store,
+    n_lists=None,
+    sample=KMEANS_SAMPLE,
+    iterations=KMEANS_ITERATIONS,
+    seed=0,
+) -> int:
+    """Cluster a store's vectors with spherical k-means and save an IVF index of int8
+    codes in cluster order, returning the number of clusters"""
+    rng = np.random.default_rng(seed)
+    present_rows = np.flatnonzero(store.present)
+    n_lists = n_lists or max(1, int(4 * np.sqrt(len(present_rows))))
+    n_lists = min(n_lists, len(present_rows))
+
+    # train on a sample, re-seeding clusters that end up empty with random vectors
+    sample_rows = np.sort(
+        rng.choice(present_rows, min(sample, len(present_rows)), replace=False)
+    )
+    train = np.asarray(store.vectors[sample_rows], dtype=np.float32)
+    centroids = train[rng.choice(len(train), n_lists, replace=False)]
+    for _ in tqdm(range(iterations), desc="Clustering"):
+        clusters = _assign(train, centroids, store.block_rows)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, clusters, train)
+        empty = np.flatnonzero(~sums.any(axis=1))
+        sums[empty] = train[rng.choice(len(train), len(empty))]
+        centroids = _normalize(sums)
+
+    # every vector's cluster, then rows grouped by cluster
+    clusters = np.empty(len(present_rows), dtype=np.int32)
+    for start in range(0, len(present_rows), store.block_rows):
+        block_rows = present_rows[start : start + store.block_rows]
+        block = np.asarray(store.vectors[block_rows], dtype=np.float32)
+        clusters[start : start + len(block)] = _assign(block, centroids, len(block))
+    order = np.argsort(clusters, kind="stable")
+    list_rows = present_rows[order]
+    list_indptr = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(clusters, minlength=n_lists), out=list_indptr[1:])
+
+    # int8 codes with a scale per dimension, written in cluster order
+    scales = np.abs(train).max(axis=0) / 127
+    scales[scales == 0] = 1
+    folder = f"{store.folder}/{IVF_FOLDER}"
+    with tempfile.TemporaryDirectory() as temp_folder:
+        codes = np.lib.format.open_memmap(
+            f"{temp_folder}/codes.npy", "w+", np.int8, (len(list_rows), train.shape[1])
+        )
+        for start in range(0, len(list_rows), store.block_rows):
+            rows = list_rows[start : start + store.block_rows]
+            block = np.asarray(store.vectors[np.sort(rows)], dtype=np.float32)
+            block = block[np.argsort(np.argsort(rows))]  # back to cluster order
+            codes[start : start + len(rows)] = np.clip(
+                np.round(block / scales), -127, 127
+            )
+        codes.flush()
+        del codes
+        _save_file(store.storage, f"{folder}/codes.npy", f"{temp_folder}/codes.npy")
+
+    _save_array(store.storage, f"{folder}/centroids.npy", centroids)
+    _save_array(store.storage, f"{folder}/list_indptr.npy", list_indptr)
+    _save_array(store.storage, f"{folder}/list_rows.npy", list_rows)
+    _save_array(store.storage, f"{folder}/scales.npy", scales.astype(np.float32))
+    meta = {"lists": n_lists, "sample": len(train), "iterations": iterations}
+    store.storage.put(f"{folder}/meta.json", json.dumps(meta).encode("utf-8"))
+    return n_lists
+
+
+def process_embeddings(
+    path=EMBEDDINGS_PATH,
+    folder=EMBEDDINGS_FOLDER,
+    dtype=DTYPE,
+    n_lists=0,
+    skip_if_current=False,
+):
+    """Build the embedding store (and an IVF index with n_lists clusters, None for the
+    default number, 0 for no index) from an embeddings file, main function
+
+    skip_if_current=True skips the stage if the store was built from the current file and
+    books.
+    """
+    storage = open_storage(S3_FOLDER)
+    inputs = input_fingerprint(
+        path,
+        folder=folder,
+        dtype=dtype,
+        n_lists=n_lists,
+        upstream=stage_record(storage, BOOK_STAGE),
+    )
+    if skip_if_current and stage_is_current(storage, STAGE, inputs):
+        print("Embeddings are already built, skipping")
+        return
+    start_stage(STAGE)
+
+    with timer("build"):
+        n_books, n_present = build_embeddings(storage, path, folder, dtype)
+    print(f"\nSaved vectors for {n_present} of {n_books} books\n")
+    count("books", n_books)
+    count("vectors", n_present)
+    if n_lists != 0:
+        with timer("ivf"):
+            n_lists = build_ivf(EmbeddingStore(S3_FOLDER, folder), n_lists)
+        print(f"Built an IVF index with {n_lists} clusters\n")
+    mark_stage_done(storage, STAGE, inputs)
+    end_stage()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or search book embeddings")
+    parser.add_argument("--build", metavar="PATH", help="embeddings file to build from")
+    parser.add_argument("--dtype", default=DTYPE, choices=["float16", "float32"])
+    parser.add_argument(
+        "--ivf",
+        type=int,
+        nargs="?",
+        const=None,
+        default=0,
+        help="build an IVF index, with this many clusters or the default number",
+    )
+    parser.add_argument("--similar", nargs="*", default=[], help="ASINs to search for")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--approximate", action="store_true")
+    args = parser.parse_args()
+
+    if args.build:
+        process_embeddings(args.build, dtype=args.dtype, n_lists=args.ivf)
+    if args.similar:
+        store = EmbeddingStore()
+        results = store.similar(args.similar, args.k, args.approximate)
+        print(json.dumps(results, indent=4))
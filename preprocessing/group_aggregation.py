@@ -0,0 +1,165 @@
+import argparse
+import time
+
+import numpy as np
+
+"""
+Group recommendation by aggregating members' predicted ratings
+- Ratings are a members x candidates array for one group, or a groups x members x candidates
+  array for a batch of groups. Groups smaller than the batch's largest are padded with rows
+  of NaN (see pad_groups), and padded members are ignored by every method
+- average, least_misery and most_pleasure take the mean, min or max of members' ratings
+- borda gives each candidate a point per candidate a member rates it above (half a point
+  for ties) and sums members' points
+- copeland compares every pair of candidates: a candidate beats another if more members
+  prefer it, and scores its wins minus its losses. Comparisons are broadcast over blocks
+  of groups and candidates, so memory stays under COMPARISON_BLOCK elements per block.
+  When ratings take only a few distinct values, every member's comparisons for a block are
+  one matrix product, which is several times faster than comparing member by member
+"""
+
+METHODS = ["average", "least_misery", "most_pleasure", "borda", "copeland"]
+COMPARISON_BLOCK = 2**25  # most pairwise comparisons held in memory at once
+MAX_LEVELS = 64  # most distinct ratings for copeland to compare by matrix product
+
+
+def pad_groups(group_ratings) -> np.ndarray:
+    """Stack members x candidates arrays of groups of different sizes into one
+    groups x members x candidates array, padding smaller groups with NaN rows"""
+    n_members = max(len(ratings) for ratings in group_ratings)
+    n_candidates = group_ratings[0].shape[1]
+    padded = np.full(
+        (len(group_ratings), n_members, n_candidates), np.nan, dtype=np.float32
+    )
+    for i, ratings in enumerate(group_ratings):
+        padded[i, : len(ratings)] = ratings
+    return padded
+
+
+def _tied_ranks(ratings) -> np.ndarray:
+    """0-based rank of each rating within its row (last axis), ties get their average rank"""
+    n = ratings.shape[-1]
+    order = np.argsort(ratings, axis=-1, kind="stable")
+    ordered = np.take_along_axis(ratings, order, axis=-1)
+    positions = np.broadcast_to(np.arange(n, dtype=np.float32), ordered.shape)
+
+    # first and last position of each run of equal ratings
+    starts = np.ones(ordered.shape, dtype=bool)
+    starts[..., 1:] = ordered[..., 1:] != ordered[..., :-1]
+    ends = np.ones(ordered.shape, dtype=bool)
+    ends[..., :-1] = starts[..., 1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=-1)
+    last = np.flip(
+        np.minimum.accumulate(np.flip(np.where(ends, positions, n - 1), -1), axis=-1),
+        -1,
+    )
+
+    ranks = np.empty(ordered.shape, dtype=np.float32)
+    np.put_along_axis(ranks, order, (first + last) / 2, axis=-1)
+    return ranks
+
+
+def borda_scores(ratings) -> np.ndarray:
+    """Sum of members' Borda points for each candidate"""
+    points = _tied_ranks(ratings)
+    valid = ~np.isnan(ratings).all(axis=-1, keepdims=True)
+    return np.where(valid, points, 0).sum(axis=-2)
+
+
+def _level_preferences(groups, levels) -> tuple[np.ndarray, np.ndarray]:
+    """(one-hot levels, preference signs) for groups whose ratings take a few levels, with
+    net[a, b] = one_hot[a] @ signs[b] the net number of members preferring a over b"""
+    index = np.searchsorted(levels, groups).astype(np.int16)
+    index[np.isnan(groups)] = len(levels)  # padded members match no level
+    index = index[:, :, np.newaxis, :]
+    level = np.arange(len(levels), dtype=np.int16).reshape(1, 1, -1, 1)
+
+    # member m rating candidate b below, at or above level l, flattened to (m, l) rows
+    shape = (len(groups), -1, groups.shape[-1])
+    one_hot = (index == level).astype(np.float32).reshape(shape)
+    signs = (index < level).astype(np.float32) - (index > level).astype(np.float32)
+    return np.ascontiguousarray(one_hot.transpose(0, 2, 1)), signs.reshape(shape)
+
+
+def copeland_scores(ratings, block=COMPARISON_BLOCK) -> np.ndarray:
+    """Copeland score (pairwise wins minus losses) for each candidate"""
+    batch = ratings[np.newaxis] if ratings.ndim == 2 else ratings
+    n_groups, n_members, n_candidates = batch.shape
+    scores = np.zeros((n_groups, n_candidates), dtype=np.int32)
+
+    # ratings on a scale of a few levels (e.g. half stars) are compared with one matrix
+    # product over members and levels, others member by member
+    levels = np.unique(batch[~np.isnan(batch)])
+    by_level = len(levels) <= MAX_LEVELS
+
+    # compare blocks of groups and candidates against all candidates, keeping
+    # groups x candidate block x candidates under block elements
+    group_step = max(1, min(n_groups, block // n_candidates**2))
+    candidate_step = max(1, min(n_candidates, block // (group_step * n_candidates)))
+    for g in range(0, n_groups, group_step):
+        groups = batch[g : g + group_step]
+        if by_level:
+            one_hot, signs = _level_preferences(groups, levels)
+
+        for c in range(0, n_candidates, candidate_step):
+            # net number of members preferring each candidate in the block over each
+            # candidate, comparisons with padded (NaN) members are always False
+            if by_level:
+                net = np.matmul(one_hot[:, c : c + candidate_step], signs)
+            else:
+                compared = groups[:, :, c : c + candidate_step, np.newaxis]
+                others = groups[:, :, np.newaxis, :]
+                net = np.zeros((len(groups), compared.shape[2], n_candidates), np.int16)
+                for m in range(n_members):
+                    net += compared[:, m] > others[:, m]
+                    net -= compared[:, m] < others[:, m]
+
+            scores[g : g + group_step, c : c + candidate_step] = np.count_nonzero(
+                net > 0, axis=-1
+            ) - np.count_nonzero(net < 0, axis=-1)
+
+    return scores[0] if ratings.ndim == 2 else scores
+
+
+def group_scores(ratings, method="copeland") -> np.ndarray:
+    """Score each candidate for a group (or batch of groups) with an aggregation method"""
+    ratings = np.asarray(ratings, dtype=np.float32)
+    if method == "average":
+        return np.nanmean(ratings, axis=-2)
+    if method == "least_misery":
+        return np.nanmin(ratings, axis=-2)
+    if method == "most_pleasure":
+        return np.nanmax(ratings, axis=-2)
+    if method == "borda":
+        return borda_scores(ratings)
+    if method == "copeland":
+        return copeland_scores(ratings)
+    raise ValueError(f"Unknown aggregation method {method}, use one of {METHODS}")
+
+
+def recommend(ratings, method="copeland", k=10) -> tuple[np.ndarray, np.ndarray]:
+    """Rank candidates for a group (or batch of groups), returning the (candidate indexes,
+    scores) of the top k, best first. Ties go to the lower candidate index"""
+    scores = group_scores(ratings, method)
+    top = np.argsort(-scores, axis=-1, kind="stable")[..., :k]
+    return top, np.take_along_axis(scores, top, axis=-1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each method on random groups")
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--members", type=int, default=6)
+    parser.add_argument("--candidates", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # groups of 2 to --members members with ratings rounded to half stars
+    rng = np.random.default_rng(args.seed)
+    sizes = rng.integers(2, args.members + 1, args.groups)
+    ratings = pad_groups(
+        [np.round(rng.uniform(1, 5, (size, args.candidates)) * 2) / 2 for size in sizes]
+    )
+    for method in METHODS:
+        start = time.perf_counter()
+        recommend(ratings, method)
+        print(f"{method:>14}: {time.perf_counter() - start:6.2f}s")
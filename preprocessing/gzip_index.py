@@ -0,0 +1,494 @@
+import argparse
+import ctypes
+import ctypes.util
+import gzip
+import io
+import os
+import zlib
+
+import numpy as np
+
+"""
+Random access into gzipped dumps, with an index of decompression checkpoints (as in zlib's
+zran.c example)
+- One pass records a checkpoint about every SPAN uncompressed bytes, at the end of a deflate
+  block: the compressed position (to the bit), the uncompressed position and the 32KB of
+  output before it, which later blocks can refer back to. The index is saved next to the
+  input as <input>.zran.npz, with the windows compressed
+- Reading from any offset starts at the checkpoint before it, so it decompresses at most
+  SPAN bytes that aren't returned. Files with several gzip members (e.g. concatenated) work
+- zlib's inflate is called through ctypes, since the zlib module can't stop at block ends or
+  start mid-byte
+- open_gzip opens a dump as a file that seeks through the index if there is one, or reads a
+  uniform random sample: the file is split into SAMPLE_WINDOW byte windows, a fraction of
+  them is picked with a seeded generator and every line that starts in a picked window is
+  read, so each line is sampled with the same probability
+- split_ranges and read_lines split one file into byte ranges that separate workers can
+  decompress on their own
+"""
+
+INDEX_SUFFIX = ".zran.npz"
+SPAN = 2**22  # uncompressed bytes between checkpoints
+WINDOW_BYTES = 32768  # deflate's window, the output a checkpoint has to keep
+INPUT_CHUNK = 2**16  # compressed bytes read at a time
+OUTPUT_CHUNK = 2**17  # uncompressed bytes inflated at a time
+BUFFER_BYTES = 2**20  # read buffer of the files open_gzip returns
+SAMPLE_WINDOW = 2**20  # uncompressed bytes in each window a sample picks from
+SAMPLE_SEED = 0
+TRAILER_BYTES = 8  # crc32 and size after each gzip member's deflate stream
+
+# zlib constants, see zlib.h
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+GZIP_WBITS = 31  # gzip header and trailer
+RAW_WBITS = -15  # bare deflate data, from a checkpoint
+END_OF_BLOCK = 128  # data_type flag, inflate stopped at the end of a block (or header)
+LAST_BLOCK = 64  # data_type flag, the block is the last of its member
+
+_libz = None  # zlib, loaded on first use
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ("next_in", ctypes.c_void_p),
+        ("avail_in", ctypes.c_uint),
+        ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p),
+        ("avail_out", ctypes.c_uint),
+        ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p),
+        ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p),
+        ("zfree", ctypes.c_void_p),
+        ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int),
+        ("adler", ctypes.c_ulong),
+        ("reserved", ctypes.c_ulong),
+    ]
+
+
+def _load_libz():
+    """Load the zlib shared library and declare the functions used"""
+    global _libz
+    if _libz is None:
+        path = ctypes.util.find_library("z")
+        if path is None:
+            raise OSError("zlib's shared library (libz) is needed for gzip indexes")
+        lib = ctypes.CDLL(path)
+        stream = ctypes.POINTER(_ZStream)
+        lib.zlibVersion.restype = ctypes.c_char_p
+        lib.inflateInit2_.argtypes = [
+            stream,
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_int,
+        ]
+        lib.inflate.argtypes = [stream, ctypes.c_int]
+        lib.inflateEnd.argtypes = [stream]
+        lib.inflateReset.argtypes = [stream]
+        lib.inflatePrime.argtypes = [stream, ctypes.c_int, ctypes.c_int]
+        lib.inflateSetDictionary.argtypes = [stream, ctypes.c_char_p, ctypes.c_uint]
+        _libz = lib
+    return _libz
+
+
+class _Inflater:
+    """A zlib inflate stream"""
+
+    def __init__(self, wbits):
+        self.lib = _load_libz()
+        self.stream = _ZStream()
+        self.output = ctypes.create_string_buffer(OUTPUT_CHUNK)
+        self.input = None
+        ret = self.lib.inflateInit2_(
+            ctypes.byref(self.stream),
+            wbits,
+            self.lib.zlibVersion(),
+            ctypes.sizeof(_ZStream),
+        )
+        if ret != Z_OK:
+            raise zlib.error(f"inflateInit2 failed ({ret})")
+        self.open = True
+
+    def start_at(self, bits, byte, window):
+        """Start a raw stream bits into byte, with the window before it"""
+        if bits:
+            self.lib.inflatePrime(ctypes.byref(self.stream), bits, byte >> (8 - bits))
+        if window:
+            self.lib.inflateSetDictionary(
+                ctypes.byref(self.stream), window, len(window)
+            )
+
+    def feed(self, data):
+        """Give the stream more compressed data, once it has used up the last"""
+        self.input = ctypes.create_string_buffer(data, len(data))
+        self.stream.next_in = ctypes.addressof(self.input)
+        self.stream.avail_in = len(data)
+
+    @property
+    def unused(self) -> int:
+        """Compressed bytes fed but not used yet"""
+        return self.stream.avail_in
+
+    @property
+    def data_type(self) -> int:
+        return self.stream.data_type
+
+    def inflate(self, flush=Z_NO_FLUSH) -> tuple[bytes, int]:
+        """Inflate up to OUTPUT_CHUNK bytes, returning them and zlib's return code"""
+        self.stream.next_out = ctypes.addressof(self.output)
+        self.stream.avail_out = OUTPUT_CHUNK
+        ret = self.lib.inflate(ctypes.byref(self.stream), flush)
+        if ret not in [Z_OK, Z_STREAM_END, Z_BUF_ERROR]:
+            message = self.stream.msg.decode() if self.stream.msg else ret
+            raise zlib.error(f"Error inflating: {message}")
+        produced = OUTPUT_CHUNK - self.stream.avail_out
+        return ctypes.string_at(self.output, produced), ret
+
+    def reset(self):
+        """Start over for the next gzip member, keeping unused input"""
+        self.lib.inflateReset(ctypes.byref(self.stream))
+
+    def close(self):
+        if self.open:
+            self.lib.inflateEnd(ctypes.byref(self.stream))
+            self.open = False
+
+    def __del__(self):
+        self.close()
+
+
+class GzipIndex:
+    """Decompression checkpoints of a gzip file
+
+    compressed (byte positions), bits (of the byte before, 0 if the block starts on a byte)
+    and uncompressed (positions) are parallel arrays, windows the 32KB before each one.
+    """
+
+    def __init__(
+        self, compressed, bits, uncompressed, windows, size, source_size, span
+    ):
+        self.compressed = compressed
+        self.bits = bits
+        self.uncompressed = uncompressed
+        self.windows = windows
+        self.size = size
+        self.source_size = source_size
+        self.span = span
+
+    def __len__(self) -> int:
+        return len(self.compressed)
+
+    def point(self, offset) -> int:
+        """The last checkpoint at or before an uncompressed offset"""
+        return max(int(np.searchsorted(self.uncompressed, offset, side="right")) - 1, 0)
+
+
+def index_path(path) -> str:
+    """Where a gzip file's index is saved"""
+    return f"{path}{INDEX_SUFFIX}"
+
+
+def build_gzip_index(path, span=SPAN) -> GzipIndex:
+    """Decompress a gzip file once, recording a checkpoint about every span bytes, and save
+    the index next to it"""
+    compressed, bits, uncompressed, windows = [], [], [], []
+    window = b""
+    consumed = produced = 0  # compressed bytes used, uncompressed bytes made
+    last = -span  # uncompressed position of the last checkpoint
+
+    inflater = _Inflater(GZIP_WBITS)
+    with open(path, "rb") as f:
+        while True:
+            if not inflater.unused:
+                data = f.read(INPUT_CHUNK)
+                if not data:
+                    break
+                inflater.feed(data)
+                consumed += len(data)
+
+            output, ret = inflater.inflate(Z_BLOCK)
+            produced += len(output)
+            window = (window + output)[-WINDOW_BYTES:]
+
+            if ret == Z_STREAM_END:
+                # another member may follow
+                inflater.reset()
+                continue
+
+            # a block (or the header) just ended, and the next one isn't past the last
+            data_type = inflater.data_type
+            at_boundary = data_type & END_OF_BLOCK and not data_type & LAST_BLOCK
+            if at_boundary and produced - last >= span:
+                compressed.append(consumed - inflater.unused)
+                bits.append(data_type & 7)
+                uncompressed.append(produced)
+                windows.append(zlib.compress(window))
+                last = produced
+    inflater.close()
+
+    window_offsets = np.zeros(len(windows) + 1, dtype=np.int64)
+    np.cumsum([len(w) for w in windows], out=window_offsets[1:])
+    arrays = {
+        "compressed": np.array(compressed, dtype=np.int64),
+        "bits": np.array(bits, dtype=np.uint8),
+        "uncompressed": np.array(uncompressed, dtype=np.int64),
+        "window_data": np.frombuffer(b"".join(windows), dtype=np.uint8),
+        "window_offsets": window_offsets,
+        "meta": np.array([produced, os.path.getsize(path), span], dtype=np.int64),
+    }
+    with open(index_path(path), "wb") as f:
+        np.savez(f, **arrays)
+    return load_gzip_index(path)
+
+
+def load_gzip_index(path) -> GzipIndex:
+    """Load a gzip file's index, None if it hasn't been built or the file has changed"""
+    if not os.path.exists(index_path(path)):
+        return None
+    with np.load(index_path(path)) as npz:
+        size, source_size, span = npz["meta"].tolist()
+        if source_size != os.path.getsize(path):
+            return None
+        data = npz["window_data"].tobytes()
+        offsets = npz["window_offsets"].tolist()
+        windows = [
+            zlib.decompress(data[start:end]) for start, end in zip(offsets, offsets[1:])
+        ]
+        return GzipIndex(
+            npz["compressed"],
+            npz["bits"],
+            npz["uncompressed"],
+            windows,
+            size,
+            source_size,
+            span,
+        )
+
+
+class _Pieces(io.RawIOBase):
+    """A raw reader that hands out pieces of output from _next_piece, tracking position"""
+
+    def __init__(self):
+        self.position = 0  # position of the next byte handed out
+        self.piece = b""
+        self.piece_at = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self.piece_at == len(self.piece):
+            self.piece, self.piece_at = self._next_piece(), 0
+            if not self.piece:
+                return 0
+        n = min(len(buffer), len(self.piece) - self.piece_at)
+        buffer[:n] = self.piece[self.piece_at : self.piece_at + n]
+        self.piece_at += n
+        self.position += n
+        return n
+
+    def _skip(self, n):
+        """Skip n bytes forward"""
+        while n > 0:
+            if self.piece_at == len(self.piece):
+                self.piece, self.piece_at = self._next_piece(), 0
+                if not self.piece:
+                    return
+            skipped = min(n, len(self.piece) - self.piece_at)
+            self.piece_at += skipped
+            self.position += skipped
+            n -= skipped
+
+    def tell(self) -> int:
+        return self.position
+
+
+class _IndexedRaw(_Pieces):
+    """Uncompressed bytes of a gzip file, seeking through its index"""
+
+    def __init__(self, path, index):
+        super().__init__()
+        self.fileobj = open(path, "rb")
+        self.index = index
+        self.inflater = None
+        self._start(0)
+
+    def seekable(self) -> bool:
+        return True
+
+    def _start(self, point):
+        """Start decompressing at a checkpoint"""
+        if self.inflater is not None:
+            self.inflater.close()
+        self.inflater = _Inflater(RAW_WBITS)
+        self.raw = True  # a raw stream doesn't read its member's trailer, gzip ones do
+        bits = int(self.index.bits[point])
+        self.fileobj.seek(int(self.index.compressed[point]) - (1 if bits else 0))
+        byte = self.fileobj.read(1)[0] if bits else 0
+        self.inflater.start_at(bits, byte, self.index.windows[point])
+        self.position = int(self.index.uncompressed[point])
+        self.piece, self.piece_at = b"", 0
+
+    def _next_piece(self) -> bytes:
+        while True:
+            at_end = False
+            if not self.inflater.unused:
+                data = self.fileobj.read(INPUT_CHUNK)
+                at_end = not data
+                if data:
+                    self.inflater.feed(data)
+            # at the end of the file, still take any output the inflater has pending
+            output, ret = self.inflater.inflate()
+            if ret == Z_STREAM_END:
+                # step back to the end of the member, then read the next one (if any) whole
+                trailer = TRAILER_BYTES if self.raw else 0
+                self.fileobj.seek(-self.inflater.unused + trailer, os.SEEK_CUR)
+                self.inflater.close()
+                self.inflater = _Inflater(GZIP_WBITS)
+                self.raw = False
+            if output:
+                return output
+            if at_end:
+                return b""
+
+    def seek(self, offset, whence=os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.index.size
+
+        # jump to a checkpoint unless the offset is a short way ahead
+        if not 0 <= offset - self.position <= self.index.span:
+            self._start(self.index.point(offset))
+        self._skip(offset - self.position)
+        return self.position
+
+    def close(self):
+        if self.inflater is not None:
+            self.inflater.close()
+        self.fileobj.close()
+        super().close()
+
+
+class IndexedGzipFile(io.BufferedReader):
+    """A buffered gzip reader, with fileobj the compressed file like gzip.GzipFile"""
+
+    @property
+    def fileobj(self):
+        return self.raw.fileobj
+
+
+class _SampledRaw(_Pieces):
+    """The lines that start in randomly picked windows of a gzip file, in file order"""
+
+    def __init__(self, path, index, fraction, seed, window):
+        super().__init__()
+        self.reader = IndexedGzipFile(_IndexedRaw(path, index), BUFFER_BYTES)
+        self.fileobj = self.reader.fileobj
+        self.arguments = index, fraction, seed, window
+        self._restart()
+
+    def _restart(self):
+        """Go back to the first picked window"""
+        index, fraction, seed, window = self.arguments
+        n_windows = -(-index.size // window)
+        picked = np.random.default_rng(seed).random(n_windows) < fraction
+        self.windows = iter(np.flatnonzero(picked).tolist())
+        self.window_end = 0
+        self.position = 0
+        self.piece, self.piece_at = b"", 0
+
+    def seekable(self) -> bool:
+        return True
+
+    def _next_piece(self) -> bytes:
+        """The next line of the sample"""
+        while True:
+            position = self.reader.tell()
+            if position < self.window_end:
+                return self.reader.readline()
+
+            window = next(self.windows, None)
+            if window is None:
+                return b""
+            start = window * self.arguments[3]
+            self.window_end = start + self.arguments[3]
+
+            # move to the first line that starts in the window, unless a line of the last
+            # window ran into it
+            if position < start:
+                self.reader.seek(start - 1)
+                self.reader.readline()
+
+    def seek(self, offset, whence=os.SEEK_SET) -> int:
+        """Seek within the sample, by reading it from the start if the offset is behind"""
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence != os.SEEK_SET:
+            raise io.UnsupportedOperation("Samples can't seek from their end")
+        if offset < self.position:
+            self._restart()
+        self._skip(offset - self.position)
+        return self.position
+
+    def close(self):
+        self.reader.close()
+        super().close()
+
+
+def open_gzip(path, sample_fraction=None, seed=SAMPLE_SEED):
+    """Open a gzip file for reading, seeking through its index if it has one
+
+    With sample_fraction, only a uniform random sample of about that fraction of its lines
+    is read (building the index first if needed), the same lines for the same seed.
+    """
+    index = load_gzip_index(path)
+    if sample_fraction is not None:
+        if index is None:
+            print(f"Indexing {path} for sampling, once")
+            index = build_gzip_index(path)
+        raw = _SampledRaw(path, index, sample_fraction, seed, SAMPLE_WINDOW)
+        return IndexedGzipFile(raw, BUFFER_BYTES)
+    if index is None:
+        return gzip.open(path, "rb")
+    return IndexedGzipFile(_IndexedRaw(path, index), BUFFER_BYTES)
+
+
+def split_ranges(index, n) -> list[tuple[int, int]]:
+    """Split a file's uncompressed bytes into n (start, end) ranges of about equal size"""
+    bounds = [index.size * i // n for i in range(n + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def read_lines(path, start, end, index=None):
+    """Yield the lines that start in [start, end) of a gzip file's uncompressed bytes, so
+    workers reading the ranges from split_ranges read every line exactly once"""
+    index = index or load_gzip_index(path)
+    with IndexedGzipFile(_IndexedRaw(path, index), BUFFER_BYTES) as f:
+        # a line that starts before the range belongs to the range before
+        if start:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index gzip files for random access")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--span", type=int, default=SPAN)
+    args = parser.parse_args()
+
+    for path in args.paths:
+        index = build_gzip_index(path, args.span)
+        print(
+            f"{path}: {len(index)} checkpoints over {index.size} bytes, "
+            f"saved to {index_path(path)}"
+        )
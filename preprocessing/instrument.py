@@ -0,0 +1,140 @@
+import json
+import resource
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+"""
+Lightweight instrumentation for preprocessing runs
+- Counters (reject reasons, lines, bytes) and timers are kept per stage, for whichever stage
+  was last started with start_stage
+- Hot paths only do a dict increment (see reject), timers wrap whole loops, saves and
+  aggregations rather than single lines, so overhead stays well under a percent
+- Timers are exclusive: time spent in a nested timer isn't counted in the enclosing one,
+  so a parse loop that saves batches reports parse and save time separately
+- Parse workers in other processes collect counts locally, hand them back with take_counts,
+  and the reading process merges them with add_counts
+"""
+
+REPORTS_FOLDER = "reports"
+
+_counts = defaultdict(Counter)
+_times = defaultdict(Counter)
+_peak_rss = dict()
+_current = _counts[None]  # counter of the current stage, used by the hot-path functions
+_stage = None
+_timer_stack = []
+_run_start = time.time()
+
+
+def _peak_rss_mb() -> float:
+    """Peak RSS of this process and its finished children in MB"""
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def start_run():
+    """Clear everything recorded so far and start timing a new run"""
+    global _current, _stage, _run_start
+    _counts.clear()
+    _times.clear()
+    _peak_rss.clear()
+    _timer_stack.clear()
+    _stage = None
+    _current = _counts[None]
+    _run_start = time.time()
+
+
+def start_stage(stage):
+    """Record counts and times under stage until the next stage starts"""
+    global _current, _stage
+    _stage = stage
+    _current = _counts[stage]
+
+
+def end_stage():
+    """Record the peak memory at the end of the current stage"""
+    _peak_rss[_stage] = _peak_rss_mb()
+
+
+def count(name, n=1):
+    """Add n to a counter of the current stage"""
+    _current[name] += n
+
+
+def reject(reason) -> tuple[None, None]:
+    """Count a parse rejection and return the (None, None) a parse function returns for it"""
+    _current["rejected." + reason] += 1
+    return None, None
+
+
+def count_written(n_bytes):
+    """Count a file that has just been written (or queued to be) and its size"""
+    _current["files_written"] += 1
+    _current["bytes_written"] += n_bytes
+
+
+def get_count(name) -> int:
+    """Value of a counter of the current stage"""
+    return _current[name]
+
+
+def take_counts() -> dict:
+    """Return and clear the counts of the current stage, for handing back from a worker"""
+    counts = dict(_current)
+    _current.clear()
+    return counts
+
+
+def add_counts(counts):
+    """Merge counts (e.g. from take_counts in a worker) into the current stage"""
+    _current.update(counts)
+
+
+@contextmanager
+def timer(name):
+    """Time a block under name in the current stage, excluding time spent in nested timers"""
+    stage = _stage
+    start = time.perf_counter()
+    _timer_stack.append(0.0)
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = _timer_stack.pop()
+        _times[stage][name] += elapsed - nested
+        if _timer_stack:
+            _timer_stack[-1] += elapsed
+
+
+def report() -> dict:
+    """Everything recorded in this run as a JSON-ready dict"""
+    stages = dict()
+    for stage in list(_counts.keys()) + list(_times.keys()):
+        if stage is None or stage in stages:
+            continue
+        stages[stage] = {
+            "counts": dict(sorted(_counts[stage].items())),
+            "seconds": dict(_times[stage]),
+            "peak_rss_mb": _peak_rss.get(stage),
+        }
+
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(_run_start)),
+        "seconds": time.time() - _run_start,
+        "argv": sys.argv,
+        "peak_rss_mb": _peak_rss_mb(),
+        "stages": stages,
+    }
+
+
+def save_report(storage, prefix) -> str:
+    """Save the run report as JSON under prefix in storage (see storage.py), returning its key"""
+    started = time.strftime("%Y%m%d_%H%M%S", time.localtime(_run_start))
+    key = f"{prefix}/run_{started}.json"
+    storage.put(key, json.dumps(report(), indent=4).encode("utf-8"))
+    return key
@@ -0,0 +1,126 @@
+from array import array
+
+import numpy as np
+
+from columnar import load_shard
+
+"""
+ISBN -> work index
+- Every ISBN-10 is normalized to its ISBN-13, so both forms of a book match the same key
+- Keys are stored as a sorted uint64 array with a parallel array of work numbers (OL123W -> 123)
+- Both arrays are .npy files opened with mmap, so opening is instant and only touched pages are read
+  (from a remote storage backend they're downloaded to a local cache first, see storage.py)
+"""
+
+INDEX_FOLDER = "isbn_index"
+LOOKUP_BATCH = 100000  # ISBNs looked up in the index at a time
+
+
+def isbn_to_int(isbn) -> int:
+    """Normalize an ISBN-10 or ISBN-13 string to its ISBN-13 as an int, 0 if it isn't an ISBN"""
+    if not isbn:
+        return 0
+    isbn = isbn.replace("-", "").replace(" ", "").upper()
+
+    if len(isbn) == 13 and isbn.isdigit():
+        return int(isbn)
+
+    # ISBN-10 -> "978" + first 9 digits + recomputed ISBN-13 check digit
+    if len(isbn) == 10 and isbn[:9].isdigit() and (isbn[9].isdigit() or isbn[9] == "X"):
+        digits = "978" + isbn[:9]
+        total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+        return int(digits + str((10 - total % 10) % 10))
+
+    return 0
+
+
+def work_id_to_int(work_id) -> int:
+    """Convert an Open Library work id like OL123W to its number"""
+    return int(work_id[2:-1])
+
+
+def int_to_work_id(work_number) -> str:
+    """Convert a work number back to an Open Library work id"""
+    return f"OL{work_number}W"
+
+
+def record_isbns(items, keys, work_numbers):
+    """Pass (isbn, work id) pairs through unchanged, appending them to keys and work_numbers"""
+    for isbn, work_id in items:
+        key = isbn_to_int(isbn)
+        if key:
+            keys.append(key)
+            work_numbers.append(work_id_to_int(work_id))
+        yield isbn, work_id
+
+
+def save_isbn_index(storage, folder, keys, work_numbers):
+    """Sort recorded ISBNs and save them as an index, later pairs win for duplicate ISBNs"""
+    keys = np.frombuffer(array("Q", keys), dtype=np.uint64)
+    work_numbers = np.frombuffer(array("Q", work_numbers), dtype=np.uint64)
+
+    # stable sort so the last of each group of equal keys is the latest recorded
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    work_numbers = work_numbers[order]
+    last = np.append(keys[1:] != keys[:-1], True) if len(keys) else np.zeros(0, bool)
+
+    with storage.open_write(f"{folder}/keys.npy") as f:
+        np.save(f, keys[last])
+    with storage.open_write(f"{folder}/work_numbers.npy") as f:
+        np.save(f, work_numbers[last])
+
+
+def open_isbn_index(storage, folder) -> tuple[np.ndarray, np.ndarray]:
+    """Memory-map an ISBN index, returning its (keys, work_numbers) arrays"""
+    keys = np.load(storage.local_path(f"{folder}/keys.npy"), mmap_mode="r")
+    work_numbers = np.load(
+        storage.local_path(f"{folder}/work_numbers.npy"), mmap_mode="r"
+    )
+    return keys, work_numbers
+
+
+def lookup_isbns(index, isbns) -> np.ndarray:
+    """Look up a batch of ISBN strings, returning work numbers (0 where not found)"""
+    keys, work_numbers = index
+    query = np.fromiter(
+        (isbn_to_int(isbn) for isbn in isbns), dtype=np.uint64, count=len(isbns)
+    )
+    if not len(keys):
+        return np.zeros(len(query), dtype=np.uint64)
+
+    positions = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    found = (keys[positions] == query) & (query > 0)
+    return np.where(found, work_numbers[positions], 0)
+
+
+def has_isbn(index, isbns) -> bool:
+    """Check whether any of a few ISBN strings is in the index"""
+    keys, _ = index
+    for isbn in isbns:
+        key = isbn_to_int(isbn)
+        if key:
+            position = np.searchsorted(keys, np.uint64(key))
+            if position < len(keys) and keys[position] == key:
+                return True
+    return False
+
+
+def asin_works(storage, folder=INDEX_FOLDER) -> dict:
+    """{asin: work number} for every ASIN with an ISBN in the ISBN index"""
+    index = open_isbn_index(storage, folder)
+
+    # ISBN-13s are tried before ISBN-10s, each in the order they're listed
+    pairs = []
+    for path in ["amz_isbn13s", "amz_isbn10s"]:
+        for asin, isbns in load_shard(storage, path, "id_lists").items():
+            pairs += [(asin, isbn) for isbn in isbns]
+
+    works = dict()
+    for start in range(0, len(pairs), LOOKUP_BATCH):
+        batch = pairs[start : start + LOOKUP_BATCH]
+        numbers = lookup_isbns(index, [isbn for _, isbn in batch]).tolist()
+        for (asin, _), number in zip(batch, numbers):
+            if number and asin not in works:
+                works[asin] = number
+    return works
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+import numpy as np
+
+from amz_preproc import S3_FOLDER
+from covers import HTTPClient
+from rating_matrix import MATRIX_FOLDER, open_rating_matrix
+from storage import open_storage
+
+"""
+Load test for the group recommendation service (see service.py)
+- Groups are drawn at random from the rating matrix's users, with a fixed seed. Requests
+  pick from a pool of --groups distinct groups, so fewer groups than requests exercises the
+  result cache and request coalescing, and as many groups as requests measures scoring
+- --concurrency clients send requests back to back over keep-alive connections, and every
+  request's latency is timed from sending it to reading the whole response
+- Reports requests/sec, latency percentiles (p50, p90, p99, max) in milliseconds, status
+  counts and the service's own stats afterwards, as JSON
+"""
+
+URL = "http://127.0.0.1:8080"
+REQUESTS = 2000
+CONCURRENCY = 16
+GROUPS = 200  # distinct groups requests are drawn from
+MEMBERS = 5  # most members per group, groups have 2 to this many
+PERCENTILES = [50, 90, 99]
+
+
+def sample_groups(user_ids, n_groups, max_members, seed) -> list[list[str]]:
+    """n_groups random groups of 2 to max_members ids from an array of user ids"""
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(2, max_members + 1, n_groups)
+    return [
+        [
+            user_ids[i].decode("utf-8")
+            for i in rng.choice(len(user_ids), size, replace=False)
+        ]
+        for size in sizes
+    ]
+
+
+async def run_load(url, groups, n_requests, concurrency, method, seed) -> dict:
+    """Send n_requests recommendation requests from concurrency clients, returning
+    latencies (seconds), statuses and the elapsed time"""
+    rng = np.random.default_rng(seed + 1)
+    bodies = [
+        json.dumps({"members": groups[i], "method": method}).encode("utf-8")
+        for i in rng.integers(0, len(groups), n_requests)
+    ]
+    pending = iter(bodies)
+    latencies = []
+    statuses = Counter()
+    client = HTTPClient(concurrency)
+
+    async def worker():
+        for body in pending:
+            start = time.perf_counter()
+            try:
+                status, _, _ = await client.request("POST", f"{url}/recommend", body)
+            except (
+                OSError,
+                ValueError,
+                asyncio.TimeoutError,
+                asyncio.IncompleteReadError,
+            ):
+                status = "connection_error"
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        _, _, stats = await client.get(f"{url}/stats")
+    finally:
+        client.close()
+    return {
+        "latencies": latencies,
+        "statuses": statuses,
+        "elapsed": elapsed,
+        "service": json.loads(stats),
+    }
+
+
+def summarize(results) -> dict:
+    """Requests/sec and latency percentiles in milliseconds of a load test"""
+    latencies = np.array(results["latencies"]) * 1000
+    summary = {
+        "requests": len(latencies),
+        "seconds": round(results["elapsed"], 3),
+        "requests_per_sec": round(len(latencies) / results["elapsed"], 1),
+    }
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = round(
+            float(np.percentile(latencies, percentile)), 2
+        )
+    summary["max_ms"] = round(float(latencies.max()), 2)
+    summary["statuses"] = {str(status): n for status, n in results["statuses"].items()}
+    summary["service"] = results["service"]
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the recommendation service")
+    parser.add_argument("--url", default=URL)
+    parser.add_argument("--location", default=S3_FOLDER, help="to draw user ids from")
+    parser.add_argument("--requests", type=int, default=REQUESTS)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--groups", type=int, default=GROUPS)
+    parser.add_argument("--members", type=int, default=MEMBERS)
+    parser.add_argument("--method", default="copeland")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    matrix = open_rating_matrix(open_storage(args.location), MATRIX_FOLDER)
+    groups = sample_groups(matrix.user_ids, args.groups, args.members, args.seed)
+    results = asyncio.run(
+        run_load(
+            args.url, groups, args.requests, args.concurrency, args.method, args.seed
+        )
+    )
+    print(json.dumps(summarize(results), indent=4))
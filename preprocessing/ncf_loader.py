@@ -0,0 +1,277 @@
+import argparse
+import time
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+
+from amz_preproc import S3_FOLDER
+from book_features import FEATURES_FOLDER, open_book_features
+from instrument import (
+    REPORTS_FOLDER,
+    count,
+    end_stage,
+    save_report,
+    start_run,
+    start_stage,
+    timer,
+)
+from rating_matrix import MATRIX_FOLDER, open_rating_matrix
+from storage import open_storage
+
+"""
+Streaming training data for neural collaborative filtering
+- Examples are (user, book, rating) triples read from the memory-mapped rating matrix (see
+  rating_matrix.py), plus the book's features joined from the memory-mapped feature arrays
+  (see book_features.py) by book index
+- Each epoch shuffles the ratings in chunks: tasks take CHUNKS_PER_TASK chunks from a random
+  permutation of all chunks and shuffle their ratings together, so a batch mixes many users
+- Every rating gets negatives unrated books, drawn uniformly or by popularity. Draws that hit
+  a book the user rated are redrawn, checked with a binary search of the user's sorted
+  row for the whole batch at once
+- Tasks run in a pool of workers that memory-map the arrays, with at most prefetch tasks in
+  flight, so memory stays bounded however many ratings there are
+- Batches are dicts of arrays: users, books (int32), ratings (0 for negatives), labels (1 for
+  rated books, 0 for negatives), genres (int32) and numeric (float32, batch x features)
+"""
+
+BATCH_SIZE = 1024  # examples per batch, negatives included
+NEGATIVES = 4  # negatives per rating
+CHUNK_SIZE = 4096  # ratings per chunk, the unit of shuffling
+CHUNKS_PER_TASK = 32  # chunks shuffled together by each task
+WORKERS = 2
+PREFETCH = 4  # tasks in flight, each one is CHUNK_SIZE * CHUNKS_PER_TASK ratings
+NEGATIVE_ROUNDS = 3  # times negatives that hit rated books are redrawn
+
+_matrix = None  # the rating matrix, opened in each worker
+_features = None  # book features, opened in each worker
+_book_cdf = None  # cumulative probability of drawing each book as a negative
+
+
+def _open_arrays(location, matrix_folder, features_folder, popularity):
+    """Memory-map the rating matrix and book features in a worker"""
+    global _matrix, _features, _book_cdf
+    storage = open_storage(location)
+    _matrix = open_rating_matrix(storage, matrix_folder)
+    _features = open_book_features(storage, features_folder)
+
+    # books are drawn with probability proportional to ratings ** popularity
+    weights = np.diff(_matrix.csc_indptr).astype(np.float64) ** popularity
+    _book_cdf = np.cumsum(weights) / weights.sum()
+
+
+def _is_rated(users, books) -> np.ndarray:
+    """Whether each user rated each book, by binary search of the users' sorted rows"""
+    low = _matrix.csr_indptr[users]
+    end = _matrix.csr_indptr[users + 1]
+    high = end.copy()
+    while np.any(low < high):
+        searching = low < high
+        middle = (low + high) // 2
+        before = searching & (_matrix.csr_indices[np.minimum(middle, end - 1)] < books)
+        low = np.where(before, middle + 1, low)
+        high = np.where(searching & ~before, middle, high)
+    return (low < end) & (_matrix.csr_indices[np.minimum(low, end - 1)] == books)
+
+
+def _sample_negatives(users, rng) -> np.ndarray:
+    """Draw a book for each user, redrawing books the user rated"""
+    books = np.searchsorted(_book_cdf, rng.random(len(users)), side="right")
+    books = np.minimum(books, len(_book_cdf) - 1).astype(np.int32)
+    for _ in range(NEGATIVE_ROUNDS):
+        rated = np.flatnonzero(_is_rated(users, books))
+        if not len(rated):
+            break
+        redrawn = np.searchsorted(_book_cdf, rng.random(len(rated)), side="right")
+        books[rated] = np.minimum(redrawn, len(_book_cdf) - 1)
+    return books
+
+
+def _make_examples(task) -> dict:
+    """Shuffled examples for a task's chunks of ratings, with negatives and features"""
+    chunks, negatives, seed = task
+    rng = np.random.default_rng(seed)
+    n_ratings = len(_matrix.csr_indices)
+    positions = np.concatenate(
+        [
+            np.arange(chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, n_ratings))
+            for chunk in chunks
+        ]
+    )
+    users = np.searchsorted(_matrix.csr_indptr, positions, side="right") - 1
+
+    negative_users = np.repeat(users, negatives)
+    examples = {
+        "users": np.concatenate([users, negative_users]).astype(np.int32),
+        "books": np.concatenate(
+            [_matrix.csr_indices[positions], _sample_negatives(negative_users, rng)]
+        ),
+        "ratings": np.concatenate(
+            [_matrix.csr_data[positions], np.zeros(len(negative_users), np.float32)]
+        ),
+        "labels": np.repeat(
+            np.array([1, 0], dtype=np.float32), [len(users), len(negative_users)]
+        ),
+    }
+    order = rng.permutation(len(examples["users"]))
+    examples = {name: values[order] for name, values in examples.items()}
+    examples["genres"] = _features.genres[examples["books"]]
+    examples["numeric"] = _features.numeric[examples["books"]]
+    return examples
+
+
+class NCFLoader:
+    """Shuffled batches of training examples, one epoch per iteration
+
+    Use as a context manager (or call close) to stop the workers.
+    """
+
+    def __init__(
+        self,
+        location=S3_FOLDER,
+        batch_size=BATCH_SIZE,
+        negatives=NEGATIVES,
+        popularity=0.0,
+        workers=WORKERS,
+        prefetch=PREFETCH,
+        seed=0,
+        matrix_folder=MATRIX_FOLDER,
+        features_folder=FEATURES_FOLDER,
+    ):
+        matrix = open_rating_matrix(open_storage(location), matrix_folder)
+        self.n_ratings = len(matrix.csr_indices)
+        self.batch_size = batch_size
+        self.negatives = negatives
+        self.prefetch = prefetch
+        self.seed = seed
+        self.epoch = 0
+        self.pool = Pool(
+            workers,
+            initializer=_open_arrays,
+            initargs=(location, matrix_folder, features_folder, popularity),
+        )
+
+    def __len__(self) -> int:
+        """Batches per epoch"""
+        examples = self.n_ratings * (1 + self.negatives)
+        return -(-examples // self.batch_size)
+
+    def _tasks(self, epoch):
+        """(chunks, negatives, seed) for each task of an epoch"""
+        n_chunks = -(-self.n_ratings // CHUNK_SIZE)
+        chunks = np.random.default_rng([self.seed, epoch]).permutation(n_chunks)
+        for i, start in enumerate(range(0, n_chunks, CHUNKS_PER_TASK)):
+            task_chunks = chunks[start : start + CHUNKS_PER_TASK]
+            yield task_chunks, self.negatives, [self.seed, epoch, i]
+
+    def batches(self, epoch):
+        """Yield an epoch's batches, the same ones for the same seed and epoch"""
+        pending = deque()
+        buffered = []  # examples left over from earlier tasks, fewer than a batch
+        for task in self._tasks(epoch):
+            pending.append(self.pool.apply_async(_make_examples, (task,)))
+            if len(pending) < self.prefetch:
+                continue
+
+            buffered.append(pending.popleft().get())
+            yield from self._split(buffered)
+
+        while pending:
+            buffered.append(pending.popleft().get())
+            yield from self._split(buffered)
+        if buffered:
+            yield self._join(buffered)
+
+    def _join(self, parts) -> dict:
+        """Concatenate example dicts"""
+        return {
+            name: np.concatenate([part[name] for part in parts]) for name in parts[0]
+        }
+
+    def _split(self, buffered):
+        """Yield full batches from the buffered examples, leaving the rest in buffered"""
+        examples = self._join(buffered)
+        n = len(examples["users"])
+        full = n - n % self.batch_size
+        for start in range(0, full, self.batch_size):
+            yield {
+                name: values[start : start + self.batch_size]
+                for name, values in examples.items()
+            }
+        buffered.clear()
+        if full < n:
+            buffered.append({name: values[full:] for name, values in examples.items()})
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1
+        return self.batches(epoch)
+
+    def close(self):
+        """Stop the workers"""
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def measure_throughput(loader, epochs=1) -> list[dict]:
+    """Run through epochs of a loader without training, returning each epoch's examples,
+    batches, seconds and examples per second"""
+    start_stage("ncf_loader")
+    results = []
+    for epoch in range(epochs):
+        examples = batches = 0
+        start = time.perf_counter()
+        with timer("epoch"):
+            for batch in loader:
+                examples += len(batch["users"])
+                batches += 1
+        seconds = time.perf_counter() - start
+        count("examples", examples)
+        count("batches", batches)
+        results.append(
+            {
+                "epoch": epoch,
+                "examples": examples,
+                "batches": batches,
+                "seconds": round(seconds, 3),
+                "examples_per_second": round(examples / seconds),
+            }
+        )
+    end_stage()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure NCF loader throughput")
+    parser.add_argument("--location", default=S3_FOLDER)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--negatives", type=int, default=NEGATIVES)
+    parser.add_argument("--popularity", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--prefetch", type=int, default=PREFETCH)
+    args = parser.parse_args()
+
+    start_run()
+    with NCFLoader(
+        args.location,
+        args.batch_size,
+        args.negatives,
+        args.popularity,
+        args.workers,
+        args.prefetch,
+    ) as loader:
+        for result in measure_throughput(loader, args.epochs):
+            print(
+                f"Epoch {result['epoch']}: {result['examples']} examples in "
+                f"{result['batches']} batches, {result['seconds']}s, "
+                f"{result['examples_per_second']} examples/s"
+            )
+    report_key = save_report(open_storage(args.location), REPORTS_FOLDER)
+    print(f"Saved run report to {args.location}/{report_key}")
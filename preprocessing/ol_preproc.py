@@ -1,11 +1,48 @@
 import json
 from tqdm import tqdm
-import gzip
-import os
-from collections import defaultdict
+from collections import defaultdict, deque
+from multiprocessing import Pool
 from pprint import pp
-
-# data paths
+from array import array
+from checkpoint import (
+    clear_partial_batches,
+    input_fingerprint,
+    load_checkpoint,
+    mark_stage_done,
+    save_checkpoint,
+    stage_is_current,
+)
+from columnar import save_shard
+from gzip_index import open_gzip
+from instrument import (
+    add_counts,
+    count,
+    end_stage,
+    reject,
+    start_run,
+    start_stage,
+    take_counts,
+    timer,
+)
+from isbn_index import INDEX_FOLDER, record_isbns, save_isbn_index
+from runs import concat, last, list_runs, merge_runs, write_run
+from sharding import (
+    AGGREGATE_WORKERS,
+    SHARDING,
+    WORKER_MEMORY,
+    aggregate_shards,
+    run_order,
+)
+from storage import AsyncWriter, open_storage
+from subject_index import SUBJECT_INDEX_FOLDER, build_work_index, index_fields
+
+# use orjson for parsing editions if it's installed, it's several times faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# data paths, S3_FOLDER can also be an s3://bucket/prefix location (see storage.py)
 S3_FOLDER = "mock_s3"
 OL_DATA = "data/openlibrary/2025-06-30/2025-06-30.txt.gz"
 
@@ -13,6 +50,11 @@ OL_DATA = "data/openlibrary/2025-06-30/2025-06-30.txt.gz"
 SAMPLE_SIZE = 1000000
 WORK_ID_FIRST_N = 4
 BATCH_SIZE = 10000
+OUTPUT_FORMAT = "json"  # "json" or "columnar", see columnar.py
+STAGE = "ol_editions"  # name of this stage's checkpoint and stage record
+WORKERS = 1  # number of parse processes, 1 parses in the reading process
+CHUNK_BYTES = 4 * 1024 * 1024  # size of raw line chunks sent to parse workers
+CHUNKS_IN_FLIGHT = 4  # chunks queued per worker before the reader waits
 
 """
 OL Notes
@@ -22,21 +64,6 @@ OL Notes
 """
 
 
-def _remove_folder(folder_path, recursed=False):
-    """Recursively delete a folder."""
-    names = os.listdir(folder_path)
-    for name in names:
-        path = folder_path + f"/{name}"
-        if os.path.isfile(path):
-            os.remove(path)
-        else:
-            _remove_folder(path, recursed=True)
-            os.rmdir(path)
-
-    if not recursed:
-        os.rmdir(folder_path)
-
-
 def _check_ids(raw_json) -> dict:
     """Extract matchable external IDs from edition, returning None if no IDs exist"""
     book = dict()
@@ -59,28 +86,50 @@ def _check_ids(raw_json) -> dict:
     return book if book else None
 
 
+def _prefilter_edition(line) -> bool:
+    """Check the raw bytes of a line for markers every accepted edition has, so most lines
+    can be rejected without decoding or parsing JSON. Never rejects a line _parse_edition
+    would accept"""
+    return (
+        line.startswith(b"/type/edition\t")
+        and b'"/languages/eng"' in line
+        and b'"isbn_1' in line
+        and b'"works"' in line
+    )
+
+
+def _loads(raw) -> dict:
+    """Parse JSON bytes, with orjson if it's installed"""
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass  # json accepts a few things orjson doesn't, like NaN and huge ints
+    return json.loads(raw)
+
+
 def _parse_edition(line) -> tuple[str, dict]:
     """Parse a single line into edition key and data"""
 
     # preprocess line into dictionary
-    line = line.decode("utf-8").split("\t")
-    edition_key = line[1].split("/")[-1]
-    raw_json = json.loads("".join(line[4:]))
+    line = line.split(b"\t")
+    edition_key = line[1].split(b"/")[-1].decode("utf-8")
+    raw_json = _loads(b"".join(line[4:]))
 
     # only include English books
     languages = raw_json.get("languages")
     if not languages or languages[0].get("key") != "/languages/eng":
-        return None, None
+        return reject("language")
 
     # only include books that have works
     works = raw_json.get("works")
     if not works:
-        return None, None
+        return reject("no_works")
 
     # check if book has ids, otherwise return None
     book = _check_ids(raw_json)
     if not book:
-        return None, None
+        return reject("no_isbn")
 
     # add work id
     book["work_id"] = works[0]["key"].split("/")[-1]
@@ -102,39 +151,134 @@ def _parse_edition(line) -> tuple[str, dict]:
     return edition_key, book
 
 
+def _parse_chunk(chunk) -> tuple[int, int, list, dict]:
+    """Parse a chunk of raw lines, returning its line count, number of lines rejected by
+    the prefilter, accepted editions with the offset of the end of their line in the chunk,
+    and this worker's reject counts for the chunk"""
+    lines = chunk.splitlines(keepends=True)
+    editions = []
+    prefiltered = 0
+    end = 0
+    for line in lines:
+        end += len(line)
+        if not _prefilter_edition(line):
+            prefiltered += 1
+            continue
+        key, edition = _parse_edition(line)
+        if key and edition:
+            editions.append((key, edition, end))
+
+    return len(lines), prefiltered, editions, take_counts()
+
+
+def _read_chunks(f, chunk_bytes):
+    """Read a file in chunks of roughly chunk_bytes, only splitting on line ends"""
+    remainder = b""
+    while True:
+        block = f.read(chunk_bytes)
+        if not block:
+            break
+
+        # hold back the partial line at the end of the block for the next chunk
+        end = block.rfind(b"\n") + 1
+        if end == 0:
+            remainder += block
+            continue
+        yield remainder + block[:end]
+        remainder = block[end:]
+
+    if remainder:
+        yield remainder
+
+
+def _iter_editions(f, t, counts, workers=WORKERS, offset=0, chunk_bytes=CHUNK_BYTES):
+    """Yield (key, edition, offset) for accepted editions in file order, where offset is the
+    uncompressed position after the edition's line. Parses in a pool if workers > 1.
+    Lines read and lines rejected by the prefilter are added to counts, reject reasons
+    from workers are added to the stage's instrumentation counts"""
+
+    # serial path, parse each line in this process
+    if workers <= 1:
+        for line in f:
+            t.update()
+            offset += len(line)
+            counts["lines"] += 1
+            if not _prefilter_edition(line):
+                counts["prefiltered"] += 1
+                continue
+            key, edition = _parse_edition(line)
+            if key and edition:
+                yield key, edition, offset
+        return
+
+    # parallel path, this process reads chunks and workers parse them. results are
+    # collected in submission order so batches match the serial path exactly
+    # workers start with empty counts, so they only hand back their own
+    with Pool(workers, initializer=start_run) as pool:
+        pending = deque()
+        for chunk in _read_chunks(f, chunk_bytes):
+            pending.append((offset, pool.apply_async(_parse_chunk, (chunk,))))
+            offset += len(chunk)
+
+            # bound the number of chunks in flight so memory doesn't grow with file size
+            if len(pending) >= workers * CHUNKS_IN_FLIGHT:
+                chunk_offset, result = pending.popleft()
+                n_lines, prefiltered, editions, worker_counts = result.get()
+                t.update(n_lines)
+                add_counts(worker_counts)
+                counts["lines"] += n_lines
+                counts["prefiltered"] += prefiltered
+                for key, edition, end in editions:
+                    yield key, edition, chunk_offset + end
+
+        while pending:
+            chunk_offset, result = pending.popleft()
+            n_lines, prefiltered, editions, worker_counts = result.get()
+            t.update(n_lines)
+            add_counts(worker_counts)
+            counts["lines"] += n_lines
+            counts["prefiltered"] += prefiltered
+            for key, edition, end in editions:
+                yield key, edition, chunk_offset + end
+
+
 def _save_batch(
-    batch_works, batch_work_ids, batch_isbn10, batch_isbn13, batch_count, n
+    storage,
+    batch_works,
+    batch_work_ids,
+    batch_isbn10,
+    batch_isbn13,
+    batch_count,
+    sharding=SHARDING,
 ):
-    """Save one batch's works (grouped into files by first n characters) and work ids"""
-    # make temporary directories if they don't exist
-    os.makedirs(f"{S3_FOLDER}", exist_ok=True)
-    os.makedirs(f"{S3_FOLDER}/temp_batches", exist_ok=True)
-    os.makedirs(f"{S3_FOLDER}/temp_batches/works", exist_ok=True)
-    os.makedirs(f"{S3_FOLDER}/temp_batches/work_ids", exist_ok=True)
-    os.makedirs(f"{S3_FOLDER}/temp_batches/isbn_10", exist_ok=True)
-    os.makedirs(f"{S3_FOLDER}/temp_batches/isbn_13", exist_ok=True)
-
-    # group works by first n characters of id
-    works_n = defaultdict(dict)
-    for work_id, work_data in batch_works.items():
-        works_n[work_id[:n]][work_id] = work_data
-
-    # save batch of works to directory by their id's first n characters
-    for work_n_id, work_n_data in works_n.items():
-        work_n_dir = f"{S3_FOLDER}/temp_batches/works/{work_n_id}"
-        os.makedirs(work_n_dir, exist_ok=True)
-        with open(work_n_dir + f"/batch_{batch_count}.json", "w") as f:
-            json.dump(work_n_data, f)
-
-    # save work_ids by batch
-    with open(f"{S3_FOLDER}/temp_batches/work_ids/batch_{batch_count}.json", "w") as f:
-        json.dump(batch_work_ids, f)
-
-    # save isbn map by batch
-    with open(f"{S3_FOLDER}/temp_batches/isbn_10/batch_{batch_count}.json", "w") as f:
-        json.dump(batch_isbn10, f)
-    with open(f"{S3_FOLDER}/temp_batches/isbn_13/batch_{batch_count}.json", "w") as f:
-        json.dump(batch_isbn13, f)
+    """Save one batch's works, work ids and isbn maps as sorted runs"""
+    # spill each map as one run sorted by key, works in the order they're sharded in
+    write_run(
+        storage,
+        f"temp_batches/works/batch_{batch_count}.jsonl",
+        batch_works.items(),
+        run_order(sharding),
+    )
+    write_run(
+        storage,
+        f"temp_batches/work_ids/batch_{batch_count}.jsonl",
+        batch_work_ids.items(),
+    )
+    write_run(
+        storage,
+        f"temp_batches/isbn_10/batch_{batch_count}.jsonl",
+        batch_isbn10.items(),
+    )
+    write_run(
+        storage,
+        f"temp_batches/isbn_13/batch_{batch_count}.jsonl",
+        batch_isbn13.items(),
+    )
+    write_run(
+        storage,
+        f"temp_batches/work_terms/batch_{batch_count}.jsonl",
+        [(work_id, index_fields(work)) for work_id, work in batch_works.items()],
+    )
 
 
 def _aggregate_batch(batch_editions, batch_work_ids) -> dict:
@@ -165,90 +309,197 @@ def _aggregate_batch(batch_editions, batch_work_ids) -> dict:
     return works
 
 
-def _aggregate_batches():
-    """Aggregate temporary batches into corresponding folders"""
+def _merge_works(works) -> dict:
+    """Merge versions of one work from different batches, taking the first instance
+    of each value except subjects, which are combined"""
+    work = dict()
+    work_subjects = set()
+    for work_data in works:
+        for key, value in work_data.items():
+            if key == "subjects":
+                work_subjects.update(value)
+            elif key not in work.keys():
+                work[key] = value
+
+    # sort subjects so shards are the same from run to run
+    work["subjects"] = sorted(work_subjects)
+    return work
+
+
+def _aggregate_batches(
+    storage,
+    writer,
+    n=WORK_ID_FIRST_N,
+    output_format=OUTPUT_FORMAT,
+    sharding=SHARDING,
+    aggregate_workers=AGGREGATE_WORKERS,
+    worker_memory=WORKER_MEMORY,
+):
+    """Aggregate temporary batches into corresponding folders by merging their sorted runs
+
+    Sharded outputs are queued on writer, the single-file maps are streamed to storage
+    since they hold every id and would be buffered in memory by the writer.
+    With aggregate_workers > 1, works are merged by a pool of processes while the maps
+    are aggregated here (see sharding.py), into the same shards.
+    """
+    # every run has to be stored before they're merged
+    writer.flush()
+
+    # works are merged meanwhile by a pool of processes, or after the maps
+    finish_works = aggregate_shards(
+        storage,
+        writer,
+        S3_FOLDER,
+        "works",
+        list_runs(storage, "temp_batches/works"),
+        _merge_works,
+        "works",
+        output_format,
+        sharding,
+        first_n=n,
+        workers=aggregate_workers,
+        worker_memory=worker_memory,
+        desc="Aggregating works",
+    )
 
     # aggregate work ids and save
-    work_ids = defaultdict(list)
-    for batch_filename in tqdm(
-        os.listdir(f"{S3_FOLDER}/temp_batches/work_ids"), desc="Aggregating work IDs"
-    ):
-        with open(f"{S3_FOLDER}/temp_batches/work_ids/{batch_filename}", "r") as f:
-            batch = json.load(f)
-            for work_id, editions_lst in batch.items():
-                work_ids[work_id] += editions_lst
-    with open(f"{S3_FOLDER}/work_ids.json", "w") as f:
-        json.dump(work_ids, f)
-
-    # aggregate isbn 10 batches and save
-    isbn_10s = dict()
-    for batch_filename in tqdm(
-        os.listdir(f"{S3_FOLDER}/temp_batches/isbn_10"), desc="Aggregating ISBN 10"
-    ):
-        with open(f"{S3_FOLDER}/temp_batches/isbn_10/{batch_filename}", "r") as f:
-            batch = json.load(f)
-            for isbn_10, work_id in batch.items():
-                isbn_10s[isbn_10] = work_id
-    with open(f"{S3_FOLDER}/isbn_10s.json", "w") as f:
-        json.dump(isbn_10s, f)
-
-    # aggregate isbn 13 batches and save
-    isbn_13s = dict()
-    for batch_filename in tqdm(
-        os.listdir(f"{S3_FOLDER}/temp_batches/isbn_13"), desc="Aggregating ISBN 13"
-    ):
-        with open(f"{S3_FOLDER}/temp_batches/isbn_13/{batch_filename}", "r") as f:
-            batch = json.load(f)
-            for isbn_13, work_id in batch.items():
-                isbn_13s[isbn_13] = work_id
-    with open(f"{S3_FOLDER}/isbn_13s.json", "w") as f:
-        json.dump(isbn_13s, f)
-
-    # aggregate works
-    for first_n_id in tqdm(
-        os.listdir(f"{S3_FOLDER}/temp_batches/works"), desc="Aggregating works"
-    ):
-        works_group = dict()
-        for batch_group_filename in os.listdir(
-            f"{S3_FOLDER}/temp_batches/works/{first_n_id}"
-        ):
-            with open(
-                f"{S3_FOLDER}/temp_batches/works/{first_n_id}/{batch_group_filename}",
-                "r",
-            ) as f:
-                batch_group = json.load(f)
-                for work_id, work_data in batch_group.items():
-                    if work_id not in works_group.keys():
-                        work_data["subjects"] = set(
-                            work_data.get("subjects", [])
-                        )  # convert subjects to set, empty set if doesn't exist
-                        works_group[work_id] = work_data
-
-                    else:
-                        work_keys = works_group[work_id].keys()
-                        for key, value in work_data.items():
-                            if key == "subjects":
-                                works_group[work_id]["subjects"].update(value)
-                            elif key not in work_keys:
-                                works_group[work_id][key] = value
-
-        # export group to json, converting subjects from set to list
-        works_group = {
-            work_id: {**data, "subjects": list(data.get("subjects", set()))}
-            for work_id, data in works_group.items()
-        }
-        os.makedirs(f"{S3_FOLDER}/works", exist_ok=True)
-        with open(f"{S3_FOLDER}/works/{first_n_id}.json", "w") as f:
-            json.dump(works_group, f)
-
-    # clear temporary batches
-    _remove_folder(f"{S3_FOLDER}/temp_batches")
+    save_shard(
+        storage,
+        "work_ids",
+        tqdm(
+            merge_runs(storage, list_runs(storage, "temp_batches/work_ids"), concat),
+            desc="Aggregating work IDs",
+        ),
+        "id_lists",
+        output_format,
+    )
+
+    # aggregate isbn 10 batches and save, recording them for the isbn index
+    isbn_keys = array("Q")
+    isbn_work_numbers = array("Q")
+    save_shard(
+        storage,
+        "isbn_10s",
+        record_isbns(
+            tqdm(
+                merge_runs(storage, list_runs(storage, "temp_batches/isbn_10"), last),
+                desc="Aggregating ISBN 10",
+            ),
+            isbn_keys,
+            isbn_work_numbers,
+        ),
+        "isbn_map",
+        output_format,
+    )
+
+    # aggregate isbn 13 batches and save, recording them for the isbn index
+    save_shard(
+        storage,
+        "isbn_13s",
+        record_isbns(
+            tqdm(
+                merge_runs(storage, list_runs(storage, "temp_batches/isbn_13"), last),
+                desc="Aggregating ISBN 13",
+            ),
+            isbn_keys,
+            isbn_work_numbers,
+        ),
+        "isbn_map",
+        output_format,
+    )
+
+    # save isbn index with isbn 10s normalized to isbn 13s
+    save_isbn_index(storage, INDEX_FOLDER, isbn_keys, isbn_work_numbers)
+
+    # index works by subject, genre, pages and year, merging their fields like the works'
+    _, n_terms = build_work_index(
+        storage,
+        tqdm(
+            merge_runs(
+                storage, list_runs(storage, "temp_batches/work_terms"), _merge_works
+            ),
+            desc="Indexing subjects",
+        ),
+        SUBJECT_INDEX_FOLDER,
+    )
+    count("indexed_terms", n_terms)
+
+    # aggregate works, writing each shard once all of its ids have been merged
+    finish_works()
+
+    # the shards are stored, clear temporary batches
+    storage.delete("temp_batches")
+
+
+def _flush_batch(
+    storage,
+    batch_editions,
+    batch_work_ids,
+    batch_isbn10,
+    batch_isbn13,
+    batch_count,
+    sharding=SHARDING,
+):
+    """Aggregate one batch into works, save it and reset the batch"""
+    batch_works = _aggregate_batch(batch_editions, batch_work_ids)
+    _save_batch(
+        storage,
+        batch_works,
+        batch_work_ids,
+        batch_isbn10,
+        batch_isbn13,
+        batch_count,
+        sharding,
+    )
+
+    # reset batch
+    batch_editions.clear()
+    batch_work_ids.clear()
+    batch_isbn10.clear()
+    batch_isbn13.clear()
 
 
 def process_in_batches(
-    data_path=OL_DATA, batch_size=BATCH_SIZE, sample_size=SAMPLE_SIZE
+    data_path=OL_DATA,
+    batch_size=BATCH_SIZE,
+    sample_size=SAMPLE_SIZE,
+    workers=WORKERS,
+    output_format=OUTPUT_FORMAT,
+    resume=False,
+    skip_if_current=False,
+    sharding=SHARDING,
+    aggregate_workers=AGGREGATE_WORKERS,
+    worker_memory=WORKER_MEMORY,
+    sample_fraction=None,
 ):
-    """Process OpenLibrary data in batches, main function"""
+    """Process OpenLibrary data in batches, main function
+
+    With workers > 1, lines are parsed by a pool of processes while this process
+    decompresses and batches. The output is identical to the serial path.
+    output_format selects JSON or columnar shards (see columnar.py), sharding prefix or
+    hash sharded works (see sharding.py). aggregate_workers > 1 merges works in a pool of
+    processes using up to worker_memory each, with the same output as merging them here.
+    resume=True continues from the last checkpointed batch of an interrupted run with
+    the same inputs, skip_if_current=True skips the stage if its outputs are current.
+    sample_fraction reads a uniform random sample of about that fraction of the lines
+    instead of the whole file (see gzip_index.py).
+    Batches and shards are written by a pool of threads, so parsing doesn't wait on them.
+    """
+    storage = open_storage(S3_FOLDER)
+    temp_folder = "temp_batches"
+    inputs = input_fingerprint(
+        data_path,
+        batch_size=batch_size,
+        sample_size=sample_size,
+        output_format=output_format,
+        sharding=sharding,
+        sample_fraction=sample_fraction,
+    )
+    if skip_if_current and stage_is_current(storage, STAGE, inputs):
+        print("Open Library editions are already processed, skipping")
+        return
+    start_stage(STAGE)
+    writer = AsyncWriter(storage)
 
     # define variables for batch
     batch_editions = dict()
@@ -260,22 +511,44 @@ def process_in_batches(
     # define variable for tracking number of samples collected
     total_processed = 0
 
-    # define variable for whether or not aggregation has occurred
-    aggregated = False
-
-    with gzip.open(data_path, "rb") as f:
-        with tqdm(f, desc="Procesing editions") as t:
-            for line in t:
-                key, edition = _parse_edition(line)
-
-                if key and edition:
+    # define variables for where to start reading and whether reading has finished
+    offset = 0
+    parsed = False
+
+    # define variable for counting lines read and lines rejected by the prefilter
+    counts = {"lines": 0, "prefiltered": 0}
+
+    # pick up from the last checkpoint, otherwise clear anything left by an earlier run
+    checkpoint = (
+        load_checkpoint(storage, temp_folder, STAGE, inputs) if resume else None
+    )
+    if checkpoint:
+        batch_count = checkpoint["batch_count"]
+        total_processed = checkpoint["total_processed"]
+        offset = checkpoint["offset"]
+        parsed = checkpoint["parsed"]
+        clear_partial_batches(storage, temp_folder, batch_count)
+        print(f"Resuming after {total_processed} books in {batch_count} batches")
+    else:
+        storage.delete(temp_folder)
+
+    if not parsed:
+        with open_gzip(data_path, sample_fraction) as f, timer("parse"):
+            # jumps through the file's gzip index if it has one, otherwise decompresses up
+            # to the offset without parsing
+            f.seek(offset)
+            start_offset = offset
+            with tqdm(desc="Procesing editions") as t:
+                for key, edition, offset in _iter_editions(
+                    f, t, counts, workers, offset
+                ):
                     work_id = edition.pop(
                         "work_id"
                     )  # get and remove work id from edition
                     batch_editions[key] = edition
                     batch_work_ids[work_id].append(key)
                     isbn_10 = edition.get("isbn_10")
-                    isbn_13 = edition.get("isbn_10")
+                    isbn_13 = edition.get("isbn_13")
                     if isbn_10:
                         batch_isbn10[isbn_10] = work_id
                     if isbn_13:
@@ -284,41 +557,82 @@ def process_in_batches(
                     if total_processed % 10000 == 0:
                         t.set_postfix(total_processed=total_processed)
 
-                    if (
-                        len(batch_editions) >= batch_size
-                        or total_processed == sample_size
-                    ):
-                        # aggregate into works and save
-                        batch_works = _aggregate_batch(batch_editions, batch_work_ids)
-                        _save_batch(
-                            batch_works,
-                            batch_work_ids,
-                            batch_isbn10,
-                            batch_isbn13,
-                            batch_count,
-                            WORK_ID_FIRST_N,
-                        )
-
-                        # reset batch
-                        batch_editions.clear()
-                        batch_work_ids.clear()
-                        batch_works.clear()
-                        batch_isbn10.clear()
-                        batch_isbn13.clear()
+                    # aggregate into works, save, and checkpoint
+                    if len(batch_editions) >= batch_size:
+                        with timer("save"):
+                            _flush_batch(
+                                writer,
+                                batch_editions,
+                                batch_work_ids,
+                                batch_isbn10,
+                                batch_isbn13,
+                                batch_count,
+                                sharding,
+                            )
                         batch_count += 1
+                        save_checkpoint(
+                            writer,
+                            temp_folder,
+                            STAGE,
+                            inputs,
+                            offset=offset,
+                            compressed_offset=f.fileobj.tell(),
+                            batch_count=batch_count,
+                            total_processed=total_processed,
+                            parsed=False,
+                        )
 
                     # if processed the number we want, break
                     if total_processed == sample_size:
-                        print(
-                            f"\nProcessed {total_processed} books in {batch_count} batches\n"
-                        )
-                        _aggregate_batches()
-                        aggregated = True
                         break
 
-    # aggregate batches in case sample size isn't reached
-    if not aggregated:
-        _aggregate_batches()
+            # save the last partial batch
+            if batch_editions:
+                with timer("save"):
+                    _flush_batch(
+                        writer,
+                        batch_editions,
+                        batch_work_ids,
+                        batch_isbn10,
+                        batch_isbn13,
+                        batch_count,
+                        sharding,
+                    )
+                batch_count += 1
+            count("bytes_read", offset - start_offset)
+            count("compressed_bytes_read", f.fileobj.tell())
+            add_counts(
+                {"lines": counts["lines"], "rejected.prefilter": counts["prefiltered"]}
+            )
+            save_checkpoint(
+                writer,
+                temp_folder,
+                STAGE,
+                inputs,
+                offset=offset,
+                compressed_offset=f.fileobj.tell(),
+                batch_count=batch_count,
+                total_processed=total_processed,
+                parsed=True,
+            )
+
+    print(
+        f"\nProcessed {total_processed} books in {batch_count} batches, "
+        f"prefilter rejected {counts['prefiltered']} of {counts['lines']} lines read\n"
+    )
+    count("accepted", total_processed)
+    with timer("aggregate"):
+        _aggregate_batches(
+            storage,
+            writer,
+            output_format=output_format,
+            sharding=sharding,
+            aggregate_workers=aggregate_workers,
+            worker_memory=worker_memory,
+        )
+    writer.close()
+    mark_stage_done(storage, STAGE, inputs)
+    end_stage()
 
 
 if __name__ == "__main__":
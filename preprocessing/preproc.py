@@ -1,5 +1,10 @@
 from amz_preproc import process_book_batches, process_review_batches
+from book_features import process_book_features
+from instrument import REPORTS_FOLDER, save_report, start_run
 from ol_preproc import process_in_batches
+from rating_matrix import process_rating_matrix
+from storage import open_storage
+from work_ratings import process_work_ratings
 
 BOOK_PATH = "data/amazon/meta_Books.jsonl.gz"
 REVIEWS_PATH = "data/amazon/Books.jsonl.gz"
@@ -11,14 +16,91 @@ AMZ_BOOKS = 10000000
 REVIEWS = 10000000
 
 BATCH_SIZE = 50000
+REVIEW_BATCH_SIZE = 500000  # ratings per reviews batch
 BOOK_ID_FIRST_N = 2
 REVIEW_ID_FIRST_N = 3
 WORK_ID_FIRST_N = 4
+OL_WORKERS = 8
+AGGREGATE_WORKERS = 4  # processes merging shards after each pass, see sharding.py
+OUTPUT_FORMAT = "json"  # "json" or "columnar"
+SHARDING = "prefix"  # "prefix" or "hash", see sharding.py
+# fraction of each dump to read as a uniform random sample (see gzip_index.py), None for all
+SAMPLE_FRACTION = None
+RESUME = True  # continue interrupted stages and skip stages whose outputs are current
+
+
+def run_ol_stage():
+    """The Open Library stage with the settings above, as run here and by benchmark.py"""
+    process_in_batches(
+        OL_DATA,
+        BATCH_SIZE,
+        OL_BOOKS,
+        OL_WORKERS,
+        OUTPUT_FORMAT,
+        RESUME,
+        RESUME,
+        SHARDING,
+        aggregate_workers=AGGREGATE_WORKERS,
+        sample_fraction=SAMPLE_FRACTION,
+    )
+
+
+def run_book_stage():
+    """The Amazon books stage with the settings above"""
+    process_book_batches(
+        BOOK_PATH,
+        BATCH_SIZE,
+        AMZ_BOOKS,
+        OUTPUT_FORMAT,
+        RESUME,
+        RESUME,
+        SHARDING,
+        aggregate_workers=AGGREGATE_WORKERS,
+        sample_fraction=SAMPLE_FRACTION,
+    )
+
+
+def run_review_stage():
+    """The Amazon reviews stage with the settings above"""
+    process_review_batches(
+        REVIEWS_PATH,
+        REVIEW_BATCH_SIZE,
+        REVIEWS,
+        OUTPUT_FORMAT,
+        RESUME,
+        RESUME,
+        SHARDING,
+        aggregate_workers=AGGREGATE_WORKERS,
+        sample_fraction=SAMPLE_FRACTION,
+    )
+
 
 if __name__ == "__main__":
-    print("PROCESSING OPEN LIBRARY BOOKS")
-    process_in_batches(OL_DATA, BATCH_SIZE, OL_BOOKS)
-    print(f"***********************************************\nPROCESSING AMAZON BOOKS")
-    process_book_batches(BOOK_PATH, BATCH_SIZE, AMZ_BOOKS)
-    print(f"***********************************************\nPROCESSING AMAZON REVIEWS")
-    process_review_batches(REVIEWS_PATH, BATCH_SIZE, REVIEWS)
+    # every run writes a report of counts, timings and memory, even if a stage fails
+    start_run()
+    try:
+        print("PROCESSING OPEN LIBRARY BOOKS")
+        run_ol_stage()
+        print(
+            f"***********************************************\nPROCESSING AMAZON BOOKS"
+        )
+        run_book_stage()
+        print(
+            f"***********************************************\nPROCESSING AMAZON REVIEWS"
+        )
+        run_review_stage()
+        print(
+            f"***********************************************\nBUILDING RATING MATRIX"
+        )
+        process_rating_matrix(skip_if_current=RESUME)
+        print(
+            f"***********************************************\nBUILDING BOOK FEATURES"
+        )
+        process_book_features(skip_if_current=RESUME)
+        print(
+            f"***********************************************\nJOINING RATINGS TO WORKS"
+        )
+        process_work_ratings(output_format=OUTPUT_FORMAT, skip_if_current=RESUME)
+    finally:
+        report_key = save_report(open_storage(S3_FOLDER), REPORTS_FOLDER)
+        print(f"Saved run report to {S3_FOLDER}/{report_key}")
@@ -0,0 +1,226 @@
+import json
+from array import array
+from collections import namedtuple
+
+import numpy as np
+from tqdm import tqdm
+
+from amz_preproc import REVIEW_STAGE, S3_FOLDER
+from checkpoint import mark_stage_done, stage_is_current, stage_record
+from columnar import load_shard
+from instrument import count, end_stage, start_stage, timer
+from sharding import shard_paths
+from storage import open_storage
+
+"""
+Sparse user x book rating matrix, built from the reviews shards
+- User ids and ASINs are interned to dense int32 indexes in sorted order, so an id's index
+  is a binary search away. Shards can come in any order (hash sharded reviews aren't in
+  user id order), so rows are sorted by user id once every shard has been loaded
+- Ratings are float32, stored as both CSR (rows are users) and CSC (columns are books):
+  indptr (int64), indices (int32) and data (float32) arrays for each
+- Every array is a .npy file, so the matrix is opened with mmap without parsing any JSON,
+  and the id mappings are .npy arrays of utf-8 encoded ids, position = index
+- A user who rated the same ASIN more than once keeps their last rating
+"""
+
+MATRIX_FOLDER = "rating_matrix"
+STAGE = "rating_matrix"  # name of this stage's stage record
+ARRAYS = [
+    "user_ids",
+    "asins",
+    "csr_indptr",
+    "csr_indices",
+    "csr_data",
+    "csc_indptr",
+    "csc_indices",
+    "csc_data",
+]
+
+RatingMatrix = namedtuple("RatingMatrix", ARRAYS + ["shape"])
+
+
+def _encode_ids(ids) -> np.ndarray:
+    """Encode ids as a fixed-width bytes array, a quarter of the size of a str array"""
+    return np.array([item_id.encode("utf-8") for item_id in ids], dtype=bytes)
+
+
+def _save_array(storage, key, values):
+    """Save an array as a .npy file in storage"""
+    with storage.open_write(key) as f:
+        np.save(f, values)
+
+
+def _to_csc(rows, indices, data, n_columns) -> tuple[np.ndarray, ...]:
+    """Transpose row-sorted (row, column, rating) arrays to CSC, rows stay sorted within
+    each column"""
+    order = np.argsort(indices, kind="stable")
+    csc_indptr = np.zeros(n_columns + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n_columns), out=csc_indptr[1:])
+    return csc_indptr, rows[order], data[order]
+
+
+def build_rating_matrix(storage, folder=MATRIX_FOLDER) -> tuple[int, int, int]:
+    """Stream every reviews shard once and save the rating matrix, returning its
+    (users, books, ratings) counts"""
+    user_ids = []
+    asin_index = dict()  # asin -> index in the order ASINs are first seen
+    indptr = array("q", [0])
+    indices = array("i")
+    data = array("f")
+
+    for path in tqdm(shard_paths(storage, "reviews"), desc="Building rating matrix"):
+        for user_id, reviews in load_shard(storage, path, "reviews").items():
+            # one row per user, later ratings of the same ASIN replace earlier ones
+            ratings = dict()
+            for review in reviews:
+                ratings.update(review)
+            count("duplicate_ratings", sum(len(r) for r in reviews) - len(ratings))
+
+            user_ids.append(user_id)
+            for asin, rating in ratings.items():
+                indices.append(asin_index.setdefault(asin, len(asin_index)))
+                data.append(rating)
+            indptr.append(len(indices))
+
+    if len(user_ids) >= 2**31 or len(asin_index) >= 2**31:
+        raise ValueError("Too many users or books for int32 indexes")
+
+    # relabel ASINs in sorted order, then sort each row by its new column indexes
+    with timer("sort"):
+        indptr = np.frombuffer(indptr, dtype=np.int64)
+        indices = np.frombuffer(indices, dtype=np.int32)
+        data = np.frombuffer(data, dtype=np.float32)
+        # hash sharded reviews aren't in user id order, rows are sorted by user id below
+        user_ids = _encode_ids(user_ids)
+        user_order = np.argsort(user_ids, kind="stable")
+        user_ids = user_ids[user_order]
+        if np.any(user_ids[1:] == user_ids[:-1]):
+            raise ValueError("A user id is in more than one reviews shard")
+        user_rank = np.empty(len(user_order), dtype=np.int32)
+        user_rank[user_order] = np.arange(len(user_order), dtype=np.int32)
+        asins = _encode_ids(asin_index)
+        order = np.argsort(asins, kind="stable")
+        rank = np.empty(len(order), dtype=np.int32)
+        rank[order] = np.arange(len(order), dtype=np.int32)
+        asins = asins[order]
+        indices = rank[indices]
+
+        rows = user_rank[np.repeat(np.arange(len(user_ids)), np.diff(indptr))]
+        row_order = np.lexsort((indices, rows))
+        rows = rows[row_order]
+        indices = indices[row_order]
+        data = data[row_order]
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(user_ids)), out=indptr[1:])
+
+        csc_indptr, csc_indices, csc_data = _to_csc(rows, indices, data, len(asins))
+
+    arrays = {
+        "user_ids": user_ids,
+        "asins": asins,
+        "csr_indptr": indptr,
+        "csr_indices": indices,
+        "csr_data": data,
+        "csc_indptr": csc_indptr,
+        "csc_indices": csc_indices,
+        "csc_data": csc_data,
+    }
+    with timer("save"):
+        for name, values in arrays.items():
+            _save_array(storage, f"{folder}/{name}.npy", values)
+        shape = [len(user_ids), len(asins)]
+        storage.put(
+            f"{folder}/meta.json",
+            json.dumps({"shape": shape, "ratings": len(data)}).encode("utf-8"),
+        )
+
+    return len(user_ids), len(asins), len(data)
+
+
+def open_rating_matrix(storage, folder=MATRIX_FOLDER) -> RatingMatrix:
+    """Memory-map a saved rating matrix"""
+    meta = json.loads(storage.get(f"{folder}/meta.json"))
+    arrays = {
+        name: np.load(storage.local_path(f"{folder}/{name}.npy"), mmap_mode="r")
+        for name in ARRAYS
+    }
+    return RatingMatrix(**arrays, shape=tuple(meta["shape"]))
+
+
+def _find(ids, item_id) -> int:
+    """Index of an id in a sorted id array, -1 if it isn't there"""
+    key = item_id.encode("utf-8")
+    position = int(np.searchsorted(ids, key))
+    if position < len(ids) and ids[position] == key:
+        return position
+    return -1
+
+
+def user_index(matrix, user_id) -> int:
+    """Row index of a user id, -1 if the user has no ratings"""
+    return _find(matrix.user_ids, user_id)
+
+
+def book_index(matrix, asin) -> int:
+    """Column index of an ASIN, -1 if the book has no ratings"""
+    return _find(matrix.asins, asin)
+
+
+def user_ratings(matrix, user) -> tuple[np.ndarray, np.ndarray]:
+    """(book indexes, ratings) of the user at an index"""
+    start, end = matrix.csr_indptr[user], matrix.csr_indptr[user + 1]
+    return matrix.csr_indices[start:end], matrix.csr_data[start:end]
+
+
+def book_ratings(matrix, book) -> tuple[np.ndarray, np.ndarray]:
+    """(user indexes, ratings) of the book at an index"""
+    start, end = matrix.csc_indptr[book], matrix.csc_indptr[book + 1]
+    return matrix.csc_indices[start:end], matrix.csc_data[start:end]
+
+
+def gather_rows(matrix, users) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(position in users, book index, rating) arrays of every rating of a batch of users"""
+    starts = matrix.csr_indptr[users]
+    lengths = matrix.csr_indptr[np.asarray(users) + 1] - starts
+    owners = np.repeat(np.arange(len(lengths)), lengths)
+    first = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.arange(len(owners)) - first + np.repeat(starts, lengths)
+    return owners, matrix.csr_indices[positions], matrix.csr_data[positions]
+
+
+def to_scipy(matrix, layout="csr"):
+    """The matrix as a scipy.sparse matrix (needs scipy), sharing the memory-mapped arrays"""
+    from scipy.sparse import csc_matrix, csr_matrix
+
+    if layout == "csr":
+        arrays = (matrix.csr_data, matrix.csr_indices, matrix.csr_indptr)
+        return csr_matrix(arrays, shape=matrix.shape, copy=False)
+    arrays = (matrix.csc_data, matrix.csc_indices, matrix.csc_indptr)
+    return csc_matrix(arrays, shape=matrix.shape, copy=False)
+
+
+def process_rating_matrix(folder=MATRIX_FOLDER, skip_if_current=False):
+    """Build the rating matrix from the reviews shards, main function
+
+    skip_if_current=True skips the stage if the matrix was built from the current reviews.
+    """
+    storage = open_storage(S3_FOLDER)
+    inputs = {"folder": folder, "upstream": stage_record(storage, REVIEW_STAGE)}
+    if skip_if_current and stage_is_current(storage, STAGE, inputs):
+        print("Rating matrix is already built, skipping")
+        return
+    start_stage(STAGE)
+
+    with timer("build"):
+        n_users, n_books, n_ratings = build_rating_matrix(storage, folder)
+    print(f"\nBuilt a {n_users} x {n_books} rating matrix with {n_ratings} ratings\n")
+    count("users", n_users)
+    count("books", n_books)
+    count("ratings", n_ratings)
+    mark_stage_done(storage, STAGE, inputs)
+    end_stage()
+
+
+if __name__ == "__main__":
+    process_rating_matrix()
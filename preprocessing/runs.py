@@ -0,0 +1,153 @@
+import heapq
+import json
+import os
+from itertools import groupby
+
+"""
+Spill-and-merge engine for batch aggregation
+- Each batch is spilled as one run: a file of (key, value) JSON lines sorted by key
+- Runs are k-way merged in one sequential pass, so only one key (or one shard) is in memory at a time
+- Keys that share a shard are contiguous in sorted order (see sharding.py), so shards can be written as the merge goes
+- A range of sort keys can be merged on its own by binary searching each run file for where the range starts,
+  so ranges of shards can be merged in parallel
+"""
+
+
+def _item_key(item):
+    """Sort key for (key, value) pairs"""
+    return item[0]
+
+
+def write_run(storage, key, items, order=None):
+    """Write (key, value) pairs to a run in storage (see storage.py), sorted by key or by
+    an order function of the pairs
+
+    The run is stored in one put, so a run only exists once it's complete.
+    """
+    items = sorted(items, key=order or _item_key)
+    lines = [json.dumps([k, value]) + "\n" for k, value in items]
+    storage.put(key, "".join(lines).encode("utf-8"))
+
+
+def _read_run(storage, key):
+    """Stream the (key, value) pairs of a run"""
+    for line in storage.iter_lines(key):
+        k, value = json.loads(line)
+        yield k, value
+
+
+def list_runs(storage, prefix) -> list[str]:
+    """List the runs under a prefix, in the order their batches were written"""
+    keys = [
+        key
+        for key in storage.list(prefix)
+        if key.rsplit("/", 1)[-1].startswith("batch_") and key.endswith(".jsonl")
+    ]
+    return sorted(keys, key=lambda key: int(key.rsplit("_", 1)[1].split(".")[0]))
+
+
+def merge_runs(storage, keys, combine, order=None):
+    """Stream (key, value) pairs from sorted runs in key order, or the order function the
+    runs were written with
+
+    Values that share a key are passed to combine as a list, in the order of the runs
+    they came from (heapq.merge is stable), and combine returns the merged value.
+    """
+    runs = [_read_run(storage, key) for key in keys]
+    merged = heapq.merge(*runs, key=order or _item_key)
+    for key, group in groupby(merged, key=_item_key):
+        yield key, combine([value for _, value in group])
+
+
+def _sort_key(key, order):
+    """Sort key of a run key, under an order function of (key, value) pairs"""
+    return (order or _item_key)((key, None))
+
+
+def _seek_run(f, bound, order):
+    """Move a run file to the start of its first line whose sort key isn't below bound"""
+    low, high = 0, os.fstat(f.fileno()).st_size
+    while low < high:
+        middle = (low + high) // 2
+        # the first line that starts at or after middle
+        f.seek(middle - 1 if middle else 0)
+        if middle:
+            f.readline()
+        line = f.readline()
+        if not line or _sort_key(json.loads(line)[0], order) >= bound:
+            high = middle
+        else:
+            low = middle + 1
+    f.seek(low - 1 if low else 0)
+    if low:
+        f.readline()
+
+
+def _read_run_range(path, order, lower, upper):
+    """Stream the (key, value) pairs of a local run file whose sort keys are in
+    [lower, upper), None for no bound"""
+    with open(path, "rb") as f:
+        if lower is not None:
+            _seek_run(f, lower, order)
+        for line in f:
+            k, value = json.loads(line)
+            if upper is not None and _sort_key(k, order) >= upper:
+                break
+            yield k, value
+
+
+def merge_run_range(paths, combine, order=None, lower=None, upper=None):
+    """Like merge_runs, for local run files and only the keys whose sort keys are in
+    [lower, upper)"""
+    runs = [_read_run_range(path, order, lower, upper) for path in paths]
+    merged = heapq.merge(*runs, key=order or _item_key)
+    for key, group in groupby(merged, key=_item_key):
+        yield key, combine([value for _, value in group])
+
+
+def sample_run_keys(path, n) -> list[str]:
+    """Keys of the lines at about n evenly spaced offsets of a local run file"""
+    keys = []
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        for i in range(n):
+            f.seek(size * i // n)
+            if i:
+                f.readline()
+            line = f.readline()
+            if line:
+                keys.append(json.loads(line)[0])
+    return keys
+
+
+def write_json_stream(storage, key, items) -> int:
+    """Write (key, value) pairs as one JSON object without holding it in memory, same format as json.dump,
+    returning its size in bytes"""
+    with storage.open_write(key) as f:
+        f.write(b"{")
+        for i, (k, value) in enumerate(items):
+            if i:
+                f.write(b", ")
+            f.write(f"{json.dumps(k)}: {json.dumps(value)}".encode("utf-8"))
+        f.write(b"}")
+        return f.tell()
+
+
+def concat(values):
+    """Combine values by concatenating lists"""
+    return [item for value in values for item in value]
+
+
+def last(values):
+    """Combine values by keeping the one from the latest run"""
+    return values[-1]
+
+
+def first_fields(values):
+    """Combine dicts by keeping the first value seen for each field"""
+    merged = dict()
+    for value in values:
+        for key, field in value.items():
+            if key not in merged:
+                merged[key] = field
+    return merged
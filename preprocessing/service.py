@@ -0,0 +1,354 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import traceback
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from amz_preproc import S3_FOLDER
+from candidates import CANDIDATES_FOLDER, CandidateStore
+from group_aggregation import METHODS
+from rating_matrix import MATRIX_FOLDER, book_index, user_index
+from subject_index import SUBJECT_INDEX_FOLDER, SubjectIndex
+
+"""
+HTTP service for group recommendations, on the candidate lists (see candidates.py)
+- The rating matrix and candidate lists are memory-mapped once at startup, and every
+  request is answered from them. Scoring runs on one thread beside the event loop, so
+  requests are parsed and answered while a group is scored, and the store is never used
+  by two threads at once
+- POST /recommend takes {"members": [user ids], "ratings": {name: {asin: rating}}, "method",
+  "k", "exclude_rated"}: members are users in the rating matrix, and each uploaded rating
+  list is a guest whose neighbours are found from their ratings (see CandidateStore.guest).
+  It returns {"recommendations": [{"asin", "score"}, ...]}, best first. An optional
+  "filter" is a subject index query (see subject_index.py), e.g. ["and", "subject:fantasy",
+  ["pages", null, 400], ["year", 2000, null]], and only books of the works it matches are
+  scored
+- Identical requests (the same members in any order, the same uploaded ratings and options)
+  share a key. While one is being scored, the others wait for its result instead of
+  scoring it again (or score it themselves if that request is cancelled), and results are
+  kept in an LRU cache of CACHE_ENTRIES
+- POST /ratings takes {"ratings": {user id: {asin: rating}}} and adds them to the candidate
+  store. Cached results are invalidated for every group with a member (or a guest's
+  neighbour) whose predictions the ratings change, and results being scored meanwhile
+  aren't cached
+- GET /health and GET /stats report the store's size and the cache's hits, misses and
+  coalesced requests
+"""
+
+HOST = "127.0.0.1"
+PORT = 8080
+CACHE_ENTRIES = 10000  # results kept in the cache
+MAX_BODY = 2**20  # largest request body accepted, in bytes
+MAX_K = 100  # most recommendations returned per request
+K = 10
+METHOD = "copeland"
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Content Too Large",
+    500: "Internal Server Error",
+}
+
+
+class RecommendationService:
+    """Group recommendations from a candidate store, with request coalescing and a result
+    cache"""
+
+    def __init__(
+        self,
+        location=S3_FOLDER,
+        folder=CANDIDATES_FOLDER,
+        matrix_folder=MATRIX_FOLDER,
+        cache_entries=CACHE_ENTRIES,
+    ):
+        self.store = CandidateStore(location, folder, matrix_folder)
+        self.cache_entries = cache_entries
+        self.executor = ThreadPoolExecutor(1)
+        self.cache = OrderedDict()  # key -> (result, users it depends on)
+        # user -> keys of the cached results that depend on them
+        self.dependents = defaultdict(set)
+        self.in_flight = dict()  # key -> future of the result being scored
+        # counts rating updates, results scored across one aren't cached
+        self.version = 0
+        self.stats = Counter()
+        # the subject index filters recommendations, if the pipeline built one
+        self.subjects = None
+        if self.store.storage.exists(f"{SUBJECT_INDEX_FOLDER}/meta.json"):
+            self.subjects = SubjectIndex(self.store.storage)
+            self.book_works = self.subjects.book_works(self.store.matrix.asins)
+
+    def _parse_group(self, body) -> tuple:
+        """Members, guests and options of a recommendation request, and its key"""
+        members = sorted({self._user(user_id) for user_id in body.get("members", [])})
+        guests = []
+        for name, ratings in sorted(body.get("ratings", {}).items()):
+            books = [book_index(self.store.matrix, asin) for asin in ratings]
+            rated = sorted(
+                (book, float(rating))
+                for book, rating in zip(books, ratings.values())
+                if book >= 0
+            )
+            if not rated:
+                raise ValueError(f"None of {name}'s rated books are known")
+            guests.append(rated)
+        if not members and not guests:
+            raise ValueError("A group needs members or uploaded ratings")
+
+        method = body.get("method", METHOD)
+        if method not in METHODS:
+            raise ValueError(f"Unknown method {method}, use one of {METHODS}")
+        k = int(body.get("k", K))
+        if not 0 < k <= MAX_K:
+            raise ValueError(f"k has to be between 1 and {MAX_K}")
+        exclude_rated = bool(body.get("exclude_rated", True))
+        query = body.get("filter")
+        if query is not None and self.subjects is None:
+            raise ValueError("There's no subject index to filter by")
+
+        options = [members, sorted(guests), method, k, exclude_rated, query]
+        key = hashlib.sha1(json.dumps(options).encode("utf-8")).hexdigest()
+        return members, guests, method, k, exclude_rated, query, key
+
+    def _user(self, user_id) -> int:
+        user = user_index(self.store.matrix, str(user_id))
+        if user < 0:
+            raise ValueError(f"Unknown user {user_id}")
+        return user
+
+    def _recommend(
+        self, members, guests, method, k, exclude_rated, query
+    ) -> tuple[dict, set]:
+        """Score a group, returning the result and the users it depends on"""
+        allowed = None
+        if query is not None:
+            works = self.subjects.query(query)
+            allowed = self.subjects.book_mask(self.book_works, works)
+        guests = [
+            self.store.guest([book for book, _ in rated], [value for _, value in rated])
+            for rated in guests
+        ]
+        recommendations = self.store.recommend(
+            members, method, k, exclude_rated, guests, allowed
+        )
+        users = set(members)
+        for guest in guests:
+            users.update(guest["neighbours"].tolist())
+        result = {
+            "recommendations": [
+                {"asin": asin, "score": score} for asin, score in recommendations
+            ]
+        }
+        return result, users
+
+    async def recommend(self, body) -> dict:
+        """Recommendations for a group, from the cache, a request being scored for the same
+        group or by scoring it"""
+        members, guests, method, k, exclude_rated, query, key = self._parse_group(body)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats["hits"] += 1
+            return self.cache[key][0]
+        if key in self.in_flight:
+            self.stats["coalesced"] += 1
+            future = self.in_flight[key]
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this request was cancelled
+                # the request scoring the group was cancelled, so score it here instead
+                return await self.recommend(body)
+
+        self.stats["misses"] += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.in_flight[key] = future
+        version = self.version
+        try:
+            result, users = await loop.run_in_executor(
+                self.executor,
+                self._recommend,
+                members,
+                guests,
+                method,
+                k,
+                exclude_rated,
+                query,
+            )
+        except Exception as error:
+            future.set_exception(error)
+            future.exception()  # raised here, so waiting requests needn't retrieve it
+            raise
+        except BaseException:
+            future.cancel()  # this request was cancelled, the waiting ones score it instead
+            raise
+        finally:
+            del self.in_flight[key]
+
+        if version == self.version:
+            self._cache(key, result, users)
+        future.set_result(result)
+        return result
+
+    def _cache(self, key, result, users):
+        self.cache[key] = (result, users)
+        for user in users:
+            self.dependents[user].add(key)
+        while len(self.cache) > self.cache_entries:
+            old_key, (_, old_users) = self.cache.popitem(last=False)
+            self._forget(old_key, old_users)
+
+    def _forget(self, key, users):
+        for user in users:
+            self.dependents[user].discard(key)
+            if not self.dependents[user]:
+                del self.dependents[user]
+
+    def _add_ratings(self, users, books, ratings) -> np.ndarray:
+        """Add ratings to the store, returning the users whose predictions changed"""
+        affected = self.store.affected_users(users)
+        self.store.add_ratings(users, books, ratings)
+        return affected
+
+    async def add_ratings(self, body) -> dict:
+        """Add users' new ratings and invalidate the results they change"""
+        users, books, ratings = [], [], []
+        for user_id, user_ratings in body.get("ratings", {}).items():
+            user = self._user(user_id)
+            for asin, rating in user_ratings.items():
+                book = book_index(self.store.matrix, asin)
+                if book < 0:
+                    raise ValueError(f"Unknown book {asin}")
+                users.append(user)
+                books.append(book)
+                ratings.append(float(rating))
+        if not users:
+            raise ValueError("No ratings to add")
+
+        loop = asyncio.get_running_loop()
+        affected = await loop.run_in_executor(
+            self.executor, self._add_ratings, users, books, ratings
+        )
+        self.version += 1
+        invalidated = 0
+        for user in affected.tolist():
+            for key in list(self.dependents.get(user, ())):
+                self._forget(key, self.cache.pop(key)[1])
+                invalidated += 1
+        self.stats["invalidated"] += invalidated
+        return {"affected_users": len(affected), "invalidated": invalidated}
+
+    def health(self) -> dict:
+        users, books = self.store.matrix.shape
+        return {"status": "ok", "users": users, "books": books}
+
+    def report(self) -> dict:
+        return {
+            **self.stats,
+            "cached": len(self.cache),
+            "in_flight": len(self.in_flight),
+            "updates": self.store.n_updates,
+        }
+
+    async def handle(self, method, path, body) -> tuple[int, dict]:
+        """Route a request, returning the response's status and JSON body"""
+        routes = {
+            "/recommend": ("POST", self.recommend),
+            "/ratings": ("POST", self.add_ratings),
+            "/health": ("GET", self.health),
+            "/stats": ("GET", self.report),
+        }
+        if path not in routes:
+            return 404, {"error": f"No route {path}"}
+        route_method, handler = routes[path]
+        if method != route_method:
+            return 405, {"error": f"{path} takes {route_method}"}
+        if method == "GET":
+            return 200, handler()
+
+        try:
+            return 200, await handler(json.loads(body or b"{}"))
+        except (ValueError, TypeError, AttributeError) as error:
+            return 400, {"error": str(error)}
+
+    async def serve_connection(self, reader, writer):
+        """Answer requests on one connection until the client closes it"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in [b"\r\n", b"\n", b""]:
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                keep_alive = version == "HTTP/1.1" and (
+                    headers.get("connection", "").lower() != "close"
+                )
+                if length > MAX_BODY:
+                    status, response = 413, {"error": f"Bodies over {MAX_BODY} bytes"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    try:
+                        status, response = await self.handle(
+                            method, target.split("?")[0], body
+                        )
+                    except Exception:
+                        traceback.print_exc()
+                        status, response = 500, {"error": "Internal error"}
+
+                data = json.dumps(response).encode("utf-8")
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    ).encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # the client went away or sent something that isn't HTTP
+        finally:
+            writer.close()
+
+
+async def serve(service, host=HOST, port=PORT):
+    server = await asyncio.start_server(service.serve_connection, host, port)
+    print(f"Serving group recommendations on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve group recommendations over HTTP"
+    )
+    parser.add_argument("--location", default=S3_FOLDER)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--cache-entries", type=int, default=CACHE_ENTRIES)
+    args = parser.parse_args()
+
+    service = RecommendationService(args.location, cache_entries=args.cache_entries)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
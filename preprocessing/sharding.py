@@ -0,0 +1,320 @@
+import json
+import os
+import zlib
+from itertools import groupby
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+from columnar import save_shard
+from instrument import add_counts, start_run, take_counts
+from runs import merge_run_range, merge_runs, sample_run_keys
+from storage import open_storage
+
+"""
+How sharded outputs (works, amz_books, reviews) are split into files
+- "prefix" sharding keeps ids that share their first n characters together, e.g.
+  works/OL12.json holds every work id starting with OL12. Shards are in id order, but
+  their sizes follow the ids' leading digits
+- "hash" sharding puts an id in one of HASH_SLOTS slots by a stable hash (crc32) of the id,
+  and each shard holds an equal range of slots. Runs are sorted by (slot, id), so the
+  merged stream reaches each shard's ids contiguously and shards are still written one at a
+  time. The number of shards is the power of two that puts the runs' total size per shard
+  within a factor of sqrt(2) of TARGET_SHARD_BYTES, so shard sizes stay the same at every
+  data size
+- Shards can be merged by a pool of workers (write_shards_parallel), each one merging a range
+  of shards from every run, so the caller can do other work meanwhile. Ranges are split at
+  shard boundaries, evenly spaced hash shards or prefixes sampled from the runs, and each
+  worker writes exactly the shards the serial merge would, so outputs are byte-identical.
+  Workers hand back their counts of files written, so run reports match the serial merge's
+- Every sharded folder gets a manifest.json, written once its shards are stored, with the
+  sharding, each shard's record count and byte size, and the totals. Readers find an id's
+  shard, and the list of shards, through the manifest
+"""
+
+SHARDING_MODES = ["prefix", "hash"]
+SHARDING = "prefix"  # "prefix" or "hash"
+HASH_SLOTS = 2**16  # hash slots ids are sorted by, shards are equal ranges of them
+TARGET_SHARD_BYTES = 2**24  # size hash shards are aimed at, in bytes of runs
+MANIFEST_FILE = "manifest.json"
+AGGREGATE_WORKERS = 1  # processes merging shards, 1 merges them in the calling process
+WORKER_MEMORY = 2**30  # bytes each merging process may use, sets how runs are split
+# memory a range of runs takes when merged, relative to its bytes in runs, about
+EXPANSION = 8
+SAMPLES = 64  # keys sampled from each run to split prefix sharded runs into ranges
+
+
+def hash_slot(item_id) -> int:
+    """Stable hash slot of an id"""
+    return zlib.crc32(item_id.encode("utf-8")) % HASH_SLOTS
+
+
+def _hashed_item_key(item):
+    """Sort key for (key, value) pairs in hash order"""
+    return hash_slot(item[0]), item[0]
+
+
+def run_order(sharding):
+    """Sort key for the (key, value) pairs of runs that are merged into sharded outputs,
+    None for key order"""
+    if sharding == "hash":
+        return _hashed_item_key
+    if sharding == "prefix":
+        return None
+    raise ValueError(f"Unknown sharding {sharding}, use one of {SHARDING_MODES}")
+
+
+def shard_count(total_bytes, target=TARGET_SHARD_BYTES) -> int:
+    """Number of hash shards for outputs of about total_bytes, the power of two that puts
+    each shard within a factor of sqrt(2) of target"""
+    n = 1
+    while n < HASH_SLOTS and total_bytes / n > target * 2**0.5:
+        n *= 2
+    return n
+
+
+def _hash_shard_name(shard, n_shards) -> str:
+    """File name (without extension) of a hash shard"""
+    return f"h{shard:0{len(str(n_shards - 1))}d}"
+
+
+def shard_name(item_id, manifest) -> str:
+    """Name of the shard an id belongs in, following a manifest"""
+    if manifest["sharding"] == "hash":
+        n_shards = manifest["shards"]
+        shard = hash_slot(item_id) // (HASH_SLOTS // n_shards)
+        return _hash_shard_name(shard, n_shards)
+    return item_id[: manifest["first_n"]]
+
+
+def _new_manifest(sharding, first_n, n_shards, output_format) -> dict:
+    """Manifest of a folder before its shards are written"""
+    run_order(sharding)  # checks the sharding
+    return {
+        "sharding": sharding,
+        "first_n": first_n if sharding == "prefix" else None,
+        "shards": n_shards if sharding == "hash" else None,
+        "format": output_format,
+    }
+
+
+def _save_shards(storage, folder, items, dataset, output_format, manifest) -> dict:
+    """Save merged (id, value) pairs as the shards of folder, returning each shard's
+    {"records", "bytes"}"""
+    files = dict()
+    for name, group in groupby(items, key=lambda item: shard_name(item[0], manifest)):
+        shard = list(group)
+        n_bytes = save_shard(storage, f"{folder}/{name}", shard, dataset, output_format)
+        files[name] = {"records": len(shard), "bytes": n_bytes}
+    return files
+
+
+def write_shards(
+    storage,
+    writer,
+    folder,
+    items,
+    dataset,
+    output_format,
+    sharding=SHARDING,
+    first_n=None,
+    n_shards=1,
+    desc=None,
+) -> dict:
+    """Save merged (id, value) pairs (sorted by run_order(sharding)) as shards of folder
+    through writer, then the folder's manifest to storage once they're stored, returning
+    the manifest
+
+    first_n is the prefix length for prefix sharding, n_shards the shard count for hash
+    sharding (see shard_count).
+    """
+    manifest = _new_manifest(sharding, first_n, n_shards, output_format)
+
+    # shards left from an earlier run (e.g. with other sharding) would be stale
+    storage.delete(folder)
+
+    files = _save_shards(
+        writer, folder, tqdm(items, desc=desc), dataset, output_format, manifest
+    )
+    writer.flush()
+    return save_manifest(storage, folder, manifest, files)
+
+
+def _range_bounds(paths, manifest, n_ranges) -> list:
+    """Sort keys where ranges of shards start, the first range starting at None"""
+    if manifest["sharding"] == "hash":
+        n_shards = manifest["shards"]
+        starts = sorted({n_shards * i // n_ranges for i in range(1, n_ranges)} - {0})
+        return [None] + [(shard * (HASH_SLOTS // n_shards), "") for shard in starts]
+
+    # every prefix is where a shard starts, sampled prefixes split the runs about evenly
+    prefixes = sorted(
+        key[: manifest["first_n"]]
+        for path in paths
+        for key in sample_run_keys(path, SAMPLES)
+    )
+    starts = {prefixes[len(prefixes) * i // n_ranges] for i in range(1, n_ranges)}
+    return [None] + sorted(starts - {prefixes[0]} if prefixes else set())
+
+
+def _write_shard_range(task) -> tuple[dict, dict]:
+    """Merge one range of shards from local run files and save them, in a worker,
+    returning their {"records", "bytes"} and the worker's counts (files written)"""
+    location, folder, paths, combine, dataset, output_format, manifest, bounds = task
+    items = merge_run_range(paths, combine, run_order(manifest["sharding"]), *bounds)
+    files = _save_shards(
+        open_storage(location), folder, items, dataset, output_format, manifest
+    )
+    return files, take_counts()
+
+
+def write_shards_parallel(
+    location,
+    folder,
+    run_keys,
+    combine,
+    dataset,
+    output_format,
+    sharding=SHARDING,
+    first_n=None,
+    n_shards=1,
+    workers=AGGREGATE_WORKERS,
+    worker_memory=WORKER_MEMORY,
+    desc=None,
+):
+    """Start merging runs (sorted by run_order(sharding)) with combine into shards of folder
+    in a pool of workers, returning a function that waits for them, saves the folder's
+    manifest and returns it
+
+    The shards and manifest are the same as write_shards writes from merge_runs. combine
+    has to be a module level function, so it can be sent to the workers.
+    """
+    storage = open_storage(location)
+    manifest = _new_manifest(sharding, first_n, n_shards, output_format)
+    storage.delete(folder)
+
+    # workers read the runs from local files, downloaded once here for remote storage
+    paths = [storage.local_path(key) for key in run_keys]
+    run_bytes = sum(os.path.getsize(path) for path in paths)
+    n_ranges = max(workers, -(-run_bytes * EXPANSION // worker_memory))
+    bounds = _range_bounds(paths, manifest, n_ranges)
+    tasks = [
+        (location, folder, paths, combine, dataset, output_format, manifest, range_)
+        for range_ in zip(bounds, bounds[1:] + [None])
+    ]
+
+    # workers start with empty counts, so they only hand back their own
+    pool = Pool(workers, initializer=start_run)
+    results = pool.imap(_write_shard_range, tasks)
+
+    def finish() -> dict:
+        try:
+            files = dict()
+            for range_files, counts in tqdm(results, total=len(tasks), desc=desc):
+                files.update(range_files)
+                add_counts(counts)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return save_manifest(storage, folder, manifest, files)
+
+    return finish
+
+
+def aggregate_shards(
+    storage,
+    writer,
+    location,
+    folder,
+    run_keys,
+    combine,
+    dataset,
+    output_format,
+    sharding=SHARDING,
+    first_n=None,
+    workers=AGGREGATE_WORKERS,
+    worker_memory=WORKER_MEMORY,
+    desc=None,
+):
+    """Start aggregating runs into shards of folder, returning a function that finishes
+    them and returns the folder's manifest
+
+    With workers > 1 the shards are merged by a pool of processes while the caller does
+    other work (see write_shards_parallel), otherwise they're merged when the function is
+    called. Either way the shards are the same.
+    """
+    n_shards = shard_count(sum(storage.size(key) for key in run_keys))
+    if workers > 1:
+        return write_shards_parallel(
+            location,
+            folder,
+            run_keys,
+            combine,
+            dataset,
+            output_format,
+            sharding,
+            first_n,
+            n_shards,
+            workers,
+            worker_memory,
+            desc,
+        )
+
+    def finish() -> dict:
+        items = merge_runs(storage, run_keys, combine, run_order(sharding))
+        return write_shards(
+            storage,
+            writer,
+            folder,
+            items,
+            dataset,
+            output_format,
+            sharding,
+            first_n,
+            n_shards,
+            desc,
+        )
+
+    return finish
+
+
+def save_manifest(storage, folder, manifest, files) -> dict:
+    """Add each shard's {"records", "bytes"} in files and the totals to a manifest and save
+    it, once every shard is stored"""
+    manifest["records"] = sum(file["records"] for file in files.values())
+    manifest["bytes"] = sum(file["bytes"] for file in files.values())
+    manifest["files"] = files
+    storage.put(f"{folder}/{MANIFEST_FILE}", json.dumps(manifest).encode("utf-8"))
+    return manifest
+
+
+def load_manifest(storage, folder) -> dict:
+    """Load a folder's manifest, None if it was sharded before manifests were written"""
+    key = f"{folder}/{MANIFEST_FILE}"
+    if not storage.exists(key):
+        return None
+    return json.loads(storage.get(key))
+
+
+def folder_bytes(storage, folder) -> int:
+    """Total bytes of a folder's shards, from its manifest or by listing the folder"""
+    manifest = load_manifest(storage, folder)
+    if manifest is not None:
+        return manifest["bytes"]
+    return sum(storage.size(key) for key in storage.list(folder))
+
+
+def shard_paths(storage, folder) -> list[str]:
+    """Paths (without extension) of the shards in a folder, from its manifest or by listing
+    the folder if it doesn't have one"""
+    manifest = load_manifest(storage, folder)
+    if manifest is not None:
+        return [f"{folder}/{name}" for name in sorted(manifest["files"])]
+
+    paths = set()
+    for key in storage.list(folder):
+        path, _, extension = key.rpartition(".")
+        if extension in ["json", "npz"]:
+            paths.add(path)
+    return sorted(paths)
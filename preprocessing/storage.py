@@ -0,0 +1,332 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from instrument import count_written
+
+"""
+Storage backends for the mock_s3 outputs
+- Every backend stores bytes under "/"-separated keys (e.g. "works/OL12.json") with the same
+  operations: put, get, open, iter_lines, open_write (streaming writes), list, exists,
+  delete (a key, or everything under a prefix like temp_batches) and local_path
+- LocalStorage is a folder on disk, every write goes to a temporary file that's moved into place
+- S3Storage is a bucket on any S3-compatible server through boto3, large files are uploaded
+  in parts. Point endpoint_url at a local stand-in server (e.g. moto_server or MinIO) to test it
+- AsyncWriter wraps a backend so writes run on a bounded thread pool while parsing continues
+- open_storage("mock_s3") gives a LocalStorage, open_storage("s3://bucket/prefix") an S3Storage
+  using the S3_ENDPOINT_URL environment variable as its endpoint if it's set
+"""
+
+MULTIPART_THRESHOLD = 64 * 1024 * 1024  # files larger than this are uploaded in parts
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+WRITE_WORKERS = 4  # threads writing for an AsyncWriter
+MAX_PENDING_WRITES = 32  # writes an AsyncWriter queues before put waits
+
+_storages = dict()
+
+
+class _Writer:
+    """File open for writing that hands itself to finish when it's closed"""
+
+    def __init__(self, file, finish):
+        self.file = file
+        self.finish = finish
+        self.closed = False
+
+    def __getattr__(self, name):
+        # tell, seek, flush etc. are the underlying file's, for np.save and zipfile
+        return getattr(self.file, name)
+
+    def write(self, data) -> int:
+        return self.file.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.finish(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # a failed write is dropped, so a key never holds a partial file
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            self.file.close()
+
+
+class Storage:
+    """Operations shared by every backend, each one implements _put and the reads"""
+
+    def _put(self, key, data):
+        raise NotImplementedError
+
+    def put(self, key, data):
+        """Store bytes under key, replacing anything there"""
+        self._put(key, data)
+        count_written(len(data))
+
+    def put_after(self, key, data):
+        """Store bytes under key after every earlier write, the same as put unless writes are queued"""
+        self.put(key, data)
+
+    def iter_lines(self, key):
+        """Stream the lines stored under key"""
+        with self.open(key) as f:
+            yield from f
+
+    def flush(self):
+        """Wait for queued writes, there are none unless writes are queued"""
+
+
+class LocalStorage(Storage):
+    """Storage in a folder on the local filesystem"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key) -> str:
+        return f"{self.root}/{key}"
+
+    def _put(self, key, data):
+        with self._open_write(key) as f:
+            f.write(data)
+
+    def get(self, key) -> bytes:
+        """Read the bytes stored under key"""
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def open(self, key):
+        """Open key for reading as a binary file"""
+        return open(self._path(key), "rb")
+
+    def _open_write(self, key, finished=None):
+        """Open a temporary file for key that's moved into place once it's closed"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def finish(f):
+            f.flush()
+            os.fsync(f.fileno())
+            if finished:
+                finished(f.tell())
+            f.close()
+            os.replace(path + ".tmp", path)
+
+        return _Writer(open(path + ".tmp", "wb"), finish)
+
+    def open_write(self, key):
+        """Open key for writing as a binary file, key is only replaced once it's closed"""
+        return self._open_write(key, count_written)
+
+    def list(self, prefix) -> list[str]:
+        """List the keys under a prefix, sorted"""
+        keys = []
+        for root, _, filenames in os.walk(self._path(prefix)):
+            for filename in filenames:
+                if not filename.endswith(".tmp"):
+                    keys.append(os.path.relpath(f"{root}/{filename}", self.root))
+        return sorted(key.replace(os.sep, "/") for key in keys)
+
+    def exists(self, key) -> bool:
+        """Check if something is stored under key"""
+        return os.path.isfile(self._path(key))
+
+    def size(self, key) -> int:
+        """Size in bytes of what's stored under key"""
+        return os.path.getsize(self._path(key))
+
+    def delete(self, prefix):
+        """Delete a key, or everything under a prefix"""
+        path = self._path(prefix)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def local_path(self, key) -> str:
+        """Path of a key on the local filesystem, e.g. to memory-map it"""
+        return self._path(key)
+
+
+class S3Storage(Storage):
+    """Storage in an S3 bucket, or on any S3-compatible server, under a key prefix"""
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, cache_folder=None):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNK_SIZE,
+        )
+        self.cache_folder = cache_folder or tempfile.mkdtemp(prefix="s3_cache_")
+
+    def _key(self, key) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _upload(self, key, f):
+        """Upload a file object from its start, in parts if it's over MULTIPART_THRESHOLD"""
+        f.seek(0)
+        self.client.upload_fileobj(
+            f, self.bucket, self._key(key), Config=self.transfer_config
+        )
+
+    def _put(self, key, data):
+        self._upload(key, io.BytesIO(data))
+
+    def _body(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"]
+
+    def get(self, key) -> bytes:
+        """Read the bytes stored under key"""
+        return self._body(key).read()
+
+    def open(self, key):
+        """Open key for reading as a binary file, the object is downloaded so it's seekable"""
+        return io.BytesIO(self.get(key))
+
+    def iter_lines(self, key):
+        """Stream the lines stored under key without downloading the whole object"""
+        yield from self._body(key).iter_lines()
+
+    def open_write(self, key):
+        """Open key for writing as a binary file, spooled to disk and uploaded once it's closed"""
+
+        def finish(f):
+            count_written(f.tell())
+            try:
+                self._upload(key, f)
+            finally:
+                f.close()
+
+        return _Writer(tempfile.TemporaryFile(), finish)
+
+    def list(self, prefix) -> list[str]:
+        """List the keys under a prefix, sorted"""
+        start = len(self.prefix) + 1 if self.prefix else 0
+        keys = []
+        pages = self.client.get_paginator("list_objects_v2").paginate(
+            Bucket=self.bucket, Prefix=self._key(prefix).rstrip("/") + "/"
+        )
+        for page in pages:
+            keys += [item["Key"][start:] for item in page.get("Contents", [])]
+        return sorted(keys)
+
+    def exists(self, key) -> bool:
+        """Check if something is stored under key"""
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except self.client.exceptions.ClientError:
+            return False
+        return True
+
+    def size(self, key) -> int:
+        """Size in bytes of what's stored under key"""
+        head = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        return head["ContentLength"]
+
+    def delete(self, prefix):
+        """Delete a key, or everything under a prefix, up to 1000 keys per request"""
+        keys = self.list(prefix) + ([prefix] if self.exists(prefix) else [])
+        for i in range(0, len(keys), 1000):
+            objects = [{"Key": self._key(key)} for key in keys[i : i + 1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects})
+
+    def local_path(self, key) -> str:
+        """Download a key to a local cache and return its path, e.g. to memory-map it"""
+        path = f"{self.cache_folder}/{key}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.client.download_file(
+            self.bucket, self._key(key), path, Config=self.transfer_config
+        )
+        return path
+
+
+class AsyncWriter:
+    """Wraps a backend so writes are queued on a bounded thread pool, reads go straight through
+
+    put returns once the write is queued, only waiting while MAX_PENDING_WRITES are pending.
+    put_after waits for every earlier write first, so a checkpoint is never stored before the
+    batches it records. open_write buffers the file in memory and queues it when closed, so
+    it's only for files of bounded size like batches and shards. An error from a queued write
+    is raised by the next put or by flush, which waits for everything queued so far.
+    """
+
+    def __init__(self, storage, workers=WRITE_WORKERS, max_pending=MAX_PENDING_WRITES):
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = []
+
+    def __getattr__(self, name):
+        # reads, lists and deletes go to the wrapped backend
+        return getattr(self.storage, name)
+
+    def _submit(self, write, *args):
+        """Queue a write, raising the error of any earlier write that failed"""
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if not future.done()]
+        for future in done:
+            future.result()
+
+        self.slots.acquire()
+        future = self.executor.submit(write, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.pending.append(future)
+
+    def put(self, key, data):
+        """Queue bytes to be stored under key"""
+        count_written(len(data))
+        self._submit(self.storage._put, key, data)
+
+    def put_after(self, key, data):
+        """Queue bytes to be stored under key once every earlier write has finished"""
+        earlier = list(self.pending)
+
+        def put_when_done():
+            wait(earlier)
+            if not any(future.exception() for future in earlier):
+                self.storage._put(key, data)
+
+        count_written(len(data))
+        self._submit(put_when_done)
+
+    def open_write(self, key):
+        """Open key for writing as an in-memory binary file, queued as one put when closed"""
+        return _Writer(io.BytesIO(), lambda f: self.put(key, f.getvalue()))
+
+    def flush(self):
+        """Wait for every queued write, raising the first error if any failed"""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """Wait for every queued write and stop the thread pool"""
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+
+def open_storage(location) -> Storage:
+    """Storage for a local folder or an s3://bucket/prefix location, one per location"""
+    if location not in _storages:
+        if location.startswith("s3://"):
+            bucket, _, prefix = location[len("s3://") :].partition("/")
+            _storages[location] = S3Storage(
+                bucket, prefix, endpoint_url=os.environ.get("S3_ENDPOINT_URL")
+            )
+        else:
+            _storages[location] = LocalStorage(location)
+    return _storages[location]
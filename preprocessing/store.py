@@ -0,0 +1,242 @@
+import argparse
+import json
+import threading
+from collections import OrderedDict, defaultdict
+
+from amz_preproc import BOOK_ID_FIRST_N, REVIEW_ID_FIRST_N
+from columnar import load_shard, shard_exists
+from isbn_index import INDEX_FOLDER, int_to_work_id, lookup_isbns, open_isbn_index
+from ol_preproc import S3_FOLDER, WORK_ID_FIRST_N
+from sharding import load_manifest, shard_name
+from storage import open_storage
+from work_ratings import WORK_RATINGS_FOLDER
+
+"""
+Read API for the preprocessed outputs
+- An id's shard is found through the folder's manifest, by the same rule the preprocessing
+  stages shard by (see sharding.py). Folders written before manifests existed are prefix
+  sharded by the first *_FIRST_N characters of the id
+- Shards are loaded on first use, in whichever format they were saved (see columnar.py), and
+  kept in an LRU cache bounded by the number of records it holds
+- get_many groups ids by shard, so a batch of lookups reads each shard at most once
+- ISBNs are looked up in the memory-mapped ISBN index, then their works in the works shards
+"""
+
+MAX_CACHED_RECORDS = 500000  # records kept in each store's cache of loaded shards
+
+
+class ShardStore:
+    """Point lookups into one sharded output, e.g. works or reviews"""
+
+    def __init__(
+        self,
+        storage,
+        folder,
+        first_n,
+        dataset,
+        columns=None,
+        max_records=MAX_CACHED_RECORDS,
+    ):
+        self.storage = storage
+        self.folder = folder
+        self.first_n = first_n
+        self.dataset = dataset
+        self.columns = columns
+        self.max_records = max_records
+        self._manifest = None
+        # shard name -> {id: value}, least recently used first
+        self.cache = OrderedDict()
+        self.cached_records = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "shards_loaded": 0}
+
+    @property
+    def manifest(self) -> dict:
+        """The folder's manifest, loaded on first use. Folders without one are taken to be
+        prefix sharded by first_n, with shards found by checking storage"""
+        if self._manifest is None:
+            manifest = load_manifest(self.storage, self.folder)
+            if manifest is None:
+                manifest = {"sharding": "prefix", "first_n": self.first_n}
+            self._manifest = manifest
+        return self._manifest
+
+    def shard_of(self, item_id) -> str:
+        """Name of the shard an id is saved in"""
+        return shard_name(item_id, self.manifest)
+
+    def _load(self, prefix) -> dict:
+        """Read a shard from storage, an empty dict if there isn't one"""
+        path = f"{self.folder}/{prefix}"
+        files = self.manifest.get("files")
+        if files is not None and prefix not in files:
+            return dict()
+        if files is None and not shard_exists(self.storage, path):
+            return dict()
+        return load_shard(self.storage, path, self.dataset, self.columns)
+
+    def shard(self, prefix) -> dict:
+        """A shard's {id: value} records, loaded into the cache if it isn't there already"""
+        with self.lock:
+            if prefix in self.cache:
+                self.cache.move_to_end(prefix)
+                self.stats["hits"] += 1
+                return self.cache[prefix]
+            self.stats["misses"] += 1
+
+        # load without holding the lock, so lookups in cached shards don't wait on it
+        records = self._load(prefix)
+
+        with self.lock:
+            self.stats["shards_loaded"] += 1
+            if prefix not in self.cache:
+                self.cache[prefix] = records
+                self.cached_records += len(records)
+
+            # evict least recently used shards, always keeping the one just loaded
+            while self.cached_records > self.max_records and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_records -= len(evicted)
+        return records
+
+    def get(self, item_id, default=None):
+        """Look up one id"""
+        return self.shard(self.shard_of(item_id)).get(item_id, default)
+
+    def get_many(self, item_ids) -> dict:
+        """Look up a batch of ids, returning {id: value} for the ones that exist"""
+        item_ids = list(item_ids)
+        by_shard = defaultdict(list)
+        for item_id in item_ids:
+            by_shard[self.shard_of(item_id)].append(item_id)
+
+        found = dict()
+        for prefix, shard_ids in by_shard.items():
+            records = self.shard(prefix)
+            for item_id in shard_ids:
+                if item_id in records:
+                    found[item_id] = records[item_id]
+
+        # same order as the ids were asked for
+        return {item_id: found[item_id] for item_id in item_ids if item_id in found}
+
+    def __contains__(self, item_id) -> bool:
+        return item_id in self.shard(self.shard_of(item_id))
+
+    def clear(self):
+        """Drop every cached shard, and the manifest in case the folder was rewritten"""
+        with self.lock:
+            self.cache.clear()
+            self.cached_records = 0
+            self._manifest = None
+
+
+class WorkStore:
+    """Lookups of works by work id or ISBN, Amazon books by ASIN and reviews by user id"""
+
+    def __init__(self, location=S3_FOLDER, max_records=MAX_CACHED_RECORDS):
+        self.storage = open_storage(location)
+        self.works = ShardStore(
+            self.storage, "works", WORK_ID_FIRST_N, "works", max_records=max_records
+        )
+        self.books = ShardStore(
+            self.storage,
+            "amz_books",
+            BOOK_ID_FIRST_N,
+            "amz_books",
+            max_records=max_records,
+        )
+        self.reviews = ShardStore(
+            self.storage,
+            "reviews",
+            REVIEW_ID_FIRST_N,
+            "reviews",
+            max_records=max_records,
+        )
+        self.work_ratings = ShardStore(
+            self.storage,
+            WORK_RATINGS_FOLDER,
+            None,
+            "work_ratings",
+            max_records=max_records,
+        )
+        self._isbn_index = None
+
+    @property
+    def isbn_index(self):
+        """The memory-mapped ISBN index, opened on first use"""
+        if self._isbn_index is None:
+            self._isbn_index = open_isbn_index(self.storage, INDEX_FOLDER)
+        return self._isbn_index
+
+    def get_work(self, work_id) -> dict:
+        """A work by its Open Library id (e.g. OL123W), None if it doesn't exist"""
+        return self.works.get(work_id)
+
+    def get_works(self, work_ids) -> dict:
+        """Works for a batch of Open Library ids, {work id: work} for the ones that exist"""
+        return self.works.get_many(work_ids)
+
+    def get_book(self, asin) -> dict:
+        """An Amazon book by its ASIN, None if it doesn't exist"""
+        return self.books.get(asin)
+
+    def get_books(self, asins) -> dict:
+        """Amazon books for a batch of ASINs, {asin: book} for the ones that exist"""
+        return self.books.get_many(asins)
+
+    def get_reviews(self, user_id) -> list[dict]:
+        """A user's [{asin: rating}, ...] reviews, an empty list if they have none"""
+        return self.reviews.get(user_id, [])
+
+    def get_many_reviews(self, user_ids) -> dict:
+        """Reviews for a batch of users, {user id: reviews} for users who have any"""
+        return self.reviews.get_many(user_ids)
+
+    def get_work_ratings(self, work_id) -> dict:
+        """A work's fields with its rated ASINs and users' ratings (see work_ratings.py),
+        None if it has no ratings"""
+        return self.work_ratings.get(work_id)
+
+    def work_ids_for_isbns(self, isbns) -> dict:
+        """Work ids for a batch of ISBN-10s or ISBN-13s, {isbn: work id} for the ones found"""
+        isbns = list(isbns)
+        work_numbers = lookup_isbns(self.isbn_index, isbns).tolist()
+        return {
+            isbn: int_to_work_id(number)
+            for isbn, number in zip(isbns, work_numbers)
+            if number
+        }
+
+    def get_work_by_isbn(self, isbn) -> dict:
+        """A work by one of its editions' ISBNs, None if it isn't found"""
+        return self.get_works_by_isbn([isbn]).get(isbn)
+
+    def get_works_by_isbn(self, isbns) -> dict:
+        """Works for a batch of ISBNs, {isbn: work} for the ones found"""
+        work_ids = self.work_ids_for_isbns(isbns)
+        works = self.works.get_many(work_ids.values())
+        return {
+            isbn: works[work_id]
+            for isbn, work_id in work_ids.items()
+            if work_id in works
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up preprocessed outputs")
+    parser.add_argument("--location", default=S3_FOLDER)
+    parser.add_argument("--work", nargs="*", default=[])
+    parser.add_argument("--isbn", nargs="*", default=[])
+    parser.add_argument("--asin", nargs="*", default=[])
+    parser.add_argument("--user", nargs="*", default=[])
+    args = parser.parse_args()
+
+    store = WorkStore(args.location)
+    results = {
+        "works": store.get_works(args.work),
+        "isbns": store.get_works_by_isbn(args.isbn) if args.isbn else {},
+        "books": store.get_books(args.asin),
+        "reviews": store.get_many_reviews(args.user),
+    }
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,368 @@
+import argparse
+import json
+import re
+import time
+from array import array
+
+import numpy as np
+
+from isbn_index import int_to_work_id, work_id_to_int
+from storage import open_storage
+
+"""
+Inverted index of works by subject, genre, page count and publication year, so a club's
+constraints can cut the candidate set down before anything is scored
+- Works are numbered densely in work number order (work i is work_numbers[i]), and every
+  term maps to a sorted int32 array of the works it's in
+- Terms are "field:value" strings. Subjects and genres are lowercased with runs of spaces
+  collapsed, page counts and years are bucketed by PAGE_BUCKET and YEAR_BUCKET
+  ("pages:300" holds the works with 300 to 399 pages)
+- Term strings are interned to ids in sorted order, so a term is a binary search away, and
+  the posting lists are stored back to back in one array with offsets, like CSR indptr
+- Works' subjects, Open Library genres, pages and years are indexed while the Open Library
+  stage aggregates its batches, from small runs of just those fields merged the way the
+  works are. Amazon genres are indexed while the Amazon books stage aggregates, through
+  each ASIN's work (see isbn_index.asin_works), as a second part with the same numbering.
+  Rebuilding the works part deletes it until the Amazon books stage runs again
+- Queries are nested lists: a term, ["and", ...], ["or", ...], ["not", query], or a
+  ["pages" | "year", low, high] range (low inclusive, high exclusive, null for no bound).
+  ANDs intersect their shortest postings first with a binary search per work and subtract
+  their NOTs, ranges join the buckets inside them and check the edge buckets' works against
+  pages.npy / years.npy. Dense ORs and NOTs are done on a bitmap of every work instead
+"""
+
+SUBJECT_INDEX_FOLDER = "subject_index"
+WORKS_PART = "works"  # terms from the works' own fields
+GENRES_PART = "amz_genres"  # terms from the genres of the works' Amazon books
+INDEX_FIELDS = ["subjects", "genres", "number_of_pages", "publish_date"]
+PAGE_BUCKET = 100
+YEAR_BUCKET = 10
+YEARS = (1000, 2100)  # years outside this range are treated as unknown
+# unions and complements with more works than 1 / DENSE of all works go through a bitmap
+DENSE = 64
+
+_YEAR = re.compile(r"\b\d{4}\b")
+
+
+def normalize_term(value) -> str:
+    """A subject or genre lowercased, with runs of spaces collapsed"""
+    return " ".join(str(value).lower().split())
+
+
+def publish_year(publish_date) -> int:
+    """Year of an Open Library publish date like "March 3, 2004", 0 if it has none"""
+    for match in _YEAR.findall(publish_date or ""):
+        if YEARS[0] <= int(match) <= YEARS[1]:
+            return int(match)
+    return 0
+
+
+def index_fields(work) -> dict:
+    """The fields of a work the index is built from"""
+    return {field: work[field] for field in INDEX_FIELDS if field in work}
+
+
+def work_terms(work, page_bucket=PAGE_BUCKET, year_bucket=YEAR_BUCKET) -> tuple:
+    """(terms, pages, year) of a work, pages and year 0 if unknown"""
+    terms = [f"subject:{normalize_term(s)}" for s in work.get("subjects", [])]
+    terms += [f"genre:{normalize_term(g)}" for g in work.get("genres", [])]
+    pages = work.get("number_of_pages")
+    pages = pages if type(pages) is int and pages > 0 else 0
+    year = publish_year(work.get("publish_date"))
+    if pages:
+        terms.append(f"pages:{pages // page_bucket * page_bucket}")
+    if year:
+        terms.append(f"year:{year // year_bucket * year_bucket}")
+    return terms, pages, year
+
+
+def _save_array(storage, key, values):
+    """Save an array as a .npy file in storage"""
+    with storage.open_write(key) as f:
+        np.save(f, values)
+
+
+def _save_postings(storage, folder, names, term_ids, works):
+    """Save (term id, work) pairs as sorted term strings, offsets and postings, returning
+    the number of terms"""
+    # relabel terms in sorted order, then sort pairs by term and work and drop repeats
+    sorted_ids = sorted(range(len(names)), key=names.__getitem__)
+    rank = np.empty(len(names), dtype=np.int64)
+    rank[sorted_ids] = np.arange(len(names))
+    term_ids = rank[np.asarray(term_ids, dtype=np.uint32)]
+    works = np.asarray(works, dtype=np.uint32)
+    order = np.lexsort((works, term_ids))
+    term_ids, works = term_ids[order], works[order]
+    keep = np.ones(len(works), dtype=bool)
+    keep[1:] = (term_ids[1:] != term_ids[:-1]) | (works[1:] != works[:-1])
+    term_ids, works = term_ids[keep], works[keep]
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=len(names)), out=offsets[1:])
+    terms = np.array([names[i].encode("utf-8") for i in sorted_ids], dtype=bytes)
+    _save_array(storage, f"{folder}/terms.npy", terms)
+    _save_array(storage, f"{folder}/offsets.npy", offsets)
+    _save_array(storage, f"{folder}/postings.npy", works.astype(np.int32))
+    return len(names)
+
+
+def build_work_index(
+    storage,
+    works,
+    folder=SUBJECT_INDEX_FOLDER,
+    page_bucket=PAGE_BUCKET,
+    year_bucket=YEAR_BUCKET,
+) -> tuple[int, int]:
+    """Index a stream of (work id, index fields) pairs, returning the number of works and
+    terms
+
+    The Amazon genres part is deleted, since it's in the old numbering of the works. The
+    Amazon books stage indexes it again (see build_genre_index).
+    """
+    storage.delete(f"{folder}/{GENRES_PART}")
+    numbers, pages, years = array("Q"), array("i"), array("i")
+    term_index = dict()  # term -> id in the order terms are first seen
+    term_ids, term_works = array("I"), array("I")
+    for i, (work_id, work) in enumerate(works):
+        terms, work_pages, year = work_terms(work, page_bucket, year_bucket)
+        numbers.append(work_id_to_int(work_id))
+        pages.append(work_pages)
+        years.append(year)
+        for term in terms:
+            term_ids.append(term_index.setdefault(term, len(term_index)))
+        term_works.extend([i] * len(terms))
+
+    # renumber works from stream order to work number order
+    numbers = np.frombuffer(numbers, dtype=np.uint64)
+    order = np.argsort(numbers, kind="stable")
+    rank = np.empty(len(numbers), dtype=np.uint32)
+    rank[order] = np.arange(len(numbers))
+    term_works = rank[np.asarray(term_works, dtype=np.uint32)]
+
+    _save_array(storage, f"{folder}/work_numbers.npy", numbers[order])
+    _save_array(storage, f"{folder}/pages.npy", np.frombuffer(pages, np.int32)[order])
+    _save_array(storage, f"{folder}/years.npy", np.frombuffer(years, np.int32)[order])
+    n_terms = _save_postings(
+        storage, f"{folder}/{WORKS_PART}", list(term_index), term_ids, term_works
+    )
+    meta = {
+        "works": len(numbers),
+        "page_bucket": page_bucket,
+        "year_bucket": year_bucket,
+    }
+    storage.put(f"{folder}/meta.json", json.dumps(meta).encode("utf-8"))
+    return len(numbers), n_terms
+
+
+def build_genre_index(
+    storage, books, asin_works, folder=SUBJECT_INDEX_FOLDER
+) -> tuple[int, int]:
+    """Index a stream of (asin, book) pairs by each book's genre, under the book's work in
+    the works part's numbering (asin_works is {asin: work number}, see
+    isbn_index.asin_works), returning the number of ASINs with a work and of genres
+
+    The ASINs with a work are saved sorted with their works, to filter books by.
+    """
+    work_numbers = np.load(storage.local_path(f"{folder}/work_numbers.npy"))
+    asins, numbers = [], array("Q")
+    term_index = dict()
+    term_ids, term_rows = array("I"), array("I")
+    for asin, book in books:
+        number = asin_works.get(asin)
+        if not number:
+            continue
+        if book.get("genre"):
+            genre = f"genre:{normalize_term(book['genre'])}"
+            term_ids.append(term_index.setdefault(genre, len(term_index)))
+            term_rows.append(len(asins))
+        asins.append(asin.encode("utf-8"))
+        numbers.append(number)
+
+    # works of the ASINs, -1 for the few whose work isn't in the works shards
+    numbers = np.frombuffer(numbers, dtype=np.uint64)
+    found = _contains(work_numbers, numbers)
+    works = np.full(len(numbers), -1, dtype=np.int32)
+    works[found] = np.searchsorted(work_numbers, numbers[found])
+    term_works = works[np.asarray(term_rows, dtype=np.uint32)]
+    indexed = term_works >= 0
+
+    # the stream is in ASIN order, which is the order of their utf-8 bytes
+    _save_array(storage, f"{folder}/{GENRES_PART}/asins.npy", np.array(asins, bytes))
+    _save_array(storage, f"{folder}/{GENRES_PART}/asin_works.npy", works)
+    _save_postings(
+        storage,
+        f"{folder}/{GENRES_PART}",
+        list(term_index),
+        np.asarray(term_ids, dtype=np.uint32)[indexed],
+        term_works[indexed],
+    )
+    return len(asins), len(term_index)
+
+
+def _contains(large, small) -> np.ndarray:
+    """Whether each value of a sorted array is in another sorted array, one binary search
+    per value of the first"""
+    if not len(large):
+        return np.zeros(len(small), dtype=bool)
+    positions = np.minimum(np.searchsorted(large, small), len(large) - 1)
+    return large[positions] == small
+
+
+def _is_not(query) -> bool:
+    return isinstance(query, list) and query[:1] == ["not"]
+
+
+class SubjectIndex:
+    """Works matching queries of subjects, genres, page counts and years"""
+
+    def __init__(self, storage, folder=SUBJECT_INDEX_FOLDER):
+        self.storage = storage
+        self.folder = folder
+        self.meta = json.loads(storage.get(f"{folder}/meta.json"))
+        self.work_numbers = self._load("work_numbers")
+        self.pages = self._load("pages")
+        self.years = self._load("years")
+        self.parts = [self._load_part(WORKS_PART)]
+        self.asins = np.empty(0, dtype=bytes)
+        self.asin_works = np.empty(0, dtype=np.int32)
+        if storage.exists(f"{folder}/{GENRES_PART}/terms.npy"):
+            self.parts.append(self._load_part(GENRES_PART))
+            self.asins = self._load(f"{GENRES_PART}/asins")
+            self.asin_works = self._load(f"{GENRES_PART}/asin_works")
+
+    def _load(self, name) -> np.ndarray:
+        """Memory-map one of the index's arrays"""
+        key = f"{self.folder}/{name}.npy"
+        return np.load(self.storage.local_path(key), mmap_mode="r")
+
+    def _load_part(self, part) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return tuple(
+            self._load(f"{part}/{name}") for name in ["terms", "offsets", "postings"]
+        )
+
+    def __len__(self) -> int:
+        return len(self.work_numbers)
+
+    def postings(self, term) -> np.ndarray:
+        """Sorted works with a "field:value" term, values normalized like the index's"""
+        field, _, value = term.partition(":")
+        key = f"{field}:{normalize_term(value)}".encode("utf-8")
+        found = []
+        for terms, offsets, postings in self.parts:
+            position = int(np.searchsorted(terms, key))
+            if position < len(terms) and terms[position] == key:
+                found.append(postings[offsets[position] : offsets[position + 1]])
+        return self._union(found)
+
+    def terms(self, field) -> list[str]:
+        """Every value of a field in the index, sorted"""
+        prefix = f"{field}:".encode("utf-8")
+        values = set()
+        for terms, _, _ in self.parts:
+            start = int(np.searchsorted(terms, prefix))
+            end = int(np.searchsorted(terms, prefix[:-1] + b";"))
+            values.update(t[len(prefix) :].decode("utf-8") for t in terms[start:end])
+        return sorted(values)
+
+    def _range(self, field, low=None, high=None) -> np.ndarray:
+        """Sorted works with pages or a year in [low, high)"""
+        size = self.meta["page_bucket" if field == "pages" else "year_bucket"]
+        values = self.pages if field == "pages" else self.years
+        low = -np.inf if low is None else low
+        high = np.inf if high is None else high
+        found = []
+        for bucket in map(int, self.terms(field)):
+            if bucket + size <= low or bucket >= high:
+                continue
+            works = self.postings(f"{field}:{bucket}")
+            if bucket < low or bucket + size > high:
+                works = works[(values[works] >= low) & (values[works] < high)]
+            found.append(works)
+        return self._union(found)
+
+    def _union(self, arrays) -> np.ndarray:
+        """Sorted union of sorted arrays of works"""
+        arrays = [works for works in arrays if len(works)]
+        if len(arrays) <= 1:
+            return np.asarray(arrays[0]) if arrays else np.empty(0, dtype=np.int32)
+        if sum(map(len, arrays)) < len(self) // DENSE:
+            return np.unique(np.concatenate(arrays))
+        bitmap = np.zeros(len(self), dtype=bool)
+        for works in arrays:
+            bitmap[works] = True
+        return np.flatnonzero(bitmap).astype(np.int32)
+
+    def query(self, query) -> np.ndarray:
+        """Sorted works matching a query (see the module docstring)"""
+        if isinstance(query, str):
+            return self.postings(query)
+        if not isinstance(query, list) or not query:
+            raise ValueError(f"Bad query {query!r}")
+        op, *args = query
+        if op in ["pages", "year"]:
+            if len(args) != 2:
+                raise ValueError(f"{op} ranges are [{op!r}, low, high]")
+            return self._range(op, *args)
+        if op == "not":
+            if len(args) != 1:
+                raise ValueError("not takes one query")
+            bitmap = np.ones(len(self), dtype=bool)
+            bitmap[self.query(args[0])] = False
+            return np.flatnonzero(bitmap).astype(np.int32)
+        if op == "or":
+            return self._union([self.query(arg) for arg in args])
+        if op != "and":
+            raise ValueError(f"Unknown query operator {op!r}")
+
+        # NOTs are subtracted from the other arguments' intersection, not complemented
+        negated = [arg[1] for arg in args if _is_not(arg)]
+        included = sorted(
+            (self.query(arg) for arg in args if not _is_not(arg)), key=len
+        )
+        works = included[0] if included else np.arange(len(self), dtype=np.int32)
+        for other in included[1:]:
+            works = works[_contains(other, works)]
+        for arg in negated:
+            if not len(works):
+                break
+            works = works[~_contains(self.query(arg), works)]
+        return works
+
+    def work_ids(self, works) -> list[str]:
+        """Open Library ids of works"""
+        return [int_to_work_id(n) for n in self.work_numbers[works].tolist()]
+
+    def book_works(self, asins) -> np.ndarray:
+        """Work of each ASIN in a sorted array of utf-8 ASINs, -1 where it has none"""
+        found = _contains(self.asins, asins)
+        positions = np.searchsorted(self.asins, asins[found])
+        works = np.full(len(asins), -1, dtype=np.int32)
+        works[found] = self.asin_works[positions]
+        return works
+
+    def book_mask(self, book_works, works) -> np.ndarray:
+        """Whether each book's work (see book_works) is one of works"""
+        allowed = np.zeros(len(self) + 1, dtype=bool)
+        allowed[works] = True
+        return allowed[book_works]  # -1 is the last, always False
+
+
+if __name__ == "__main__":
+    # imported here since ol_preproc imports this module
+    from ol_preproc import S3_FOLDER
+
+    parser = argparse.ArgumentParser(description="Query the subject index")
+    parser.add_argument(
+        "query",
+        help='JSON query, e.g. \'["and", "subject:fantasy", ["pages", null, 400]]\'',
+    )
+    parser.add_argument("--location", default=S3_FOLDER)
+    parser.add_argument("--show", type=int, default=10, help="work ids to print")
+    args = parser.parse_args()
+
+    index = SubjectIndex(open_storage(args.location))
+    start = time.perf_counter()
+    works = index.query(json.loads(args.query))
+    elapsed = time.perf_counter() - start
+    print(f"{len(works)} of {len(index)} works in {elapsed * 1000:.2f}ms")
+    print(index.work_ids(works[: args.show]))
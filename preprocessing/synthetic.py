@@ -0,0 +1,405 @@
+import argparse
+import gzip
+import json
+import os
+import random
+
+"""
+Synthetic versions of the raw dumps, for benchmarks and runs without the real data
+- Files are written with the same layout preproc.py reads (data/openlibrary/..., data/amazon/...),
+  so preproc.py can be run as is from the root folder
+- Records have the fields the real dumps have (including ones we don't use, so line sizes are
+  realistic), with the size, English ratio and Open Library/Amazon ISBN overlap configurable
+- A data/synthetic.json manifest records the parameters and line/byte counts of each file
+"""
+
+OL_PATH = "data/openlibrary/2025-06-30/2025-06-30.txt.gz"
+BOOK_PATH = "data/amazon/meta_Books.jsonl.gz"
+REVIEWS_PATH = "data/amazon/Books.jsonl.gz"
+MANIFEST_PATH = "data/synthetic.json"
+
+WORDS = (
+    "the of and a to in is you that it he was for on are as with his they at be this "
+    "from have or by one had not but what all were when we there can an your which their "
+    "said if do will each about how up out them then she many some so these would other "
+    "into has more her two like him see time could no make than first been its who now "
+    "people my made over did down only way find use may water long little very after "
+    "words called just where most know get through back much before go good new write "
+    "our used me man too any day same right look think also around another came come work "
+    "three word must because does part even place well such here take why things help put "
+    "years different away again off went old number great tell men say small every found "
+    "still between name should home big give air line set own under read last never us "
+    "left end along while might next sound below saw something thought both few those "
+    "always looked show large often together asked house world going want school important"
+).split()
+SUBJECTS = [
+    f"{a} {b}"
+    for a in ["Fiction", "History", "Juvenile", "Science", "Biography", "Poetry"]
+    for b in [
+        "",
+        "fiction",
+        "history",
+        "and criticism",
+        "literature",
+        "romance",
+        "fantasy",
+        "mystery and detective stories",
+        "United States",
+        "England",
+        "textbooks",
+    ]
+]
+GENRES = [
+    "Literature & Fiction",
+    "Mystery, Thriller & Suspense",
+    "Science Fiction & Fantasy",
+    "Romance",
+    "Biographies & Memoirs",
+    "History",
+    "Children's Books",
+    "Teen & Young Adult",
+    "Christian Books & Bibles",
+    "Religion & Spirituality",
+    "Politics & Social Sciences",
+    "Business & Money",
+    "Self-Help",
+    "Cookbooks, Food & Wine",
+    "Arts & Photography",
+]
+LANGUAGES = ["fre", "ger", "spa", "ita", "por", "rus", "jpn", "chi"]
+MONTHS = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+# popularity ranks are shifted by this, so the top book and user get about 1% of reviews
+ZIPF_OFFSET = 10
+
+
+def _words(rng, low, high) -> str:
+    """Random run of words"""
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _isbn_pair(rng) -> tuple[str, str]:
+    """Random valid ISBN-10 and its ISBN-13"""
+    digits = "".join(str(rng.randint(0, 9)) for _ in range(9))
+    check_10 = sum((10 - i) * int(d) for i, d in enumerate(digits)) % 11
+    check_10 = (11 - check_10) % 11
+    isbn_10 = digits + ("X" if check_10 == 10 else str(check_10))
+    digits_13 = "978" + digits
+    check_13 = (
+        10 - sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits_13)) % 10
+    ) % 10
+    return isbn_10, digits_13 + str(check_13)
+
+
+def _zipf_index(rng, n, offset=ZIPF_OFFSET) -> int:
+    """Random index in [0, n) with probability falling off as 1 / (index + offset), by
+    inverting the CDF of the continuous version"""
+    ratio = (n + offset + 1) / (offset + 1)
+    return min(int((offset + 1) * ratio ** rng.random() - offset) - 1, n - 1)
+
+
+def _write_line(f, line, counts):
+    """Write one line and count it"""
+    data = (line + "\n").encode("utf-8")
+    f.write(data)
+    counts["lines"] += 1
+    counts["bytes"] += len(data)
+
+
+def _generate_ol(
+    path, rng, n_editions, english_ratio, edition_ratio
+) -> tuple[dict, list]:
+    """Write an Open Library dump, returning its counts and the ISBN pairs of English editions"""
+    counts = {"lines": 0, "bytes": 0}
+    english_isbns = []
+    n_works = max(n_editions // 2, 1)
+    n_other = int(n_editions * (1 - edition_ratio) / edition_ratio)
+
+    with gzip.open(path, "wb", compresslevel=6) as f:
+        for i in range(n_editions + n_other):
+            # authors and works are mixed in with editions like in the real dump
+            if rng.random() >= n_editions / (n_editions + n_other):
+                if rng.random() < 0.5:
+                    key = f"/authors/OL{i}A"
+                    record = {
+                        "key": key,
+                        "name": _words(rng, 2, 3).title(),
+                        "type": {"key": "/type/author"},
+                        "revision": 1,
+                    }
+                    _write_line(
+                        f,
+                        f"/type/author\t{key}\t1\t2024-01-01T00:00:00\t{json.dumps(record)}",
+                        counts,
+                    )
+                else:
+                    key = f"/works/OL{rng.randint(1, n_works)}W"
+                    record = {
+                        "key": key,
+                        "title": _words(rng, 1, 6).title(),
+                        "subjects": rng.sample(SUBJECTS, 3),
+                        "type": {"key": "/type/work"},
+                    }
+                    _write_line(
+                        f,
+                        f"/type/work\t{key}\t2\t2024-01-01T00:00:00\t{json.dumps(record)}",
+                        counts,
+                    )
+                continue
+
+            key = f"/books/OL{i}M"
+            english = rng.random() < english_ratio
+            record = {
+                "key": key,
+                "title": _words(rng, 1, 8).title(),
+                "publishers": [_words(rng, 1, 3).title()],
+                "authors": [{"key": f"/authors/OL{rng.randint(1, n_works)}A"}],
+                "languages": [
+                    {
+                        "key": (
+                            "/languages/eng"
+                            if english
+                            else f"/languages/{rng.choice(LANGUAGES)}"
+                        )
+                    }
+                ],
+                "type": {"key": "/type/edition"},
+                "source_records": [f"ia:{_words(rng, 1, 1)}{i}"],
+                "revision": rng.randint(1, 9),
+                "last_modified": {
+                    "type": "/type/datetime",
+                    "value": "2024-01-01T00:00:00",
+                },
+            }
+            if rng.random() < 0.97:
+                record["works"] = [{"key": f"/works/OL{rng.randint(1, n_works)}W"}]
+            isbn_10, isbn_13 = _isbn_pair(rng)
+            if rng.random() < 0.6:
+                record["isbn_10"] = [isbn_10]
+            if rng.random() < 0.7:
+                record["isbn_13"] = [isbn_13]
+            if rng.random() < 0.6:
+                record["subjects"] = rng.sample(SUBJECTS, rng.randint(1, 6))
+            if rng.random() < 0.7:
+                record["number_of_pages"] = rng.randint(24, 1200)
+            if rng.random() < 0.9:
+                record["publish_date"] = str(rng.randint(1900, 2025))
+            if rng.random() < 0.05:
+                record["genres"] = [rng.choice(GENRES)]
+            if rng.random() < 0.4:
+                record["covers"] = [rng.randint(1, 15000000)]
+            if rng.random() < 0.3:
+                record["physical_format"] = rng.choice(
+                    ["Paperback", "Hardcover", "Ebook"]
+                )
+
+            if (
+                english
+                and "works" in record
+                and ("isbn_10" in record or "isbn_13" in record)
+            ):
+                english_isbns.append(
+                    (record.get("isbn_10", [None])[0], record.get("isbn_13", [None])[0])
+                )
+            _write_line(
+                f,
+                f"/type/edition\t{key}\t{record['revision']}\t2024-01-01T00:00:00\t{json.dumps(record)}",
+                counts,
+            )
+
+    return counts, english_isbns
+
+
+def _generate_books(
+    path, rng, n_books, english_ratio, isbn_overlap, ol_isbns
+) -> tuple[dict, list]:
+    """Write Amazon book metadata, returning its counts and ASINs"""
+    counts = {"lines": 0, "bytes": 0}
+    asins = []
+
+    with gzip.open(path, "wb", compresslevel=6) as f:
+        for i in range(n_books):
+            asin = (
+                f"{rng.randint(0, 9999999999):010d}"
+                if rng.random() < 0.8
+                else f"B0{rng.randint(0, 99999999):08d}"
+            )
+            asins.append(asin)
+
+            # take ISBNs from open library for the overlapping fraction
+            if ol_isbns and rng.random() < isbn_overlap:
+                isbn_10, isbn_13 = rng.choice(ol_isbns)
+                isbn_10 = isbn_10 or _isbn_pair(rng)[0]
+                isbn_13 = isbn_13 or _isbn_pair(rng)[1]
+            else:
+                isbn_10, isbn_13 = _isbn_pair(rng)
+
+            details = {
+                "Publisher": f"{_words(rng, 1, 2).title()}; 1st edition ({rng.choice(MONTHS)} {rng.randint(1, 28)}, {rng.randint(1950, 2025)})",
+                "Language": (
+                    "English"
+                    if rng.random() < english_ratio
+                    else rng.choice(["Spanish", "French", "German"])
+                ),
+                "Item Weight": f"{rng.randint(1, 40)} ounces",
+                "Dimensions": f"{rng.randint(4, 9)} x {rng.random():.2f} x {rng.randint(6, 11)} inches",
+            }
+            if rng.random() < 0.85:
+                details["Paperback" if rng.random() < 0.6 else "Hardcover"] = (
+                    f"{rng.randint(24, 1200)} pages"
+                )
+            if rng.random() < 0.85:
+                details["ISBN 10"] = isbn_10
+            if rng.random() < 0.85:
+                details["ISBN 13"] = f"{isbn_13[:3]}-{isbn_13[3:]}"
+
+            record = {
+                "main_category": "Books",
+                "title": _words(rng, 1, 10).title(),
+                "average_rating": round(rng.uniform(1, 5), 1),
+                "rating_number": int(rng.paretovariate(1.2)) - 1,
+                "features": [_words(rng, 5, 20)],
+                "description": [_words(rng, 20, 120)],
+                "price": round(rng.uniform(1, 60), 2),
+                "images": [
+                    {
+                        "large": f"https://m.media-amazon.com/images/I/{asin}.jpg",
+                        "variant": "MAIN",
+                    }
+                ],
+                "videos": [],
+                "store": _words(rng, 2, 3).title(),
+                "categories": ["Books"] + rng.sample(GENRES, rng.randint(0, 2)),
+                "details": details,
+                "parent_asin": asin,
+                "bought_together": None,
+            }
+            _write_line(f, json.dumps(record), counts)
+
+    return counts, asins
+
+
+def _generate_reviews(path, rng, n_reviews, n_users, asins) -> dict:
+    """Write Amazon reviews from users with skewed activity over skewed book popularity"""
+    counts = {"lines": 0, "bytes": 0}
+    # the books and users at each popularity rank
+    books = rng.sample(range(len(asins)), len(asins))
+    users = rng.sample(range(n_users), n_users)
+
+    with gzip.open(path, "wb", compresslevel=6) as f:
+        for _ in range(n_reviews):
+            # popular books and users get more reviews, with a long tail
+            asin = asins[books[_zipf_index(rng, len(asins))]]
+            if rng.random() < 0.1:
+                asin = f"B0{rng.randint(0, 99999999):08d}"  # book that's not in the metadata
+            user = users[_zipf_index(rng, n_users)]
+            record = {
+                "rating": float(rng.randint(1, 5)),
+                "title": _words(rng, 1, 6).title(),
+                "text": _words(rng, 10, 150),
+                "images": [],
+                "asin": asin,
+                "parent_asin": asin,
+                "user_id": f"AE{user:026X}",
+                "timestamp": rng.randint(1000000000000, 1700000000000),
+                "helpful_vote": int(rng.paretovariate(2)) - 1,
+                "verified_purchase": rng.random() < 0.8,
+            }
+            _write_line(f, json.dumps(record), counts)
+
+    return counts
+
+
+def generate(
+    root=".",
+    n_editions=100000,
+    english_ratio=0.8,
+    isbn_overlap=0.5,
+    n_books=None,
+    n_reviews=None,
+    n_users=None,
+    edition_ratio=0.5,
+    seed=0,
+) -> dict:
+    """Generate all three synthetic dumps under root, returning the manifest
+
+    n_books defaults to n_editions / 2, n_reviews to 5 per book and n_users to 1 per 10 reviews.
+    isbn_overlap is the fraction of Amazon books whose ISBNs come from English Open Library
+    editions, edition_ratio is the fraction of Open Library lines that are editions.
+    """
+    rng = random.Random(seed)
+    n_books = n_books if n_books is not None else max(n_editions // 2, 1)
+    n_reviews = n_reviews if n_reviews is not None else n_books * 5
+    n_users = n_users if n_users is not None else max(n_reviews // 10, 1)
+
+    for path in [OL_PATH, BOOK_PATH, REVIEWS_PATH]:
+        os.makedirs(os.path.dirname(f"{root}/{path}"), exist_ok=True)
+
+    ol_counts, ol_isbns = _generate_ol(
+        f"{root}/{OL_PATH}", rng, n_editions, english_ratio, edition_ratio
+    )
+    book_counts, asins = _generate_books(
+        f"{root}/{BOOK_PATH}", rng, n_books, english_ratio, isbn_overlap, ol_isbns
+    )
+    review_counts = _generate_reviews(
+        f"{root}/{REVIEWS_PATH}", rng, n_reviews, n_users, asins
+    )
+
+    manifest = {
+        "params": {
+            "n_editions": n_editions,
+            "english_ratio": english_ratio,
+            "isbn_overlap": isbn_overlap,
+            "n_books": n_books,
+            "n_reviews": n_reviews,
+            "n_users": n_users,
+            "edition_ratio": edition_ratio,
+            "seed": seed,
+        },
+        "files": {
+            OL_PATH: ol_counts,
+            BOOK_PATH: book_counts,
+            REVIEWS_PATH: review_counts,
+        },
+    }
+    with open(f"{root}/{MANIFEST_PATH}", "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic raw dumps")
+    parser.add_argument("--root", default=".")
+    parser.add_argument("--editions", type=int, default=100000)
+    parser.add_argument("--english-ratio", type=float, default=0.8)
+    parser.add_argument("--isbn-overlap", type=float, default=0.5)
+    parser.add_argument("--books", type=int, default=None)
+    parser.add_argument("--reviews", type=int, default=None)
+    parser.add_argument("--users", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    manifest = generate(
+        args.root,
+        args.editions,
+        args.english_ratio,
+        args.isbn_overlap,
+        args.books,
+        args.reviews,
+        args.users,
+        seed=args.seed,
+    )
+    print(json.dumps(manifest["files"], indent=4))
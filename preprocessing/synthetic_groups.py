@@ -0,0 +1,358 @@
+import argparse
+import json
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+from amz_preproc import S3_FOLDER
+from instrument import (
+    REPORTS_FOLDER,
+    count,
+    end_stage,
+    save_report,
+    start_run,
+    start_stage,
+    timer,
+)
+from rating_matrix import MATRIX_FOLDER, gather_rows, open_rating_matrix
+from storage import open_storage
+
+"""
+Synthetic book clubs, built from user-user similarity
+- Similar users are found with MinHash LSH over the books each user rated: users whose
+  signatures match in any band are candidate neighbours, so similarity is only computed for
+  candidates instead of every pair of users
+- Candidates are ranked by exact cosine similarity of their ratings (from the rating matrix,
+  see rating_matrix.py), keeping each user's top k neighbours
+- Signatures and similarities are computed in a pool of processes, each one memory-maps the
+  rating matrix and works through blocks of users or candidate pairs with NumPy
+- Groups grow from a random user: with probability cohesion the next member is one of the
+  current members' neighbours (the most similar one, or one drawn in proportion to
+  similarity when stochastic), otherwise a random user
+- Neighbours and groups are saved as .npy arrays of rating matrix user indexes, groups as a
+  flat members array with offsets
+"""
+
+GROUPS_FOLDER = "synthetic_groups"
+STAGE = "synthetic_groups"  # name of this stage in run reports
+NEIGHBOURS = 20  # neighbours kept per user
+BANDS = 32  # LSH bands, users sharing any band's signature are candidates
+ROWS_PER_BAND = 1  # MinHash values per band, more makes candidates more similar
+WINDOW = 5  # users each user is compared with in each band's bucket
+USER_BLOCK = 50000  # users signed per task
+PAIR_BLOCK = 200000  # candidate pairs scored per task
+WORKERS = 4
+PRIME = 2**31 - 1  # modulus of the MinHash hash functions
+
+_matrix = None  # the rating matrix, opened in each worker
+
+
+def _open_matrix(location, folder):
+    """Memory-map the rating matrix in a worker"""
+    global _matrix
+    _matrix = open_rating_matrix(open_storage(location), folder)
+
+
+def _sign_users(task) -> np.ndarray:
+    """MinHash signatures of users start to end, one hash function per column"""
+    start, end, a, b = task
+    start_offset = _matrix.csr_indptr[start]
+    indptr = np.asarray(_matrix.csr_indptr[start : end + 1]) - start_offset
+    books = np.asarray(_matrix.csr_indices[start_offset : indptr[-1] + start_offset])
+    books = books.astype(np.int64)
+
+    # every user has at least one rating, so no reduceat segment is empty
+    signatures = np.empty((end - start, len(a)), dtype=np.uint32)
+    for i in range(len(a)):
+        hashes = (a[i] * books + b[i]) % PRIME
+        signatures[:, i] = np.minimum.reduceat(hashes, indptr[:-1])
+    return signatures
+
+
+def _score_pairs(pairs) -> np.ndarray:
+    """Cosine similarity of the ratings of each pair of users"""
+    n_books = _matrix.shape[1]
+    left = gather_rows(_matrix, pairs[:, 0])
+    right = gather_rows(_matrix, pairs[:, 1])
+
+    # ratings both users gave the same book match on (pair, book) keys
+    left_keys = left[0].astype(np.int64) * n_books + left[1]
+    right_keys = right[0].astype(np.int64) * n_books + right[1]
+    _, left_match, right_match = np.intersect1d(
+        left_keys, right_keys, assume_unique=True, return_indices=True
+    )
+    products = left[2][left_match].astype(np.float64) * right[2][right_match]
+    dots = np.bincount(left[0][left_match], products, minlength=len(pairs))
+
+    norms = [
+        np.sqrt(np.bincount(side[0], side[2].astype(np.float64) ** 2, len(pairs)))
+        for side in [left, right]
+    ]
+    return (dots / (norms[0] * norms[1])).astype(np.float32)
+
+
+def _band_pairs(keys, window, rng) -> np.ndarray:
+    """Pairs of users with equal band keys, pairing each user with the next window users in
+    a random order of its bucket, so big buckets don't make quadratically many pairs"""
+    order = np.lexsort((rng.random(len(keys)), keys))
+    keys = keys[order]
+    pairs = []
+    for step in range(1, window + 1):
+        same = np.flatnonzero(keys[step:] == keys[:-step])
+        pairs.append(np.stack([order[same], order[same + step]], axis=1))
+    return np.concatenate(pairs)
+
+
+def _merge_neighbours(neighbours, similarities, pairs, pair_similarities):
+    """Merge scored pairs into each user's top k neighbours, in place"""
+    n_users, k = neighbours.shape
+    users = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    others = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    pair_similarities = np.concatenate([pair_similarities, pair_similarities])
+
+    # each user's k most similar new neighbours, most similar first
+    order = np.lexsort((-pair_similarities, users))
+    users, others = users[order], others[order]
+    pair_similarities = pair_similarities[order]
+    ranks = np.arange(len(users)) - np.searchsorted(users, users)
+    keep = ranks < k
+    new_neighbours = np.full((n_users, k), -1, dtype=np.int32)
+    new_similarities = np.full((n_users, k), -1, dtype=np.float32)
+    new_neighbours[users[keep], ranks[keep]] = others[keep]
+    new_similarities[users[keep], ranks[keep]] = pair_similarities[keep]
+
+    # then the k best of the old and new neighbours, only for users with new ones
+    changed = np.unique(users)
+    both = np.concatenate([neighbours[changed], new_neighbours[changed]], axis=1)
+    both_similarities = np.concatenate(
+        [similarities[changed], new_similarities[changed]], axis=1
+    )
+    best = np.argsort(-both_similarities, axis=1, kind="stable")[:, :k]
+    neighbours[changed] = np.take_along_axis(both, best, axis=1)
+    similarities[changed] = np.take_along_axis(both_similarities, best, axis=1)
+
+
+def nearest_neighbours(
+    location=S3_FOLDER,
+    matrix_folder=MATRIX_FOLDER,
+    k=NEIGHBOURS,
+    bands=BANDS,
+    rows_per_band=ROWS_PER_BAND,
+    window=WINDOW,
+    workers=WORKERS,
+    seed=0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Find each user's top k neighbours by cosine similarity among LSH candidates, returning
+    (neighbours, similarities) arrays of shape users x k, padded with -1 and 0"""
+    rng = np.random.default_rng(seed)
+    matrix = open_rating_matrix(open_storage(location), matrix_folder)
+    n_users = matrix.shape[0]
+    n_hashes = bands * rows_per_band
+    a = rng.integers(1, PRIME, n_hashes, dtype=np.int64)
+    b = rng.integers(0, PRIME, n_hashes, dtype=np.int64)
+    neighbours = np.full((n_users, k), -1, dtype=np.int32)
+    similarities = np.full((n_users, k), -1, dtype=np.float32)
+
+    with Pool(
+        workers, initializer=_open_matrix, initargs=(location, matrix_folder)
+    ) as pool:
+        # MinHash signatures, one block of users per task
+        tasks = [
+            (start, min(start + USER_BLOCK, n_users), a, b)
+            for start in range(0, n_users, USER_BLOCK)
+        ]
+        signatures = np.concatenate(
+            [np.empty((0, n_hashes), dtype=np.uint32)]
+            + list(
+                tqdm(
+                    pool.imap(_sign_users, tasks),
+                    total=len(tasks),
+                    desc="Signing users",
+                )
+            )
+        )
+
+        # one band at a time, so only one band's candidate pairs are held in memory
+        multipliers = rng.integers(1, 2**63, rows_per_band, dtype=np.uint64) | 1
+        for band in tqdm(range(bands), desc="Comparing candidates"):
+            # hash the band's MinHash values into one key per user
+            values = signatures[:, band * rows_per_band : (band + 1) * rows_per_band]
+            keys = (values.astype(np.uint64) * multipliers).sum(axis=1, dtype=np.uint64)
+            pairs = _band_pairs(keys, window, rng)
+
+            # pairs found in an earlier band were already offered to both users
+            known = (neighbours[pairs[:, 0]] == pairs[:, 1:]).any(axis=1)
+            known |= (neighbours[pairs[:, 1]] == pairs[:, :1]).any(axis=1)
+            pairs = pairs[~known]
+            count("candidate_pairs", len(pairs))
+
+            blocks = [
+                pairs[i : i + PAIR_BLOCK] for i in range(0, len(pairs), PAIR_BLOCK)
+            ]
+            pair_similarities = np.concatenate(
+                [np.empty(0, dtype=np.float32)] + pool.map(_score_pairs, blocks)
+            )
+            _merge_neighbours(neighbours, similarities, pairs, pair_similarities)
+
+    similarities[neighbours < 0] = 0
+    return neighbours, similarities
+
+
+def sample_groups(
+    neighbours,
+    similarities,
+    n_groups,
+    min_size=3,
+    max_size=8,
+    cohesion=0.9,
+    stochastic=False,
+    seed=0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Sample groups of min_size to max_size users, returning (members, offsets) where group
+    i is members[offsets[i]:offsets[i + 1]]
+
+    Each member after the first is, with probability cohesion, a neighbour of the current
+    members: the most similar one, or drawn in proportion to similarity if stochastic.
+    Otherwise (or if they have no neighbours left) it's a random user.
+    """
+    rng = np.random.default_rng(seed)
+    n_users = len(neighbours)
+    seeds = np.flatnonzero(neighbours[:, 0] >= 0)
+    if not len(seeds) or n_users < max_size:
+        raise ValueError("Not enough users with neighbours to sample groups from")
+
+    members = []
+    offsets = [0]
+    for _ in tqdm(range(n_groups), desc="Sampling groups"):
+        group = [int(rng.choice(seeds))]
+        size = rng.integers(min_size, max_size + 1)
+        while len(group) < size:
+            # neighbours of the group not in it yet, with their best similarity to it
+            candidates = dict()
+            if rng.random() < cohesion:
+                for member in group:
+                    for other, similarity in zip(
+                        neighbours[member], similarities[member]
+                    ):
+                        if other >= 0 and other not in group:
+                            candidates[other] = max(
+                                similarity, candidates.get(other, 0)
+                            )
+
+            if not candidates:
+                user = int(rng.integers(n_users))
+                if user not in group:
+                    group.append(user)
+                continue
+
+            users = list(candidates)
+            weights = np.maximum(list(candidates.values()), 1e-6)
+            if stochastic:
+                group.append(int(rng.choice(users, p=weights / weights.sum())))
+            else:
+                group.append(int(users[np.argmax(weights)]))
+
+        members += group
+        offsets.append(len(members))
+
+    return np.array(members, dtype=np.int32), np.array(offsets, dtype=np.int64)
+
+
+def _save_array(storage, key, values):
+    """Save an array as a .npy file in storage"""
+    with storage.open_write(key) as f:
+        np.save(f, values)
+
+
+def save_groups(storage, folder, neighbours, similarities, members, offsets, params):
+    """Save neighbours, groups and the parameters they were made with"""
+    _save_array(storage, f"{folder}/neighbours.npy", neighbours)
+    _save_array(storage, f"{folder}/similarities.npy", similarities)
+    _save_array(storage, f"{folder}/members.npy", members)
+    _save_array(storage, f"{folder}/offsets.npy", offsets)
+    storage.put(f"{folder}/params.json", json.dumps(params).encode("utf-8"))
+
+
+def load_groups(storage, folder=GROUPS_FOLDER) -> list[np.ndarray]:
+    """Load saved groups as a list of arrays of rating matrix user indexes"""
+    members = np.load(storage.local_path(f"{folder}/members.npy"), mmap_mode="r")
+    offsets = np.load(storage.local_path(f"{folder}/offsets.npy"))
+    return np.split(members, offsets[1:-1])
+
+
+def generate_groups(
+    n_groups=10000,
+    min_size=3,
+    max_size=8,
+    cohesion=0.9,
+    stochastic=False,
+    k=NEIGHBOURS,
+    workers=WORKERS,
+    seed=0,
+    folder=GROUPS_FOLDER,
+):
+    """Find neighbours, sample groups and save them, main function"""
+    params = {key: value for key, value in locals().items() if key != "folder"}
+    start_stage(STAGE)
+
+    with timer("neighbours"):
+        neighbours, similarities = nearest_neighbours(k=k, workers=workers, seed=seed)
+    found = int(np.count_nonzero(neighbours[:, 0] >= 0))
+    print(f"\nFound neighbours for {found} of {len(neighbours)} users\n")
+    count("users", len(neighbours))
+    count("users_with_neighbours", found)
+
+    with timer("sample"):
+        members, offsets = sample_groups(
+            neighbours,
+            similarities,
+            n_groups,
+            min_size,
+            max_size,
+            cohesion,
+            stochastic,
+            seed,
+        )
+    count("groups", n_groups)
+    count("members", len(members))
+
+    with timer("save"):
+        save_groups(
+            open_storage(S3_FOLDER),
+            folder,
+            neighbours,
+            similarities,
+            members,
+            offsets,
+            params,
+        )
+    print(f"Saved {n_groups} groups to {S3_FOLDER}/{folder}")
+    end_stage()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic book clubs")
+    parser.add_argument("--groups", type=int, default=10000)
+    parser.add_argument("--min-size", type=int, default=3)
+    parser.add_argument("--max-size", type=int, default=8)
+    parser.add_argument("--cohesion", type=float, default=0.9)
+    parser.add_argument("--stochastic", action="store_true")
+    parser.add_argument("--neighbours", type=int, default=NEIGHBOURS)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start_run()
+    generate_groups(
+        args.groups,
+        args.min_size,
+        args.max_size,
+        args.cohesion,
+        args.stochastic,
+        args.neighbours,
+        args.workers,
+        args.seed,
+    )
+    report_key = save_report(open_storage(S3_FOLDER), REPORTS_FOLDER)
+    print(f"Saved run report to {S3_FOLDER}/{report_key}")
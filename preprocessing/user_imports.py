@@ -0,0 +1,333 @@
+import argparse
+import csv
+import hashlib
+import re
+import time
+import unicodedata
+from array import array
+
+import numpy as np
+from tqdm import tqdm
+
+from amz_preproc import OL_STAGE, S3_FOLDER
+from checkpoint import mark_stage_done, stage_is_current, stage_record
+from columnar import load_shard, save_shard
+from instrument import (
+    REPORTS_FOLDER,
+    count,
+    end_stage,
+    save_report,
+    start_run,
+    start_stage,
+    timer,
+)
+from isbn_index import (
+    INDEX_FOLDER,
+    int_to_work_id,
+    lookup_isbns,
+    open_isbn_index,
+    work_id_to_int,
+)
+from sharding import shard_paths
+from storage import open_storage
+
+"""
+Importing members' Goodreads and StoryGraph library exports as ratings of Open Library works
+- Exports are CSV files, read a row at a time. The format is picked from the header, and
+  only rated books are kept. ISBNs are normalized to ISBN-13s, including Goodreads'
+  ="0439023483" quoting, and an export's ISBN-13 column is tried before its ISBN-10 one
+- Every member's books are matched together, in one batch lookup per column against the
+  sorted ISBN index (see isbn_index.py). Books without a matching ISBN fall back to their
+  normalized title (lowercased, accents, series and subtitles removed) in a title index
+  built from the works shards. Works don't store author names, so titles that several
+  works share are ambiguous and left unmatched rather than guessed
+- A member's ratings of several editions of one work are rolled up to their mean, like in
+  work_ratings.py. The output is one shard in the reviews layout, {member: [{work id:
+  rating}, ...]}, saved to imports/<name>
+- The title index is sorted uint64 hashes of normalized titles with a parallel array of work
+  numbers (0 for ambiguous titles), memory-mapped like the ISBN index. It's rebuilt when
+  the Open Library stage's outputs change
+"""
+
+IMPORTS_FOLDER = "imports"
+TITLE_INDEX_FOLDER = "title_index"
+TITLE_STAGE = "title_index"  # name of the title index's stage record
+
+# columns of each export format, ISBN columns in the order they're tried
+EXPORT_FORMATS = {
+    "goodreads": {
+        "isbns": ["ISBN13", "ISBN"],
+        "title": "Title",
+        "rating": "My Rating",
+    },
+    "storygraph": {
+        "isbns": ["ISBN/UID"],
+        "title": "Title",
+        "rating": "Star Rating",
+    },
+}
+ARTICLES = {"the", "a", "an"}  # dropped from the start of titles
+
+
+def normalize_isbn(value) -> str:
+    """An export's ISBN cell without Goodreads' ="..." quoting, hyphens or spaces"""
+    if not value:
+        return ""
+    value = value.strip()
+    if value.startswith("="):
+        value = value[1:]
+    return value.strip('"').replace("-", "").replace(" ", "")
+
+
+def normalize_title(title) -> str:
+    """A title lowercased, without accents, bracketed series (e.g. "(Dune, #1)"), subtitle,
+    punctuation or leading article"""
+    title = unicodedata.normalize("NFKD", title.lower())
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    title = re.sub(r"\(.*?\)|\[.*?\]", " ", title).split(":")[0]
+    words = re.sub(r"[^\w\s]", "", title).split()
+    if words and words[0] in ARTICLES:
+        words = words[1:]
+    return " ".join(words)
+
+
+def title_keys(titles) -> np.ndarray:
+    """uint64 hash of each normalized title, 0 for titles that normalize to nothing"""
+    keys = np.zeros(len(titles), dtype=np.uint64)
+    for i, title in enumerate(titles):
+        title = normalize_title(title)
+        if title:
+            digest = hashlib.blake2b(title.encode("utf-8"), digest_size=8).digest()
+            keys[i] = int.from_bytes(digest, "little") or 1
+    return keys
+
+
+def _save_array(storage, key, values):
+    """Save an array as a .npy file in storage"""
+    with storage.open_write(key) as f:
+        np.save(f, values)
+
+
+def build_title_index(storage, folder=TITLE_INDEX_FOLDER) -> tuple[int, int]:
+    """Hash every work's title into a sorted index, returning the number of titles and how
+    many of them are ambiguous"""
+    keys, work_numbers = array("Q"), array("Q")
+    for path in tqdm(shard_paths(storage, "works"), desc="Indexing titles"):
+        works = load_shard(storage, path, "works", columns=["title"])
+        titled = [
+            (work_id, work["title"])
+            for work_id, work in works.items()
+            if work.get("title")
+        ]
+        keys.extend(title_keys([title for _, title in titled]).tolist())
+        work_numbers.extend(work_id_to_int(work_id) for work_id, _ in titled)
+
+    keys = np.frombuffer(keys, dtype=np.uint64)
+    work_numbers = np.frombuffer(work_numbers, dtype=np.uint64)
+    order = np.lexsort((work_numbers, keys))
+    keys, work_numbers = keys[order], work_numbers[order]
+    keep = keys > 0
+    keys, work_numbers = keys[keep], work_numbers[keep]
+
+    # one entry per title, with work number 0 if the title belongs to several works
+    starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+    ends = np.append(starts[1:], len(keys)) - 1
+    ambiguous = work_numbers[starts] != work_numbers[ends]
+    _save_array(storage, f"{folder}/keys.npy", keys[starts])
+    _save_array(
+        storage,
+        f"{folder}/work_numbers.npy",
+        np.where(ambiguous, 0, work_numbers[starts]).astype(np.uint64),
+    )
+    return len(starts), int(np.count_nonzero(ambiguous))
+
+
+def process_title_index(
+    location=S3_FOLDER, folder=TITLE_INDEX_FOLDER, skip_if_current=False
+):
+    """Build the title index from the works shards
+
+    skip_if_current=True skips the stage if the index was built from the current outputs of
+    the Open Library stage.
+    """
+    storage = open_storage(location)
+    inputs = {"folder": folder, "upstream": stage_record(storage, OL_STAGE)}
+    if skip_if_current and stage_is_current(storage, TITLE_STAGE, inputs):
+        print("Title index is already built, skipping")
+        return
+    start_stage(TITLE_STAGE)
+
+    with timer("build"):
+        n_titles, n_ambiguous = build_title_index(storage, folder)
+    print(f"\nIndexed {n_titles} titles, {n_ambiguous} of them ambiguous\n")
+    count("titles", n_titles)
+    count("ambiguous_titles", n_ambiguous)
+    mark_stage_done(storage, TITLE_STAGE, inputs)
+    end_stage()
+
+
+def open_title_index(
+    storage, folder=TITLE_INDEX_FOLDER
+) -> tuple[np.ndarray, np.ndarray]:
+    """Memory-map a title index, returning its (keys, work_numbers) arrays"""
+    keys = np.load(storage.local_path(f"{folder}/keys.npy"), mmap_mode="r")
+    work_numbers = np.load(
+        storage.local_path(f"{folder}/work_numbers.npy"), mmap_mode="r"
+    )
+    return keys, work_numbers
+
+
+def lookup_titles(index, titles) -> tuple[np.ndarray, np.ndarray]:
+    """Look up a batch of titles, returning work numbers (0 where not found or ambiguous)
+    and whether each title was found"""
+    keys, work_numbers = index
+    query = title_keys(titles)
+    if not len(keys):
+        return np.zeros(len(query), dtype=np.uint64), np.zeros(len(query), dtype=bool)
+
+    positions = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    found = (keys[positions] == query) & (query > 0)
+    return np.where(found, work_numbers[positions], 0), found
+
+
+def export_format(columns) -> str:
+    """Name of the export format with these columns"""
+    for name, format_columns in EXPORT_FORMATS.items():
+        needed = format_columns["isbns"] + [
+            format_columns["title"],
+            format_columns["rating"],
+        ]
+        if all(column in columns for column in needed):
+            return name
+    raise ValueError(
+        f"Unknown export format, expected the columns of one of {list(EXPORT_FORMATS)}"
+    )
+
+
+def read_export(f):
+    """Yield (isbns, title, rating) of each rated book in an export open as text, isbns in
+    the order they're tried"""
+    reader = csv.reader(f)
+    header = next(reader, [])
+    columns = EXPORT_FORMATS[export_format(header)]
+    isbn_columns = [header.index(column) for column in columns["isbns"]]
+    title_column = header.index(columns["title"])
+    rating_column = header.index(columns["rating"])
+
+    n_rows = n_unrated = 0
+    for row in reader:
+        n_rows += 1
+        try:
+            rating = float(row[rating_column] or 0)
+        except (ValueError, IndexError):
+            rating = 0
+        if rating <= 0:
+            n_unrated += 1
+            continue
+        isbns = [normalize_isbn(row[column]) for column in isbn_columns]
+        yield isbns, row[title_column], rating
+    count("rows", n_rows)
+    count("unrated", n_unrated)
+
+
+def match_books(books, isbn_index, title_index) -> np.ndarray:
+    """Work numbers of a batch of (isbns, title, rating) books, 0 where unmatched"""
+    works = np.zeros(len(books), dtype=np.uint64)
+    n_columns = max((len(isbns) for isbns, _, _ in books), default=0)
+    for column in range(n_columns):
+        rows = np.flatnonzero(works == 0)
+        isbns = [
+            books[row][0][column] if column < len(books[row][0]) else "" for row in rows
+        ]
+        works[rows] = lookup_isbns(isbn_index, isbns)
+    count("isbn_matches", int(np.count_nonzero(works)))
+
+    rows = np.flatnonzero(works == 0)
+    numbers, found = lookup_titles(title_index, [books[row][1] for row in rows])
+    works[rows] = numbers
+    count("title_matches", int(np.count_nonzero(numbers)))
+    count("ambiguous_titles", int(np.count_nonzero(found & (numbers == 0))))
+    count("unmatched", int(np.count_nonzero(numbers == 0)))
+    return works
+
+
+def import_exports(
+    exports,
+    location=S3_FOLDER,
+    name=None,
+    output_format="json",
+    index_folder=INDEX_FOLDER,
+    title_folder=TITLE_INDEX_FOLDER,
+) -> dict:
+    """Match members' exports ({member: path}) to works, returning {member: [{work id:
+    rating}, ...]} and saving it as imports/<name> if a name is given"""
+    storage = open_storage(location)
+    isbn_index = open_isbn_index(storage, index_folder)
+    title_index = open_title_index(storage, title_folder)
+
+    members, books = [], []
+    with timer("read"):
+        for member, path in exports.items():
+            with open(path, newline="", encoding="utf-8-sig") as f:
+                for book in read_export(f):
+                    members.append(member)
+                    books.append(book)
+
+    with timer("match"):
+        works = match_books(books, isbn_index, title_index)
+
+    # each member's mean rating of each work
+    totals = dict()
+    for member, work, (_, _, rating) in zip(members, works.tolist(), books):
+        if work:
+            total = totals.setdefault(member, dict()).setdefault(work, [0.0, 0])
+            total[0] += rating
+            total[1] += 1
+    ratings = {
+        member: [
+            {int_to_work_id(work): total / n}
+            for work, (total, n) in sorted(member_totals.items())
+        ]
+        for member, member_totals in sorted(totals.items())
+    }
+    count("ratings", sum(len(member_ratings) for member_ratings in ratings.values()))
+
+    if name is not None:
+        save_shard(
+            storage,
+            f"{IMPORTS_FOLDER}/{name}",
+            ratings.items(),
+            "reviews",
+            output_format,
+        )
+    return ratings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import Goodreads or StoryGraph exports as ratings of works"
+    )
+    parser.add_argument(
+        "exports", nargs="*", help="member=path of each member's export CSV"
+    )
+    parser.add_argument("--name", help="save the ratings to imports/<name>")
+    parser.add_argument("--location", default=S3_FOLDER)
+    parser.add_argument("--format", default="json", choices=["json", "columnar"])
+    parser.add_argument("--build-index", action="store_true")
+    args = parser.parse_args()
+
+    start_run()
+    if args.build_index:
+        process_title_index(args.location, skip_if_current=True)
+    if args.exports:
+        start_stage("imports")
+        start = time.perf_counter()
+        exports = dict(export.split("=", 1) for export in args.exports)
+        ratings = import_exports(exports, args.location, args.name, args.format)
+        print(
+            f"Imported {sum(len(r) for r in ratings.values())} ratings of "
+            f"{len(ratings)} members in {time.perf_counter() - start:.3f}s"
+        )
+        end_stage()
+    report_key = save_report(open_storage(args.location), REPORTS_FOLDER)
+    print(f"Saved run report to {args.location}/{report_key}")
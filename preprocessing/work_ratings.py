@@ -0,0 +1,279 @@
+import argparse
+import json
+from collections import defaultdict
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+from amz_preproc import BOOK_STAGE, OL_STAGE, REVIEW_STAGE, S3_FOLDER
+from checkpoint import mark_stage_done, stage_is_current, stage_record
+from columnar import load_shard, save_shard
+from instrument import (
+    REPORTS_FOLDER,
+    add_counts,
+    count,
+    end_stage,
+    save_report,
+    start_run,
+    start_stage,
+    take_counts,
+    timer,
+)
+from isbn_index import asin_works, int_to_work_id, work_id_to_int
+from sharding import (
+    folder_bytes,
+    hash_slot,
+    save_manifest,
+    shard_count,
+    shard_name,
+    shard_paths,
+)
+from storage import AsyncWriter, open_storage
+
+"""
+Work-level ratings table, joining Amazon ratings to Open Library works
+- Each ASIN's ISBN-13s, then ISBN-10s (amz_isbn13s / amz_isbn10s) are looked up in the
+  sorted ISBN index (see isbn_index.py), the first one found gives the ASIN's work. This
+  side of the join has one int per Amazon book, so it's held in memory
+- Ratings (from the reviews shards) and the works they match (from the works shards) are
+  partitioned by a hash of the work id onto disk, buffered and spilled SPILL_BYTES at a
+  time, so neither side is ever in memory whole
+- Partitions are hash-joined in a pool of workers, one partition per worker at a time. The
+  number of partitions is picked from the inputs' size so each one fits in its worker's
+  share of the memory budget
+- A user's ratings of several ASINs of one work are rolled up to their mean
+- Each partition is saved as one hash shard of work_ratings/ (see sharding.py), so lookups
+  by work id go through the manifest like any other sharded output. A record is the work's
+  fields plus "asins" (its rated ASINs) and parallel "users" / "ratings" lists sorted by user
+"""
+
+WORK_RATINGS_FOLDER = "work_ratings"
+TEMP_FOLDER = "temp_join"
+STAGE = "work_ratings"
+MEMORY_BUDGET = 2**30  # bytes the partition joins may use together
+# memory a partition takes when joined, relative to its input bytes, about
+EXPANSION = 8
+SPILL_BYTES = 2**26  # partitioned rows buffered before they're spilled to disk
+WORKERS = 4
+
+_storage = None  # storage, opened in each worker
+
+
+class _Partitioner:
+    """Buffers JSON lines by partition, spilling every partition's buffer to a new part
+    under folder once they hold spill_bytes together"""
+
+    def __init__(self, writer, folder, spill_bytes):
+        self.writer = writer
+        self.folder = folder
+        self.spill_bytes = spill_bytes
+        self.buffers = defaultdict(list)
+        self.buffered = 0
+        self.spills = 0
+
+    def add(self, partition, row):
+        line = json.dumps(row) + "\n"
+        self.buffers[partition].append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.spill_bytes:
+            self.spill()
+
+    def spill(self):
+        for partition, lines in self.buffers.items():
+            key = f"{self.folder}/{partition}/part_{self.spills}.jsonl"
+            self.writer.put(key, "".join(lines).encode("utf-8"))
+        self.buffers.clear()
+        self.buffered = 0
+        self.spills += 1
+
+
+def partition_inputs(storage, writer, manifest, spill_bytes=SPILL_BYTES) -> set:
+    """Partition matched ratings and their works onto disk by work, returning the names of
+    the partitions that have ratings"""
+    works = asin_works(storage)
+    count("asins_matched", len(works))
+
+    ratings = _Partitioner(writer, f"{TEMP_FOLDER}/ratings", spill_bytes)
+    rated = set()  # work numbers with ratings
+    for path in tqdm(shard_paths(storage, "reviews"), desc="Partitioning ratings"):
+        for user_id, reviews in load_shard(storage, path, "reviews").items():
+            for review in reviews:
+                for asin, rating in review.items():
+                    number = works.get(asin)
+                    if number is None:
+                        count("unmatched_ratings")
+                        continue
+                    partition = shard_name(int_to_work_id(number), manifest)
+                    ratings.add(partition, [number, user_id, asin, rating])
+                    rated.add(number)
+    ratings.spill()
+    del works
+
+    metadata = _Partitioner(writer, f"{TEMP_FOLDER}/works", spill_bytes)
+    for path in tqdm(shard_paths(storage, "works"), desc="Partitioning works"):
+        for work_id, work in load_shard(storage, path, "works").items():
+            if work_id_to_int(work_id) in rated:
+                metadata.add(shard_name(work_id, manifest), [work_id, work])
+    metadata.spill()
+
+    writer.flush()
+    return {shard_name(int_to_work_id(number), manifest) for number in rated}
+
+
+def _open_storage(location):
+    """Open storage in a worker, which starts with empty counts so it only hands back its
+    own"""
+    global _storage
+    start_run()
+    _storage = open_storage(location)
+
+
+def _read_partition(side, partition):
+    """Rows of one side of a partition, from each of its spilled parts"""
+    for key in _storage.list(f"{TEMP_FOLDER}/{side}/{partition}"):
+        for line in _storage.iter_lines(key):
+            yield json.loads(line)
+
+
+def _join_partition(task) -> tuple[str, dict, dict]:
+    """Join one partition's ratings to their works and save it as a shard, returning the
+    partition, its shard's {"records", "bytes"} and counts"""
+    partition, folder, output_format = task
+    works = {work_id: work for work_id, work in _read_partition("works", partition)}
+
+    # work id -> user id -> [rating total, count], work id -> rated ASINs
+    totals = defaultdict(dict)
+    asins = defaultdict(set)
+    counts = {"joined_ratings": 0, "ratings": 0, "works_without_metadata": 0}
+    for number, user_id, asin, rating in _read_partition("ratings", partition):
+        work_id = int_to_work_id(number)
+        total = totals[work_id].setdefault(user_id, [0.0, 0])
+        total[0] += rating
+        total[1] += 1
+        asins[work_id].add(asin)
+        counts["joined_ratings"] += 1
+
+    items = []
+    for work_id in sorted(totals, key=lambda work_id: (hash_slot(work_id), work_id)):
+        if work_id not in works:
+            counts["works_without_metadata"] += 1
+        users = sorted(totals[work_id])
+        record = dict(works.get(work_id, {}))
+        record["asins"] = sorted(asins[work_id])
+        record["users"] = users
+        record["ratings"] = [
+            totals[work_id][user][0] / totals[work_id][user][1] for user in users
+        ]
+        counts["ratings"] += len(users)
+        items.append((work_id, record))
+
+    n_bytes = save_shard(
+        _storage, f"{folder}/{partition}", items, "work_ratings", output_format
+    )
+    counts.update(take_counts())  # files written by this worker
+    return partition, {"records": len(items), "bytes": n_bytes}, counts
+
+
+def build_work_ratings(
+    location,
+    folder=WORK_RATINGS_FOLDER,
+    output_format="json",
+    memory_budget=MEMORY_BUDGET,
+    workers=WORKERS,
+    spill_bytes=SPILL_BYTES,
+) -> dict:
+    """Join ratings to works into folder, returning its manifest"""
+    storage = open_storage(location)
+    input_bytes = folder_bytes(storage, "reviews") + folder_bytes(storage, "works")
+    n_partitions = shard_count(input_bytes, memory_budget // (workers * EXPANSION))
+    manifest = {
+        "sharding": "hash",
+        "first_n": None,
+        "shards": n_partitions,
+        "format": output_format,
+    }
+    count("partitions", n_partitions)
+
+    storage.delete(TEMP_FOLDER)
+    storage.delete(folder)
+    writer = AsyncWriter(storage)
+    with timer("partition"):
+        partitions = partition_inputs(storage, writer, manifest, spill_bytes)
+    writer.close()
+
+    files = dict()
+    with timer("join"), Pool(
+        workers, initializer=_open_storage, initargs=(location,)
+    ) as pool:
+        tasks = [(partition, folder, output_format) for partition in sorted(partitions)]
+        for partition, file, counts in tqdm(
+            pool.imap_unordered(_join_partition, tasks),
+            total=len(tasks),
+            desc="Joining partitions",
+        ):
+            files[partition] = file
+            add_counts(counts)
+
+    storage.delete(TEMP_FOLDER)
+    return save_manifest(storage, folder, manifest, dict(sorted(files.items())))
+
+
+def process_work_ratings(
+    location=S3_FOLDER,
+    folder=WORK_RATINGS_FOLDER,
+    output_format="json",
+    memory_budget=MEMORY_BUDGET,
+    workers=WORKERS,
+    skip_if_current=False,
+):
+    """Build the work-level ratings table, main function
+
+    skip_if_current=True skips the stage if the table was built from the current outputs of
+    the Open Library, Amazon books and reviews stages.
+    """
+    storage = open_storage(location)
+    inputs = {
+        "folder": folder,
+        "output_format": output_format,
+        "memory_budget": memory_budget,
+        "workers": workers,
+        "upstream": [
+            stage_record(storage, stage)
+            for stage in [OL_STAGE, BOOK_STAGE, REVIEW_STAGE]
+        ],
+    }
+    if skip_if_current and stage_is_current(storage, STAGE, inputs):
+        print("Work ratings are already built, skipping")
+        return
+    start_stage(STAGE)
+
+    with timer("build"):
+        manifest = build_work_ratings(
+            location, folder, output_format, memory_budget, workers
+        )
+    print(
+        f"\nJoined ratings to {manifest['records']} works in "
+        f"{len(manifest['files'])} partitions\n"
+    )
+    count("works", manifest["records"])
+    mark_stage_done(storage, STAGE, inputs)
+    end_stage()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Join ratings to Open Library works")
+    parser.add_argument("--location", default=S3_FOLDER)
+    parser.add_argument("--format", default="json", choices=["json", "columnar"])
+    parser.add_argument("--memory-budget", type=int, default=MEMORY_BUDGET)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    start_run()
+    process_work_ratings(
+        args.location,
+        output_format=args.format,
+        memory_budget=args.memory_budget,
+        workers=args.workers,
+    )
+    report_key = save_report(open_storage(args.location), REPORTS_FOLDER)
+    print(f"Saved run report to {args.location}/{report_key}")